@@ -0,0 +1,343 @@
+"""End to end benchmarks: how fast is a job, and how much of that is rsyncr?
+
+    python benchmarks/bench.py                  # run everything, print results
+    python benchmarks/bench.py --save           # ...and make them the baseline
+    python benchmarks/bench.py --compare        # ...or check against the baseline
+    python benchmarks/bench.py tiny-seq deep    # just some scenarios
+    python benchmarks/bench.py --transports     # ...and ssh vs rsync:// too
+
+Synthetic source trees (lots of tiny files, a few huge ones, deep trees, a big
+set of excludes) are made once in a work directory, then each scenario runs
+process_job on them with a real local rsync into a fresh target, twice: once
+to copy everything ("initial"), and again with nothing changed ("noop"). Each
+scenario runs in its own python process, so the memory numbers are its own.
+
+For each run this records:
+
+- wall: seconds for the whole process_job
+- overhead: CPU seconds spent in rsyncr's own process (parsing configs,
+  building commands, reading rsync's output...), as opposed to in rsync
+- peak_rss_kb: rsyncr's peak memory, and children_peak_rss_kb for rsync's
+- lines_per_sec: lines of rsync output handled per second of rsync running
+- mb_per_sec: file data moved per second of rsync running; with one source
+  that's the throughput of a single stream
+
+--transports also runs the huge tree over ssh (to localhost, which needs
+passwordless ssh there) and from an rsync daemon (rsync://) started on
+loopback, and compares the per-stream throughput of the two. Both pay for the
+network stack; only ssh pays for encryption.
+
+--compare fails (exit 1) if wall or overhead got more than --tolerance worse
+than the baseline, so it can go in CI. Timings depend on the machine, so a
+baseline is only good for the machine it was saved on.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "baseline.json")
+sys.path.insert(0, os.path.dirname(HERE))
+
+# name: (tree, extra job settings, extra per-source settings, sources, transport)
+SCENARIOS = {
+    "tiny-seq": ("tiny", {}, {}, 1, "local"),
+    "tiny-verbose": (
+        "tiny",
+        {"verbose": True, "itemize_changes": True},
+        {},
+        1,
+        "local",
+    ),
+    "tiny-parallel": ("tiny", {"max_parallel": 4, "max_per_device": 0}, {}, 4, "local"),
+    "tiny-sharded": ("tiny", {}, {"shards": 4}, 1, "local"),
+    "huge": ("huge", {}, {}, 1, "local"),
+    "deep": ("deep", {}, {}, 1, "local"),
+    "excludes": ("excludes", {}, {}, 1, "local"),
+    # only with --transports
+    "huge-ssh": ("huge", {}, {}, 1, "ssh"),
+    "huge-daemon": ("huge", {}, {}, 1, "daemon"),
+}
+TRANSPORTS = ("huge-ssh", "huge-daemon")
+
+
+def _bytes(rng, n):
+    return rng.getrandbits(8 * n).to_bytes(n, "little")
+
+
+def make_tree(kind, root, scale=1.0):
+    """a synthetic source tree; the same every time for the same scale"""
+    rng = random.Random(kind)
+    os.makedirs(root)
+    if kind in ("tiny", "excludes"):
+        # split into 4 top-level dirs, so it can also be 4 sources
+        n = int((20000 if kind == "tiny" else 5000) * scale)
+        for i in range(n):
+            d = os.path.join(root, f"part{i % 4}", f"d{i % 97:02}")
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, f"f{i}.txt"), "wb") as f:
+                f.write(_bytes(rng, rng.randint(10, 400)))
+    elif kind == "huge":
+        chunk = _bytes(rng, 1 << 20)
+        for i in range(max(1, int(4 * scale))):
+            with open(os.path.join(root, f"big{i}.bin"), "wb") as f:
+                for j in range(64):
+                    # not all the same block, or it'd compress to nothing
+                    f.write(chunk[j:] + chunk[:j])
+    elif kind == "deep":
+        for i in range(int(200 * scale)):
+            levels = [f"l{k}" for k in range(5 + i % 25)]
+            d = os.path.join(root, *levels, f"c{i}")
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, "leaf"), "wb") as f:
+                f.write(_bytes(rng, 100))
+    else:
+        raise ValueError(kind)
+
+
+def excludes_for(kind):
+    if kind != "excludes":
+        return []
+    # lots of patterns, few of which match anything
+    return [f"*.nope{i}" for i in range(1000)] + ["d1*/f1*"]
+
+
+def write_configs(
+    confdir, source_root, target_root, scenario, rsync_command, rsyncd_port=None
+):
+    tree, job, per_source, sources, transport = SCENARIOS[scenario]
+    with open(os.path.join(confdir, "global.toml"), "w") as f:
+        f.write(f'rsync_command = "{rsync_command}"\n')
+        f.write("console_override = true\n")
+        f.write(f'state_dir = "{confdir}/state"\n')
+    lines = [f'target_root = "{target_root}"']
+    if transport == "ssh":
+        lines.append('host = "localhost:"')
+    elif transport == "daemon":
+        # the daemon's module is the trees directory
+        lines.append(f'host = "rsync://127.0.0.1:{rsyncd_port}/bench"')
+        source_root = "/" + os.path.basename(source_root)
+    for k, v in job.items():
+        lines.append(f"{k} = {json.dumps(v)}")
+    excludes = excludes_for(tree)
+    if excludes:
+        lines.append(f"excludes = {json.dumps(excludes)}")
+    if sources == 1:
+        srcs = [("all", source_root)]
+    else:
+        srcs = [
+            (f"part{i}", os.path.join(source_root, f"part{i}")) for i in range(sources)
+        ]
+    for name, location in srcs:
+        lines.append(f"\n[sources.{name}]")
+        lines.append(f'location = "{location}"')
+        lines.append(f'target = "{name}"')
+        for k, v in per_source.items():
+            lines.append(f"{k} = {json.dumps(v)}")
+    with open(os.path.join(confdir, "config.bench.toml"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def measure_once(confdir):
+    """run the job once, here; returns the numbers"""
+    from rsyncr import run
+    from rsyncr import trace
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    trace.start()
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            results = run.process_job("bench", config_dir=confdir)
+        finally:
+            sys.stdout = stdout
+    wall = time.perf_counter() - started
+    path = os.path.join(confdir, "trace.json")
+    trace.write(path)
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    rsyncs = [e for e in events if e["name"] == "run_command"]
+    rsync_seconds = sum(e["dur"] for e in rsyncs) / 1e6
+    lines = sum(e["args"].get("lines", 0) for e in rsyncs)
+    moved = sum(r["stats"].transferred_file_size for r in results if r.get("stats"))
+    return {
+        "wall": round(wall, 4),
+        "overhead": round(
+            (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime), 4
+        ),
+        "rsyncs": len(rsyncs),
+        "lines": lines,
+        "lines_per_sec": round(lines / rsync_seconds) if rsync_seconds else None,
+        "mb_per_sec": round(moved / rsync_seconds / 1e6, 2) if rsync_seconds else None,
+        "errors": sum(1 for r in results if r["error"]),
+    }
+
+
+def run_scenario(scenario, workdir, rsync_command, rsyncd_port=None):
+    """both runs of one scenario; called in a child process"""
+    tree = SCENARIOS[scenario][0]
+    source_root = os.path.join(workdir, "trees", tree)
+    confdir = tempfile.mkdtemp(prefix=f"{scenario}-", dir=workdir)
+    target_root = os.path.join(confdir, "target")
+    write_configs(
+        confdir, source_root, target_root, scenario, rsync_command, rsyncd_port
+    )
+    out = {"initial": measure_once(confdir), "noop": measure_once(confdir)}
+    out["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    out["children_peak_rss_kb"] = children.ru_maxrss
+    shutil.rmtree(confdir)
+    return out
+
+
+def start_rsyncd(workdir, rsync_command):
+    """an rsync daemon on loopback serving the trees as module 'bench'; returns
+    (process, port)"""
+    import socket
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    path = os.path.join(workdir, "rsyncd.conf")
+    with open(path, "w") as f:
+        f.write(f"pid file = {workdir}/rsyncd.pid\nuse chroot = false\n")
+        f.write(f"[bench]\npath = {workdir}/trees\nread only = true\n")
+        f.write(f"uid = {os.getuid()}\ngid = {os.getgid()}\n")
+    proc = subprocess.Popen(
+        [rsync_command, "--daemon", "--no-detach", "--address=127.0.0.1"]
+        + [f"--port={port}", f"--config={path}"]
+    )
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return proc, port
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    sys.exit("the rsync daemon didn't start")
+
+
+def transport_report(results):
+    """how a single stream over ssh compares with one from the daemon"""
+    if not all(n in results for n in TRANSPORTS):
+        return []
+    ssh, daemon = (results[n]["initial"]["mb_per_sec"] or 0 for n in TRANSPORTS)
+    lines = [f"per-stream throughput: ssh {ssh:.1f} MB/s, rsync:// {daemon:.1f} MB/s"]
+    if ssh:
+        lines.append(f"rsync:// is {(daemon / ssh - 1) * 100:+.0f}% against ssh")
+    return lines
+
+
+def compare(results, baseline, tolerance):
+    """lines describing what got worse; empty if nothing did"""
+    worse = []
+    for scenario, runs in results.items():
+        base = baseline.get(scenario)
+        if not base:
+            continue
+        for phase in ("initial", "noop"):
+            for metric in ("wall", "overhead"):
+                now, then = runs[phase][metric], base[phase][metric]
+                # tiny numbers are mostly noise
+                if then >= 0.05 and now > then * (1 + tolerance):
+                    worse.append(
+                        f"{scenario} {phase} {metric}: {then:.3f} -> {now:.3f}"
+                        f" (+{(now / then - 1) * 100:.0f}%)"
+                    )
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("scenarios", nargs="*", help=f"of {', '.join(SCENARIOS)}")
+    parser.add_argument("--rsync", default="rsync", help="rsync to use")
+    parser.add_argument("--scale", type=float, default=1.0, help="tree size factor")
+    parser.add_argument("--workdir", help="where to put trees (default: a temp dir)")
+    parser.add_argument("--save", action="store_true", help="save as the baseline")
+    parser.add_argument("--compare", action="store_true", help="check the baseline")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline json file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--transports", action="store_true", help="compare ssh and rsync://"
+    )
+    parser.add_argument("--one", help=argparse.SUPPRESS)
+    parser.add_argument("--rsyncd-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.one:
+        # in the child process
+        out = run_scenario(args.one, args.workdir, args.rsync, args.rsyncd_port)
+        print(json.dumps(out))
+        return
+
+    if shutil.which(args.rsync) is None:
+        sys.exit(f"no {args.rsync} here; these benchmarks need a real rsync")
+    names = args.scenarios or [n for n in SCENARIOS if n not in TRANSPORTS]
+    if args.transports:
+        names += [n for n in TRANSPORTS if n not in names]
+    for n in names:
+        if n not in SCENARIOS:
+            parser.error(f"no such scenario {n}")
+    if "huge-ssh" in names:
+        ok = subprocess.run(["ssh", "-o", "BatchMode=yes", "localhost", "true"])
+        if ok.returncode:
+            sys.exit("huge-ssh needs passwordless ssh to localhost")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rsyncr-bench-")
+    rsyncd = None
+    try:
+        for tree in sorted({SCENARIOS[n][0] for n in names}):
+            root = os.path.join(workdir, "trees", tree)
+            if not os.path.exists(root):
+                print(f"making {tree} tree...", file=sys.stderr)
+                make_tree(tree, root, args.scale)
+        cmd = [sys.executable, __file__, "--workdir", workdir]
+        if "huge-daemon" in names:
+            rsyncd, port = start_rsyncd(workdir, args.rsync)
+            cmd += ["--rsyncd-port", str(port)]
+        results = {}
+        for n in names:
+            print(f"running {n}...", file=sys.stderr)
+            out = subprocess.run(
+                cmd + ["--one", n, "--rsync", args.rsync],
+                stdout=subprocess.PIPE,
+                check=True,
+            ).stdout
+            results[n] = json.loads(out.decode().strip().splitlines()[-1])
+    finally:
+        if rsyncd is not None:
+            rsyncd.terminate()
+            rsyncd.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    print(json.dumps(results, indent=2))
+    for line in transport_report(results):
+        print(line)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"scale": args.scale, "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != args.scale:
+            sys.exit("the baseline was made at a different --scale")
+        worse = compare(results, baseline["results"], args.tolerance)
+        for line in worse:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""One source, several targets: walk and pull the source once, then replay.
+
+A source with 'targets = [...]' is rsync'd to the first one as usual, but with
+--write-batch, which saves everything rsync did to that target in a batch file.
+The batch is then replayed onto the other targets (all at once) with
+--read-batch, which needs no source at all, so the source is only walked and
+pulled over the network once however many copies are kept.
+
+A replay only works on a target that was the same as the first one before the
+run; when one fails (a new replica, or one that's drifted), that target is
+rsync'd from the first target instead, which puts it right for next time.
+"""
+
+import os
+import hashlib
+
+
+def batch_path(conf, d):
+    """where a source's batch file goes"""
+    key = hashlib.sha1(f"{d['location']}\0{d['target']}".encode()).hexdigest()[:16]
+    return os.path.join(conf["state_dir"], "batches", f"{key}.batch")
+
+
+def _options(cmdlist):
+    """a command's options, without the source and target, and without the ones
+    that only make sense for talking to the source (rsync won't even start with
+    a --password-file when there's no daemon to give it to)"""
+    return [
+        a
+        for a in cmdlist[:-2]
+        if not a.startswith(
+            ("--rsh=", "--password-file=", "--write-batch=", "--read-batch=")
+        )
+    ]
+
+
+def write_batch_command(cmdlist, path):
+    """the normal command, also writing what it does to a batch file"""
+    return cmdlist[:-2] + [f"--write-batch={path}"] + cmdlist[-2:]
+
+
+def read_batch_command(cmdlist, path, target):
+    """replay a batch onto another target"""
+    return _options(cmdlist) + [f"--read-batch={path}", target]
+
+
+def copy_command(cmdlist, primary, target):
+    """the fallback: rsync the first target to another one"""
+    return _options(cmdlist) + [primary, target]
+
+
+def remove(path):
+    """clear out a batch file (and the .sh rsync writes next to it)"""
+    for p in (path, f"{path}.sh"):
+        try:
+            os.unlink(p)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,71 @@
+"""'rsyncr check <config>': is a job's config all right, and what would it run?
+
+The configs are read and merged just as a run would, so anything wrong with
+them turns up now rather than when the job next fires, and then each source's
+rsync command is printed (in full, ready to paste into a shell). Nothing is run,
+and none of the notifiers or process handling is even imported, so this is
+quick enough to go in a pre-commit hook or a deploy step.
+"""
+
+import sys
+import shlex
+import argparse
+
+from rsyncr import governor
+from rsyncr import run
+
+
+def quoted(cmdlist):
+    return " ".join(shlex.quote(a) for a in cmdlist)
+
+
+def check_job(conf):
+    """the commands for a loaded job, as text"""
+    lines = [f"{conf['job_name']}: ok, {len(conf['sources'])} source(s)"]
+    for n, d in conf["sources"].items():
+        lines.append(f"  {n}: {d['location']} to {d['target']}")
+        if d.get("shards"):
+            lines.append(f"    (in {d['shards']} shards)")
+        if d.get("replicas"):
+            lines.append(f"    (and replayed onto {', '.join(d['replicas'])})")
+        prefix = governor.priority_prefix(conf, d)
+        lines.append(f"    {quoted(prefix + run.build_command(conf, n))}")
+    return "\n".join(lines)
+
+
+def cli(argv):
+    """'rsyncr check <config>...': validate jobs and print their commands"""
+    parser = argparse.ArgumentParser(prog="rsyncr check")
+    parser.add_argument("config", nargs="*", help="job/config names to check")
+    parser.add_argument("--all", action="store_true", help="check every job")
+    parser.add_argument(
+        "--job-config-path", help="(optional) what job toml file to use"
+    )
+    parser.add_argument("--configs-dir", help="(optional) where to look for toml files")
+    parser.add_argument(
+        "--global-config-path", help="(optional) override global config settings"
+    )
+    args = parser.parse_args(argv)
+    if args.all:
+        names = run.find_jobs(args.configs_dir)
+    elif args.config:
+        names = args.config
+    else:
+        parser.error("name a config to check, or use --all")
+
+    bad = 0
+    for name in names:
+        try:
+            conf = run.load_job(
+                name,
+                job_config_path=args.job_config_path,
+                config_dir=args.configs_dir,
+                global_config_path=args.global_config_path,
+            )
+            print(check_job(conf))
+        except Exception as e:
+            # whatever's wrong (unreadable toml, a bad setting...) is the answer
+            bad += 1
+            print(f"{name}: BAD: {type(e).__name__}: {e}")
+    if bad:
+        sys.exit(1)
@@ -0,0 +1,64 @@
+"""Remember which sources of a job made it, so a failed run can be picked up again.
+
+In a job that has retries set (or is being resumed), every source that
+finishes cleanly is written down in state_dir/checkpoints/<job>.json as it
+happens. 'rsyncr --resume <config>' then only runs the sources that aren't in
+there; a plain run starts from scratch, and once a job has gone through with no
+errors its checkpoint is removed.
+
+A source only counts as done for the same location and target it was done with,
+so editing a config between the failed run and the resume doesn't skip anything
+it shouldn't.
+"""
+
+import os
+import json
+import threading
+
+
+def checkpoint_path(conf):
+    return os.path.join(
+        conf["state_dir"], "checkpoints", f"{conf.get('job_name') or 'job'}.json"
+    )
+
+
+def wanted(conf):
+    """whether a job's run should keep a checkpoint; one with no retries anywhere
+    isn't expected to need resuming, and mustn't need a writable state_dir"""
+    if conf["resume"] or conf["retries"]:
+        return True
+    return any(d.get("retries") for d in conf["sources"].values())
+
+
+class Checkpoint:
+    """one job's finished sources; safe to share between threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._done = json.load(f)
+
+    def done(self, source_name, d):
+        with self._lock:
+            return self._done.get(source_name) == [d["location"], d["target"]]
+
+    def mark(self, source_name, d):
+        with self._lock:
+            self._done[source_name] = [d["location"], d["target"]]
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._done = {}
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._done, f)
+        os.replace(tmp, self.path)
@@ -9,10 +9,35 @@ but can be overridden in a a global config file
 and then job level and source/target excludes ADD to those
 """
 
+import os
+import re
+import json
 import os.path
-from copy import deepcopy
-
-from tomlkit import parse as toml_parse
+import hashlib
+import logging
+
+from rsyncr import trace
+
+try:
+    # a plain, read-only toml parser is a lot quicker than tomlkit, which goes to
+    # the trouble of keeping comments and formatting we never write back out
+    from tomllib import loads as fast_toml_parse
+except ImportError:
+    try:
+        from tomli import loads as fast_toml_parse
+    except ImportError:
+        fast_toml_parse = None
+
+log = logging.getLogger()
+
+# where parsed config files (just the toml, before any defaults) are cached; not
+# a config setting, since it's needed before any config is read.
+# RSYNCR_CACHE_DIR="" turns the cache off.
+CACHE_DIR = os.environ.get("RSYNCR_CACHE_DIR")
+if CACHE_DIR is None:
+    CACHE_DIR = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "rsyncr"
+    )
 
 DEFAULTS = {
     # a dictionary containing sane defaults;
@@ -27,10 +52,17 @@ DEFAULTS = {
     "console_override": False,
     # if this is not None, save a file copy of the output of the command
     "capture_file": None,
+    # the full output goes to capture_file as it happens; only this many lines
+    # from the start and end of each source's output are kept for the message
+    "output_head_lines": 50,
+    "output_tail_lines": 200,
     # might need to be more detailed sometimes?
     "rsync_command": "rsync",
     # things to always exclude for all configs
     "global_excludes": [],
+    # more excludes than this (global + job + source) go in a rules file in
+    # state_dir rather than on the command line
+    "exclude_file_threshold": 32,
     "global_rsync_params": [
         "--delete",
         "--delete-excluded",
@@ -40,15 +72,179 @@ DEFAULTS = {
     ],
     "verbose": False,
     "dry_run": False,
+    # have rsync print --stats (and maybe --itemize-changes), which rsyncr counts
+    # up and writes to a Prometheus textfile and a JSON summary next to
+    # capture_file (or to metrics_file, for the .prom)
+    "stats": True,
+    "itemize_changes": False,
+    "metrics_file": None,
     "logging_level": "warning",  # for standard python logging
+    # how many sources to rsync at the same time; 1 is the old one-at-a-time way
+    "max_parallel": 1,
+    # and, when running in parallel, how many can read from one host or write to
+    # one target filesystem at once; 0 means no limit
+    "max_per_host": 0,
+    "max_per_device": 1,
+    # per-host exceptions to max_per_host, like {"pasilla": 4}
+    "host_limits": {},
+    # share one ssh connection (ControlMaster) per remote host for a whole run,
+    # rather than a fresh handshake for every source
+    "ssh_multiplex": False,
+    "ssh_command": "ssh",
+    # how many master connections to open per host; sources take turns on them
+    "ssh_pool_size": 1,
+    # per-host exceptions to ssh_pool_size, like {"pasilla": 2}
+    "ssh_pool_sizes": {},
+    # where rsyncr keeps things between runs (like the run history)
+    "state_dir": "/var/lib/rsyncr/",
+    # record every source's run in state_dir/history.sqlite; when running in
+    # parallel, this also lets the slowest sources start first
+    "history": False,
+    # for local sources, skip rsync when a quick fingerprint of the tree matches
+    # the one from the last successful run; can be set per job or per source
+    "skip_unchanged": False,
+    # command line only: ignore skip_unchanged and run everything
+    "force": False,
+    # try a source again (up to this many times) when rsync fails with one of
+    # retry_codes, the ones that usually mean a network hiccup; the wait starts
+    # at retry_backoff seconds and doubles each time. retries can be per source
+    "retries": 0,
+    "retry_backoff": 30,
+    "retry_codes": [10, 12, 30, 35],
+    # keep partly sent files in a hidden dir in the target (True means
+    # ".rsync-partial", or give a name), so a retry picks up where it left off
+    "partial": False,
+    # command line only: just run the sources the last run didn't finish
+    "resume": False,
+    # kill rsync (and fail the source, with return code 30) if its progress
+    # hasn't moved for stall_timeout seconds, or it's been going for timeout
+    # seconds; 0 is no limit. Either can be per source. stall_timeout needs
+    # rsync 3.1 or newer, for --info=progress2
+    "stall_timeout": 0,
+    "timeout": 0,
+    # keep a JSON file of what every running source is up to (bytes, percent,
+    # throughput), for monitoring
+    "status_file": None,
+    # where reports go: "telegram", or tables like {"kind": "smtp", ...}; see
+    # message.py. They're sent from a background thread; reports that turn up
+    # within notify_batch_seconds of each other go as one, failures are tried
+    # again after notify_retry seconds (and doubling), and at the end of a run
+    # rsyncr waits up to notify_timeout seconds for them to go. Anything unsent
+    # stays in state_dir/spool for next time.
+    "notifiers": ["telegram"],
+    "notify_batch_seconds": 2,
+    "notify_retry": 60,
+    "notify_timeout": 30,
+    # pick flags to suit each source's link (--whole-file for local copies,
+    # compression for slow links), from probes of each host that are redone
+    # every tune_ttl seconds; see tune.py. Can be set per job or per source
+    "auto_tune": False,
+    "tune_ttl": 86400,
+    # for 'rsyncr watch': changes are pushed in batches, once the first change
+    # in a batch is watch_batch_seconds old or watch_batch_size paths are
+    # waiting, and every source gets a full run every watch_reconcile seconds
+    # to catch anything inotify missed
+    "watch_batch_seconds": 5,
+    "watch_batch_size": 10000,
+    "watch_reconcile": 3600,
+    # go easy on the machine: rsync runs under 'nice -n <nice>' and 'ionice -c
+    # <ionice_class> -n <ionice_level>' (class is "idle", "best-effort" or
+    # "realtime"), and with --bwlimit=<bwlimit> (KiB/s, or rsync's "10m" style).
+    # All can be set per job or per source; 0/None leaves things as they are
+    "nice": 0,
+    "ionice_class": None,
+    "ionice_level": None,
+    "bwlimit": 0,
+    # for sources on an rsync daemon (a host or location like
+    # "rsync://nas[:port]/module"): a file holding the module's password, which
+    # rsync wants readable by nobody else. Can be set per job or per source
+    "password_file": None,
+    # watch the machine while a run goes, and back off when it's busy: when the
+    # load average (per CPU) goes over governor_max_load or a disk is busier
+    # than governor_max_disk_util (0-1), fewer sources run at once and sources
+    # that start get half the bwlimit; when it quietens down, back up to
+    # max_parallel and the full bwlimit. Over governor_pause_load, running
+    # rsyncs (but one) are paused until the load is back under
+    # governor_max_load; 0 never pauses. Checked every governor_interval
+    # seconds; see governor.py
+    "governor": False,
+    "governor_max_load": 1.0,
+    "governor_max_disk_util": 0.8,
+    "governor_pause_load": 0,
+    "governor_interval": 10,
+    # for 'rsyncr daemon': where it answers status requests (default is
+    # state_dir/rsyncr.sock), and how often it checks for changed config files
+    "daemon_socket": None,
+    "daemon_poll": 30,
+    # dry-run everything before a real run and check the targets have room;
+    # "refuse" won't run if they don't, "reorder" runs the smallest transfers
+    # first. Off by default, since it's a whole extra pass over every source
+    "preflight": False,
 }
 
 
+# settings that can be given per-source, in a [sources.x] table
+SOURCE_OPTIONS = [
+    # split the source into this many rsyncs running side by side
+    "shards",
+    # overrides the job/global skip_unchanged for this source
+    "skip_unchanged",
+    # overrides the job/global retries for this source
+    "retries",
+    # and the watchdog's limits
+    "stall_timeout",
+    "timeout",
+    # and auto_tune
+    "auto_tune",
+    # and how hard it's allowed to push the machine
+    "nice",
+    "ionice_class",
+    "ionice_level",
+    "bwlimit",
+    # for rsync:// sources
+    "password_file",
+    # do files over this size (bytes, or like "1G") in an rsync of their own,
+    # with --inplace; see sizes.py
+    "large_file_threshold",
+]
+
+
+# rsync://[user@]host[:port]/module[/path]
+DAEMON_RE = re.compile(r"^rsync://[^/:]+(:\d+)?/[^/]+")
+
+
 class BadConfig(TypeError):
     pass
 
 
+# what each kind of notifier (see message.py) can't do without
+NOTIFIER_FIELDS = {
+    "telegram": (),
+    "smtp": ("host", "to"),
+    "webhook": ("url",),
+    "file": (),
+}
+
+
+def notifier_spec(spec):
+    """a notifier's settings as a dict, checked for what its kind needs; just the
+    kind's name will do when it needs nothing else"""
+    if isinstance(spec, str):
+        spec = {"kind": spec}
+    kind = spec.get("kind")
+    if kind not in NOTIFIER_FIELDS:
+        raise BadConfig(f"unknown notifier kind '{kind}'")
+    missing = [f for f in NOTIFIER_FIELDS[kind] if f not in spec]
+    if missing:
+        raise BadConfig(f"the {kind} notifier needs {', '.join(missing)}")
+    return spec
+
+
 def parse_string(config_string):
+    if fast_toml_parse is not None:
+        return fast_toml_parse(config_string)
+    from tomlkit import parse as toml_parse
+
     cfg = toml_parse(config_string)
     return cfg
 
@@ -60,6 +256,7 @@ def read_config(filename):
     return cfgstr
 
 
+@trace.traced("config.make")
 def make(kind, filename=None, string=None):
     """do all the steps to make a valid config for either kind=="global" or
     kind is the name of the file/job to seek """
@@ -70,14 +267,73 @@ def make(kind, filename=None, string=None):
                 filename = os.path.join(DEFAULTS["configs_dir"], "global.toml")
             else:
                 filename = os.path.join(DEFAULTS["configs_dir"], f"config.{kind}.toml")
-        string = read_config(filename)
-    tomlobj = parse_string(string)
-    if kind == "global":
+        return _make_cached(kind == "global", filename)
+    return _make_from_string(kind == "global", string)
+
+
+def _make_from_string(is_global, string):
+    return _make_from_toml(is_global, parse_string(string))
+
+
+def _make_from_toml(is_global, tomlobj):
+    if is_global:
         return _make_global_config(tomlobj)
     else:
         return _make_job_config(tomlobj)
 
 
+def _cache_path(is_global, filename):
+    key = f"{'global' if is_global else 'job'}\0{os.path.abspath(filename)}"
+    name = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{name}.json")
+
+
+def _make_cached(is_global, filename):
+    """make a config from a file, going via the cache. If the file's mtime and
+    size haven't changed since it was cached, that's one small json read; if they
+    have but the contents haven't (say it was touched), the cache is still good;
+    otherwise it's parsed again. Only the parsed toml is cached: DEFAULTS and the
+    checks are applied every time, so a newer rsyncr never gets an older one's
+    idea of a config."""
+    if not CACHE_DIR:
+        return _make_from_string(is_global, read_config(filename))
+    st = os.stat(filename)
+    cache_path = _cache_path(is_global, filename)
+    cached = None
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if cached and cached["mtime_ns"] == st.st_mtime_ns and cached["size"] == st.st_size:
+        return _make_from_toml(is_global, cached["toml"])
+
+    string = read_config(filename)
+    digest = hashlib.sha256(string.encode()).hexdigest()
+    if cached and cached["hash"] == digest:
+        tomlobj = cached["toml"]
+    else:
+        tomlobj = parse_string(string)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "mtime_ns": st.st_mtime_ns,
+                    "size": st.st_size,
+                    "hash": digest,
+                    "toml": tomlobj,
+                },
+                f,
+            )
+        os.replace(tmp, cache_path)
+    except (OSError, TypeError, ValueError) as e:
+        # no cache is slower, not wrong
+        log.debug(f"couldn't cache {filename}: {e}")
+    return _make_from_toml(is_global, tomlobj)
+
+
 def _make_job_config(frojtoml):
     """fills in the optional config stuff for a job, and does a wee bit of data
     checking"""
@@ -91,10 +347,21 @@ def _make_job_config(frojtoml):
         assert (
             "location" in frojtoml["sources"][n]
         ), f"Need a 'location' in sources {n}!"
+        location = frojtoml["sources"][n]["location"]
+        assert location[0] == "/" or DAEMON_RE.match(
+            location
+        ), f"'{location}' needs to be a valid path (or rsync:// URL) in sources {n}!"
         assert (
-            frojtoml["sources"][n]["location"][0] == "/"
-        ), f"""'{frojtoml["sources"][n]['location']}' needs to be a valid path in sources {n}!"""
-        assert "target" in frojtoml["sources"][n], f"Need a 'target' in sources {n}!"
+            "target" in frojtoml["sources"][n] or frojtoml["sources"][n].get("targets")
+        ), f"Need a 'target' (or 'targets') in sources {n}!"
+        if len(frojtoml["sources"][n].get("targets", [])) > 1:
+            assert (
+                frojtoml["sources"][n].get("shards", 1) <= 1
+            ), f"Can't have both shards and several targets in sources {n}!"
+        if frojtoml["sources"][n].get("large_file_threshold"):
+            assert frojtoml["sources"][n].get("shards", 1) <= 1 and (
+                len(frojtoml["sources"][n].get("targets", [])) <= 1
+            ), f"large_file_threshold doesn't go with shards or targets in sources {n}!"
         if "excludes" in frojtoml["sources"][n]:
             assert (
                 len(frojtoml["sources"][n]["excludes"]) >= 1
@@ -116,6 +383,35 @@ def _make_job_config(frojtoml):
         "console_override",
         "capture_file",
         "logging_level",
+        "max_parallel",
+        "max_per_host",
+        "max_per_device",
+        "output_head_lines",
+        "output_tail_lines",
+        "ssh_multiplex",
+        "history",
+        "stats",
+        "itemize_changes",
+        "metrics_file",
+        "skip_unchanged",
+        # for 'rsyncr daemon': a cron expression, or a number of seconds
+        "schedule",
+        "interval",
+        "preflight",
+        "retries",
+        "retry_backoff",
+        "partial",
+        "stall_timeout",
+        "timeout",
+        "auto_tune",
+        "watch_batch_seconds",
+        "watch_batch_size",
+        "watch_reconcile",
+        "nice",
+        "ionice_class",
+        "ionice_level",
+        "bwlimit",
+        "password_file",
     ]:
         if i in frojtoml:
             current[i] = frojtoml.get(i)
@@ -123,9 +419,18 @@ def _make_job_config(frojtoml):
     if "host" not in frojtoml or frojtoml["host"] == "local":
         # no host implies local rsyncing, so use root
         current["host"] = "/"
+    elif frojtoml["host"].startswith("rsync://"):
+        # a module on an rsync daemon; locations are paths inside it
+        assert DAEMON_RE.match(
+            frojtoml["host"]
+        ), f"host '{frojtoml['host']}' should look like rsync://host[:port]/module"
+        current["host"] = frojtoml["host"].rstrip("/")
     else:
         current["host"] = frojtoml["host"]
 
+    if "retry_codes" in frojtoml:
+        current["retry_codes"] = list(frojtoml["retry_codes"])
+
     # make a safe copy *IF* there is something to copy
     if frojtoml.get("excludes"):
         current["excludes"] = []
@@ -139,7 +444,7 @@ def _make_job_config(frojtoml):
         # merge the paths for source, target here rather than downstream
         loc = fix_trailing_slashes(val["location"])
         current["sources"][n]["location"] = fix_trailing_slashes(
-            os.path.join(frojtoml["host"], loc)
+            os.path.join(current["host"], loc)
         )
 
         # we CAN override the normal behavior or root + target, and have an explicit
@@ -148,13 +453,25 @@ def _make_job_config(frojtoml):
             current["sources"][n]["target"] = fix_trailing_slashes(
                 val["target_full_path"]
             )
+        elif "targets" in val:
+            # the first one's the real target; the rest get a replay of it
+            targets = [
+                fix_trailing_slashes(os.path.join(frojtoml["target_root"], t))
+                for t in val["targets"]
+            ]
+            current["sources"][n]["target"] = targets[0]
+            if len(targets) > 1:
+                current["sources"][n]["replicas"] = targets[1:]
         else:
             current["sources"][n]["target"] = fix_trailing_slashes(
                 os.path.join(frojtoml["target_root"], val["target"])
             )
         # if the host isn't local, os.path.join strips off the machine part,
         # which looks like this: 'machine:' so fix that...
-        if current["host"] != "/":
+        if DAEMON_RE.match(val["location"]):
+            # a source can name a daemon module itself, whatever the host
+            current["sources"][n]["location"] = loc
+        elif current["host"] != "/":
             current["sources"][n]["location"] = current["host"] + val["location"]
 
         # and source-level excludes
@@ -162,6 +479,11 @@ def _make_job_config(frojtoml):
         for i in val.get("excludes", []):
             current["sources"][n]["excludes"].append(i)
 
+        # other optional per-source settings
+        for i in SOURCE_OPTIONS:
+            if i in val:
+                current["sources"][n][i] = val[i]
+
     return current
 
 
@@ -169,7 +491,7 @@ def _make_global_config(frojtoml):
     """check the vars declared in a conf object for this global install;
     already parsed from toml """
     # start with sane defaults:
-    current = deepcopy(DEFAULTS)
+    current = _defaults()
 
     # @@ none of the below really has sanity checks for datatype and so on
 
@@ -181,13 +503,61 @@ def _make_global_config(frojtoml):
         "console_override",
         "capture_file",
         "logging_level",
+        "max_parallel",
+        "max_per_host",
+        "max_per_device",
+        "output_head_lines",
+        "output_tail_lines",
+        "ssh_multiplex",
+        "ssh_command",
+        "ssh_pool_size",
+        "state_dir",
+        "history",
+        "itemize_changes",
+        "metrics_file",
+        "exclude_file_threshold",
+        "skip_unchanged",
+        "daemon_socket",
+        "daemon_poll",
+        "preflight",
+        "retries",
+        "retry_backoff",
+        "partial",
+        "stall_timeout",
+        "timeout",
+        "status_file",
+        "notify_batch_seconds",
+        "notify_retry",
+        "notify_timeout",
+        "auto_tune",
+        "tune_ttl",
+        "watch_batch_seconds",
+        "watch_batch_size",
+        "watch_reconcile",
+        "nice",
+        "ionice_class",
+        "ionice_level",
+        "bwlimit",
+        "password_file",
+        "governor",
+        "governor_max_load",
+        "governor_max_disk_util",
+        "governor_pause_load",
+        "governor_interval",
+        "stats",
     ]:
-        if frojtoml.get(i):
+        # 'in' rather than truthiness: 0 and false are real settings here
+        # (max_per_device = 0 is no limit, retry_backoff = 0 is straight away...)
+        if i in frojtoml:
             current[i] = frojtoml[i]
 
     # some that need a little more finesse:
     # these two are sequences, so we want to copy their elements rather than wholesale,
     # because they are stuffed with tomlkit artifacts
+    # an empty list here means never retry
+    if "retry_codes" in frojtoml:
+        current["retry_codes"] = list(frojtoml["retry_codes"])
+
     if "global_rsync_params" in frojtoml:
         current["global_rsync_params"] = []
         for i in frojtoml.get("global_rsync_params", []):
@@ -197,6 +567,25 @@ def _make_global_config(frojtoml):
         for i in frojtoml.get("global_excludes", []):
             current["global_excludes"].append(i)
 
+    if "host_limits" in frojtoml:
+        current["host_limits"] = {}
+        for host, limit in frojtoml["host_limits"].items():
+            # a host like "pasilla:" in a job config is just "pasilla" here
+            current["host_limits"][host.rstrip(":")] = limit
+
+    if "ssh_pool_sizes" in frojtoml:
+        current["ssh_pool_sizes"] = {}
+        for host, size in frojtoml["ssh_pool_sizes"].items():
+            current["ssh_pool_sizes"][host.rstrip(":")] = size
+
+    if "notifiers" in frojtoml:
+        current["notifiers"] = []
+        for n in frojtoml["notifiers"]:
+            n = n if isinstance(n, str) else dict(n)
+            # a typo here should fail now, not when the report goes out
+            notifier_spec(n)
+            current["notifiers"].append(n)
+
     if "override_rsync_params" in frojtoml:
         current["global_rsync_params"] = frojtoml["override_rsync_params"]
     elif "added_rsync_params" in frojtoml:
@@ -205,11 +594,20 @@ def _make_global_config(frojtoml):
     return current
 
 
+def _defaults():
+    """a copy of DEFAULTS that's safe to change; it's flat apart from a few lists
+    and dicts, so there's no need for a deepcopy"""
+    return {
+        k: (v.copy() if isinstance(v, (list, dict)) else v) for k, v in DEFAULTS.items()
+    }
+
+
+@trace.traced("config.merge_configs")
 def merge_configs(globalconf={}, jobconf={}, cmdline_args={}):
     """merge all the possible configs/switches into one conf object
     that is used to build command lines and such """
     # simple now, but edge conditions like adding rather than overwriting can come here
-    current = deepcopy(DEFAULTS)
+    current = _defaults()
     current.update(globalconf)
     current.update(jobconf)
     current.update(cmdline_args)
@@ -219,6 +617,8 @@ def merge_configs(globalconf={}, jobconf={}, cmdline_args={}):
 def command_line_config(args):
     """turn passed args into a config dictionary that we can use to build context"""
     cfg = {}
+    if args is None:
+        return cfg
     # I want a cfg composed of ONLY what is on command line, so don't want to stuff
     # any blank values/defaults, so have to do it manually; blah.
     if args.dry_run:
@@ -229,9 +629,22 @@ def command_line_config(args):
         cfg["console_override"] = args.console
     if args.capture_output:
         cfg["capture_file"] = args.capture_output
+    if args.jobs:
+        cfg["max_parallel"] = args.jobs
+    if args.force:
+        cfg["force"] = args.force
+    if args.resume:
+        cfg["resume"] = args.resume
     return cfg
 
 
+def config_hash(conf):
+    """a short fingerprint of a conf, so runs can be tied to the settings that
+    made them"""
+    blob = json.dumps(conf, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()[:12]
+
+
 def fix_trailing_slashes(loc):
     """make sure that the location strings are sane for rsync; this
     basically means that they contain one trailing slash """
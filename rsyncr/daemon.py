@@ -0,0 +1,347 @@
+"""'rsyncr daemon': stay running and run jobs on their own schedules.
+
+Instead of cron starting a fresh rsyncr for every job, the daemon reads all the
+configs in configs_dir once, keeps them parsed and merged, and runs each job
+when its 'schedule' (a cron expression, like "30 2 * * *") or 'interval' (in
+seconds) says to. Jobs without either are left alone.
+
+Config files are re-read when they change (checked every daemon_poll seconds,
+or straight away on SIGHUP), and only the ones that changed. If a job comes due
+while it's still running from last time, it isn't started twice; it runs once
+more after the current run finishes, however many times it came due meanwhile.
+
+'rsyncr daemon --status' asks a running daemon (over the unix socket at
+daemon_socket) how its jobs are doing.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+from rsyncr import config
+from rsyncr import run
+
+log = logging.getLogger()
+
+CRON_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+def _cron_field(text, low, high):
+    """the set of values a cron field allows"""
+    allowed = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-"))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise config.BadConfig(f"cron field '{text}' is out of range")
+        allowed.update(range(start, end + 1, step))
+    return allowed
+
+
+class CronSchedule:
+    """minute hour day-of-month month day-of-week, like cron has"""
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise config.BadConfig(f"'{expr}' isn't a 5 field cron expression")
+        self.expr = expr
+        sets = [_cron_field(f, *r) for f, r in zip(fields, CRON_RANGES)]
+        self.minutes, self.hours, self.days, self.months, dows = sets
+        # 0 and 7 are both Sunday
+        self.dows = {d % 7 for d in dows}
+        # cron's odd rule: if both day fields are restricted, either can match
+        self.either_day = fields[2] != "*" and fields[4] != "*"
+
+    def matches(self, when):
+        if when.minute not in self.minutes or when.hour not in self.hours:
+            return False
+        if when.month not in self.months:
+            return False
+        day_ok = when.day in self.days
+        # python counts weekdays from Monday=0, cron from Sunday=0
+        dow_ok = (when.weekday() + 1) % 7 in self.dows
+        if self.either_day:
+            return day_ok or dow_ok
+        return day_ok and dow_ok
+
+    def next_after(self, when):
+        """the first matching minute after 'when' (a datetime)"""
+        t = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # a bit over four years covers Feb 29th
+        for _ in range(4 * 366 * 24 * 60):
+            if self.matches(t):
+                return t
+            t += timedelta(minutes=1)
+        raise config.BadConfig(f"'{self.expr}' never matches")
+
+
+def next_run(conf, after):
+    """when a job should next run after time 'after' (epoch seconds), or None
+    for a job with no schedule"""
+    if conf.get("schedule"):
+        start = datetime.fromtimestamp(after)
+        return CronSchedule(conf["schedule"]).next_after(start).timestamp()
+    if conf.get("interval"):
+        return after + conf["interval"]
+    return None
+
+
+class JobState:
+    """one job as the daemon knows it"""
+
+    def __init__(self, name, path, mtime, conf):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.conf = conf
+        self.next_run = next_run(conf, time.time())
+        self.running = False
+        self.pending = False
+        self.last_started = None
+        self.last_finished = None
+        self.last_errors = None
+
+    def status(self):
+        return {
+            "job": self.name,
+            "schedule": self.conf.get("schedule") or self.conf.get("interval"),
+            "running": self.running,
+            "pending": self.pending,
+            "next_run": self.next_run,
+            "last_started": self.last_started,
+            "last_finished": self.last_finished,
+            "last_errors": self.last_errors,
+        }
+
+
+class Daemon:
+    def __init__(self, config_dir=None, global_config_path=None, args=None):
+        self.config_dir = config_dir or config.DEFAULTS["configs_dir"]
+        self.global_config_path = global_config_path or os.path.join(
+            self.config_dir, "global.toml"
+        )
+        self.args = args
+        self.jobs = {}
+        self.gconf = None
+        self.global_mtime = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._reload = False
+        self._stopping = False
+        self._server = None
+
+    @property
+    def conf(self):
+        """the global settings, as the daemon itself uses them"""
+        return config.merge_configs(
+            self.gconf, {}, config.command_line_config(self.args)
+        )
+
+    def reload(self):
+        """re-read whatever config files changed since last time; a changed
+        global config means every job gets re-merged"""
+        mtime = os.stat(self.global_config_path).st_mtime_ns
+        everything = mtime != self.global_mtime
+        if everything:
+            log.info("loading global config")
+            self.gconf = config.make("global", self.global_config_path)
+            self.global_mtime = mtime
+        seen = set()
+        for name in run.find_jobs(self.config_dir):
+            path = os.path.join(self.config_dir, f"config.{name}.toml")
+            seen.add(name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                old = self.jobs.get(name)
+            if old is not None and old.mtime == mtime and not everything:
+                continue
+            try:
+                jconf = config.make(name, path)
+                conf = config.merge_configs(
+                    self.gconf, jconf, config.command_line_config(self.args)
+                )
+                conf["job_name"] = name
+                # just to find out now if the schedule's no good
+                next_run(conf, time.time())
+            except Exception as e:
+                # a broken file shouldn't take down every other job
+                log.error(f"couldn't load {path}, keeping what we had: {e}")
+                continue
+            with self._lock:
+                if old is None:
+                    state = self.jobs[name] = JobState(name, path, mtime, conf)
+                else:
+                    # same job, new settings; a run in progress picks them up
+                    # the next time it goes round
+                    state = old
+                    state.mtime = mtime
+                    state.conf = conf
+                    state.next_run = next_run(conf, time.time())
+            log.info(f"loaded job {name}, next run at {state.next_run}")
+        with self._lock:
+            for name in set(self.jobs) - seen:
+                log.info(f"job {name} is gone")
+                del self.jobs[name]
+
+    def _run(self, state):
+        """run a job, then run it again if it came due while running"""
+        while True:
+            state.last_started = time.time()
+            try:
+                results = run.run_job(state.conf)
+                state.last_errors = any(r["error"] for r in results)
+            except Exception:
+                log.exception(f"job {state.name} fell over")
+                state.last_errors = True
+            state.last_finished = time.time()
+            with self._lock:
+                if not state.pending or self._stopping:
+                    state.running = False
+                    return
+                state.pending = False
+
+    def tick(self, now=None):
+        """start whatever is due; a job that's still running gets marked pending
+        instead of being started twice"""
+        now = time.time() if now is None else now
+        with self._lock:
+            due = [s for s in self.jobs.values() if s.next_run and s.next_run <= now]
+            for state in due:
+                state.next_run = next_run(state.conf, now)
+                if state.running:
+                    log.info(f"{state.name} is still running, will go again after")
+                    state.pending = True
+                    continue
+                state.running = True
+                threading.Thread(target=self._run, args=(state,), daemon=True).start()
+
+    def status(self):
+        with self._lock:
+            return [s.status() for s in self.jobs.values()]
+
+    def _serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        os.chmod(path, 0o660)
+        self._server.listen(5)
+        while not self._stopping:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            with conn:
+                conn.sendall(json.dumps(self.status()).encode() + b"\n")
+
+    def _hup(self, signum, frame):
+        self._reload = True
+        self._wake.set()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        self._wake.set()
+
+    def serve_forever(self):
+        self.reload()
+        conf = self.conf
+        signal.signal(signal.SIGHUP, self._hup)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        path = conf["daemon_socket"] or os.path.join(conf["state_dir"], "rsyncr.sock")
+        threading.Thread(target=self._serve, args=(path,), daemon=True).start()
+        last_poll = time.time()
+        try:
+            while not self._stopping:
+                now = time.time()
+                if self._reload or now - last_poll >= conf["daemon_poll"]:
+                    self._reload = False
+                    last_poll = now
+                    try:
+                        self.reload()
+                    except Exception:
+                        log.exception("reloading configs failed")
+                    conf = self.conf
+                self.tick(now)
+                self._wake.wait(1)
+                self._wake.clear()
+        finally:
+            if self._server is not None:
+                self._server.close()
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def ask_status(path):
+    """what a running daemon says about its jobs"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        data = b""
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+def cli(argv):
+    """'rsyncr daemon': run scheduled jobs until told to stop"""
+    parser = argparse.ArgumentParser(prog="rsyncr daemon")
+    parser.add_argument("--configs-dir", help="(optional) where to look for toml files")
+    parser.add_argument(
+        "--global-config-path", help="(optional) override global config settings"
+    )
+    parser.add_argument(
+        "--status",
+        help="ask a running daemon how its jobs are doing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--console",
+        help="Don't use telegram, just print to console",
+        action="store_true",
+    )
+    # these are what config.command_line_config looks for
+    parser.set_defaults(
+        dry_run=False,
+        verbose=False,
+        capture_output=None,
+        jobs=None,
+        force=False,
+        resume=False,
+    )
+    args = parser.parse_args(argv)
+
+    d = Daemon(args.configs_dir, args.global_config_path, args)
+    if args.status:
+        d.gconf = config.make("global", d.global_config_path)
+        conf = d.conf
+        path = conf["daemon_socket"] or os.path.join(conf["state_dir"], "rsyncr.sock")
+        try:
+            print(json.dumps(ask_status(path), indent=2))
+        except OSError as e:
+            sys.exit(f"couldn't talk to the daemon at {path}: {e}")
+        return
+    d.serve_forever()
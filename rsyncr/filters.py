@@ -0,0 +1,98 @@
+"""Turn the three layers of excludes (global, job, source) into what rsync gets.
+
+A handful of excludes go on the command line as --exclude=... like always. Past
+exclude_file_threshold of them, they're written to a rules file named after its
+own contents (so every source and every run with the same excludes shares one
+file) and handed to rsync with --filter=merge, which keeps the argv short.
+"""
+
+import os
+import fnmatch
+import hashlib
+import logging
+
+log = logging.getLogger()
+
+
+def compile_excludes(conf, src):
+    """global, job, then source excludes, with repeats dropped but order kept"""
+    merged = {}
+    for layer in (
+        conf.get("global_excludes", []),
+        conf.get("excludes", []),
+        conf["sources"][src].get("excludes", []),
+    ):
+        for e in layer:
+            merged.setdefault(str(e), None)
+    return list(merged)
+
+
+def rules_text(patterns):
+    # '- pattern' rather than bare patterns, so a pattern that happens to start
+    # with '#' or ';' isn't taken for a comment
+    return "".join(f"- {p}\n" for p in patterns)
+
+
+def filter_file(patterns, directory):
+    """write (if it's not already there) a merge file for patterns, named by a
+    hash of its contents; returns its path"""
+    text = rules_text(patterns)
+    digest = hashlib.sha256(text.encode()).hexdigest()[:20]
+    path = os.path.join(directory, f"excludes-{digest}.rules")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    return path
+
+
+def exclude_args(conf, src):
+    """the rsync arguments for a source's excludes"""
+    patterns = compile_excludes(conf, src)
+    if len(patterns) > conf["exclude_file_threshold"]:
+        try:
+            path = filter_file(patterns, os.path.join(conf["state_dir"], "filters"))
+            return [f"--filter=merge {path}"]
+        except OSError as e:
+            log.warning(f"couldn't write excludes file, using --exclude instead: {e}")
+    return [f"--exclude={e}" for e in patterns]
+
+
+def matcher(patterns):
+    """a function(relpath, is_dir) that says whether rsync's excludes would leave
+    a path out. This is a decent approximation of rsync's rules, for places
+    (like verify and watch) where rsyncr has to decide for itself:
+
+    - a pattern starting with '/' is anchored at the top of the source
+    - a pattern ending with '/' only matches directories
+    - a pattern with a '/' in it is matched against the whole relative path,
+      otherwise against just the last part of it
+    """
+    compiled = []
+    for p in patterns:
+        dir_only = p.endswith("/")
+        p = p.rstrip("/")
+        anchored = p.startswith("/")
+        p = p.lstrip("/")
+        compiled.append((p, dir_only, anchored or "/" in p, anchored))
+
+    def excluded(relpath, is_dir=False):
+        name = relpath.rsplit("/", 1)[-1]
+        for p, dir_only, whole, anchored in compiled:
+            if dir_only and not is_dir:
+                continue
+            if not whole:
+                if fnmatch.fnmatchcase(name, p):
+                    return True
+            elif anchored:
+                if fnmatch.fnmatchcase(relpath, p):
+                    return True
+            elif fnmatch.fnmatchcase(relpath, p) or fnmatch.fnmatchcase(
+                relpath, "*/" + p
+            ):
+                return True
+        return False
+
+    return excluded
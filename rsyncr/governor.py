@@ -0,0 +1,263 @@
+"""Share the machine: run rsync at a lower priority, and back off when it's busy.
+
+Backups often have to run alongside whatever the machine is really for. Each
+source's rsync can run under nice and ionice, and with a --bwlimit; all three
+can be set per job or per source.
+
+With 'governor' on, a thread watches the machine during a run: the load average
+(from /proc/loadavg, per CPU) and how busy the disks are (from the time spent
+doing I/O in /proc/diskstats). When either is over its limit it halves the
+bandwidth of sources as they start and lets one fewer source run at a time;
+once things are quiet it goes back up, a step at a time, to max_parallel and
+the full bwlimit. A running rsync's --bwlimit can't be changed, so the only
+thing to do with those is pause them: over governor_pause_load, all but the
+oldest get a SIGSTOP until the load is back under governor_max_load. The
+watchdog doesn't count time spent paused.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+
+from rsyncr import config
+
+log = logging.getLogger()
+
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+# never go below this fraction of a source's bwlimit
+MIN_FACTOR = 1 / 16
+
+# how far under the limits counts as quiet enough to speed back up
+CALM = 0.7
+
+# devices that aren't real disks
+NOT_DISKS = re.compile(r"^(loop|ram|zram|sr|fd)\d")
+
+
+def _setting(conf, d, key):
+    d = d or {}
+    return d.get(key, conf[key])
+
+
+def priority_prefix(conf, d=None):
+    """the nice/ionice to put in front of a source's rsync"""
+    prefix = []
+    nice = _setting(conf, d, "nice")
+    if nice:
+        prefix += ["nice", "-n", str(int(nice))]
+    cls = _setting(conf, d, "ionice_class")
+    level = _setting(conf, d, "ionice_level")
+    if cls is not None or level is not None:
+        if cls is None:
+            cls = "best-effort"
+        if isinstance(cls, str):
+            if cls not in IONICE_CLASSES:
+                raise config.BadConfig(
+                    f"ionice_class should be one of {', '.join(IONICE_CLASSES)}"
+                )
+            cls = IONICE_CLASSES[cls]
+        prefix += ["ionice", "-c", str(cls)]
+        # the idle class has no levels
+        if level is not None and cls != IONICE_CLASSES["idle"]:
+            prefix += ["-n", str(int(level))]
+    return prefix
+
+
+def parse_bwlimit(value):
+    """a bwlimit setting in KiB/s; a number is already KiB/s, and strings can
+    have a k, m or g on the end, like rsync's own --bwlimit"""
+    if not value:
+        return 0
+    if isinstance(value, (int, float)):
+        return float(value)
+    m = re.match(r"^\s*([\d.]+)\s*([kmg]?)i?b?\s*$", value.lower())
+    if not m:
+        raise config.BadConfig(f"can't make sense of bwlimit {value!r}")
+    return float(m.group(1)) * {"": 1, "k": 1, "m": 1024, "g": 1024 ** 2}[m.group(2)]
+
+
+def bwlimit(conf, d=None, factor=1.0):
+    """the --bwlimit (KiB/s) for a source, scaled by the governor's factor"""
+    limit = parse_bwlimit(_setting(conf, d, "bwlimit"))
+    if not limit:
+        return 0
+    return max(1, int(limit * factor))
+
+
+def read_loadavg(path="/proc/loadavg"):
+    """the 1 minute load average"""
+    with open(path) as f:
+        return float(f.read().split()[0])
+
+
+def read_diskstats(path="/proc/diskstats"):
+    """{device: milliseconds spent doing I/O}"""
+    found = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 13 or NOT_DISKS.match(fields[2]):
+                continue
+            found[fields[2]] = int(fields[12])
+    return found
+
+
+def disk_util(before, after, seconds):
+    """how busy (0-1) the busiest disk was between two read_diskstats"""
+    if seconds <= 0:
+        return 0.0
+    busiest = 0.0
+    for dev, ms in after.items():
+        if dev in before:
+            busiest = max(busiest, (ms - before[dev]) / (seconds * 1000))
+    return min(busiest, 1.0)
+
+
+def family(pid):
+    """a process and its children (local rsync forks a receiver), if /proc
+    says; otherwise just the process"""
+    pids = [pid]
+    for p in pids:
+        try:
+            tasks = os.listdir(f"/proc/{p}/task")
+        except OSError:
+            continue
+        for t in tasks:
+            try:
+                with open(f"/proc/{p}/task/{t}/children") as f:
+                    pids.extend(int(c) for c in f.read().split())
+            except (OSError, ValueError):
+                pass
+    return pids
+
+
+def signal_family(pid, signum):
+    for p in family(pid):
+        try:
+            os.kill(p, signum)
+        except ProcessLookupError:
+            pass
+
+
+class Governor:
+    """Adjusts a schedule.Scheduler (and the bandwidth of sources yet to start)
+    to the load on the machine, from its own thread. Watchdogs of running
+    rsyncs register with it, so they can be paused."""
+
+    def __init__(
+        self,
+        pool,
+        max_load=1.0,
+        max_util=0.8,
+        pause_load=0,
+        interval=10,
+        cpus=None,
+        loadavg=read_loadavg,
+        diskstats=read_diskstats,
+    ):
+        self.pool = pool
+        self.ceiling = pool.max_parallel
+        self.max_load = max_load
+        self.max_util = max_util
+        self.pause_load = pause_load
+        self.interval = interval
+        self.cpus = cpus or os.cpu_count() or 1
+        self.factor = 1.0
+        self._loadavg = loadavg
+        self._diskstats = diskstats
+        self._lock = threading.Lock()
+        self._dogs = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = None
+
+    @classmethod
+    def from_conf(cls, conf, pool):
+        return cls(
+            pool,
+            conf["governor_max_load"],
+            conf["governor_max_disk_util"],
+            conf["governor_pause_load"],
+            conf["governor_interval"],
+        )
+
+    def add(self, dog):
+        with self._lock:
+            self._dogs.append(dog)
+
+    def discard(self, dog):
+        with self._lock:
+            if dog in self._dogs:
+                self._dogs.remove(dog)
+
+    def sample(self, now):
+        """(load per CPU, busiest disk) right now; None for either that can't
+        be read"""
+        try:
+            load = self._loadavg() / self.cpus
+        except (OSError, ValueError, IndexError):
+            load = None
+        try:
+            stats = self._diskstats()
+        except (OSError, ValueError):
+            return load, None
+        util = None
+        if self._last is not None:
+            util = disk_util(self._last[1], stats, now - self._last[0])
+        self._last = (now, stats)
+        return load, util
+
+    def adjust(self, load, util):
+        """decide what to do about a sample"""
+        load = load or 0.0
+        util = util or 0.0
+        busy = load > self.max_load or util > self.max_util
+        calm = load < self.max_load * CALM and util < self.max_util * CALM
+        limit = self.pool.max_parallel
+        if busy:
+            limit = max(1, limit - 1)
+            self.factor = max(MIN_FACTOR, self.factor / 2)
+        elif calm:
+            limit = min(self.ceiling, limit + 1)
+            self.factor = min(1.0, self.factor * 2)
+        if limit != self.pool.max_parallel:
+            log.info(
+                f"load {load:.2f}, disk {util:.0%}: running up to {limit} at once,"
+                f" at {self.factor:.0%} of bwlimit"
+            )
+            self.pool.set_max_parallel(limit)
+
+        with self._lock:
+            dogs = list(self._dogs)
+        if self.pause_load and load > self.pause_load:
+            # the oldest keeps going, so the run still gets somewhere
+            for dog in dogs[1:]:
+                dog.pause()
+        elif load <= self.max_load:
+            for dog in dogs:
+                dog.resume()
+
+    def _run(self):
+        self.sample(time.monotonic())
+        while not self._stop.wait(self.interval):
+            self.adjust(*self.sample(time.monotonic()))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stop watching; anything paused carries on, and the pool gets its old
+        limit back"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            dogs = list(self._dogs)
+        for dog in dogs:
+            dog.resume()
+        self.pool.set_max_parallel(self.ceiling)
@@ -0,0 +1,202 @@
+"""Keep a record of every source rsyncr runs: when, how long, how much, and
+whether it worked. Lives in a sqlite file in state_dir.
+
+This is also what lets the parallel scheduler start the historically slowest
+sources first, so one long straggler doesn't start last and hold up the end of
+the whole job.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+
+from rsyncr import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    job TEXT,
+    source TEXT,
+    location TEXT,
+    target TEXT,
+    started REAL,
+    finished REAL,
+    returncode INTEGER,
+    bytes_sent INTEGER,
+    bytes_received INTEGER,
+    config_hash TEXT,
+    duration REAL,
+    files INTEGER,
+    files_transferred INTEGER,
+    total_file_size INTEGER,
+    transferred_file_size INTEGER,
+    literal_data INTEGER,
+    matched_data INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_job_source ON runs (job, source, finished);
+"""
+
+# the ones that come straight from the result's stats.TransferStats
+STATS_COLUMNS = [
+    "files",
+    "files_transferred",
+    "total_file_size",
+    "transferred_file_size",
+    "literal_data",
+    "matched_data",
+]
+
+
+def history_path(conf):
+    return os.path.join(conf["state_dir"], "history.sqlite")
+
+
+class History:
+    """A thin layer over the sqlite runs table; safe to share between threads"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record(self, job, result, config_hash=None):
+        """write down how one source's run went"""
+        started = result.get("started")
+        finished = result.get("finished")
+        duration = None
+        if started is not None and finished is not None:
+            duration = finished - started
+        stats = result.get("stats")
+        columns = [
+            "job",
+            "source",
+            "location",
+            "target",
+            "started",
+            "finished",
+            "returncode",
+            "bytes_sent",
+            "bytes_received",
+            "config_hash",
+            "duration",
+        ] + STATS_COLUMNS
+        values = [
+            job,
+            result["name"],
+            result["location"],
+            result["target"],
+            started,
+            finished,
+            result["returncode"],
+            result.get("bytes_sent"),
+            result.get("bytes_received"),
+            config_hash,
+            duration,
+        ] + [getattr(stats, c, None) for c in STATS_COLUMNS]
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT INTO runs ({', '.join(columns)})"
+                f" VALUES ({', '.join('?' for _ in columns)})",
+                values,
+            )
+
+    def durations(self, job, recent=5):
+        """{source: average seconds} over the last few successful runs of each of
+        a job's sources"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT source, finished - started FROM runs"
+                " WHERE job = ? AND returncode = 0 AND started IS NOT NULL"
+                " ORDER BY finished DESC",
+                (job,),
+            ).fetchall()
+        seen = {}
+        for source, took in rows:
+            seen.setdefault(source, [])
+            if len(seen[source]) < recent:
+                seen[source].append(took)
+        return {source: sum(t) / len(t) for source, t in seen.items()}
+
+    def query(self, job=None, source=None, limit=20):
+        """the most recent runs, newest first, as dicts"""
+        sql = "SELECT * FROM runs"
+        where = []
+        params = []
+        if job:
+            where.append("job = ?")
+            params.append(job)
+        if source:
+            where.append("source = ?")
+            params.append(source)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY finished DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            cur = self._db.execute(sql, params)
+            names = [c[0] for c in cur.description]
+            return [dict(zip(names, row)) for row in cur.fetchall()]
+
+
+def _or_dash(value):
+    return "-" if value is None else value
+
+
+def format_runs(runs):
+    """a plain text table of runs, for a terminal"""
+    lines = [
+        f"{'finished':19}  {'job':12} {'source':16} {'secs':>8} {'rc':>4}"
+        f" {'sent':>14} {'received':>14} {'files':>8} {'changed':>8}"
+        f" {'size':>14} {'literal':>14} {'matched':>14}"
+    ]
+    for r in runs:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(r["finished"] or 0))
+        took = r.get("duration")
+        if took is None:
+            took = (r["finished"] or 0) - (r["started"] or 0)
+        lines.append(
+            f"{when:19}  {r['job'] or '':12} {r['source']:16} {took:8.1f}"
+            f" {_or_dash(r['returncode']):>4}"
+            f" {_or_dash(r['bytes_sent']):>14}"
+            f" {_or_dash(r['bytes_received']):>14}"
+            f" {_or_dash(r.get('files')):>8}"
+            f" {_or_dash(r.get('files_transferred')):>8}"
+            f" {_or_dash(r.get('total_file_size')):>14}"
+            f" {_or_dash(r.get('literal_data')):>14}"
+            f" {_or_dash(r.get('matched_data')):>14}"
+        )
+    return "\n".join(lines)
+
+
+def cli(argv):
+    """'rsyncr history [job]': show recent runs"""
+    parser = argparse.ArgumentParser(prog="rsyncr history")
+    parser.add_argument("config", nargs="?", help="(optional) only show this job")
+    parser.add_argument("--source", help="(optional) only show this source")
+    parser.add_argument("--limit", type=int, default=20, help="how many runs to show")
+    parser.add_argument("--configs-dir", help="(optional) where to look for toml files")
+    parser.add_argument(
+        "--global-config-path", help="(optional) override global config settings"
+    )
+    args = parser.parse_args(argv)
+
+    config_dir = args.configs_dir or config.DEFAULTS["configs_dir"]
+    gpath = args.global_config_path or os.path.join(config_dir, "global.toml")
+    conf = config.merge_configs(config.make("global", gpath))
+    path = history_path(conf)
+    if not os.path.exists(path):
+        sys.exit(f"no history yet at {path}")
+    db = History(path)
+    try:
+        print(format_runs(db.query(args.config, args.source, args.limit)))
+    finally:
+        db.close()
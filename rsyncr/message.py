@@ -1,18 +1,369 @@
 """Code that sends data to user after operating...
-Right now uses telegram via telegram - send, a python package """
 
-# Currently assumes telegram-send has been setup; which can be done
-# on a command line from the virtualenv: telegram-send --config
+Reports go to one or more 'notifiers' (telegram via telegram-send, email, a
+webhook, or a file/stdout), and they go from a background thread, so a slow or
+unreachable endpoint can't hold up or crash a run that's already done its
+backups. Reports that arrive close together (like the jobs of a fleet, or the
+daemon's jobs finishing around the same time) are sent as one, cut into pieces
+no bigger than each notifier takes.
+
+Every report is written to a spool directory (state_dir/spool) before it's
+sent, and only removed once it's gone; whatever couldn't be sent is tried again
+later, or by the next rsyncr to run. The rsyncr that has a spooled report holds
+a lock on its file (see claim), so with several running at once (the daemon's
+jobs, overlapping cron runs) each report still goes out just the once.
+"""
+
+# telegram-send needs setting up first; which can be done on a command line from
+# the virtualenv: telegram-send --config
 #
 # This puts droppings into XDG stuff or ~/Library/Application Support/ on Mac
 
-# this is a ridiculously thin wrapper, doesn't now need its' own module, but
-# there could be some formatting and other sort of code, or other ways to send... tbd
+import os
+import json
+import time
+import uuid
+import fcntl
+import queue
+import atexit
+import hashlib
+import logging
+import threading
+
+from rsyncr import config
+from rsyncr import trace
+
+log = logging.getLogger()
+
+
+class Telegram:
+    """telegram, via telegram-send (only imported when there's something to send)"""
+
+    limit = 4096
+
+    def __init__(self, spec):
+        # a telegram-send config file, if not the default one
+        self.conf = spec.get("config")
+
+    def send(self, text):
+        import telegram_send
+
+        kwargs = {"conf": self.conf} if self.conf else {}
+        telegram_send.send(messages=[text], **kwargs)
+
+
+class SMTP:
+    """plain old email"""
+
+    limit = 1 << 20
+
+    def __init__(self, spec):
+        assert "host" in spec and "to" in spec, "smtp notifier needs a host and a to"
+        self.host = spec["host"]
+        self.port = spec.get("port", 0)
+        self.starttls = spec.get("starttls", False)
+        self.username = spec.get("username")
+        self.password = spec.get("password")
+        self.sender = spec.get("from", "rsyncr")
+        to = spec["to"]
+        self.to = [to] if isinstance(to, str) else list(to)
+        self.subject = spec.get("subject", "rsyncr report")
+
+    def send(self, text):
+        import smtplib
+        from email.message import EmailMessage
+
+        msg = EmailMessage()
+        msg["Subject"] = self.subject
+        msg["From"] = self.sender
+        msg["To"] = ", ".join(self.to)
+        msg.set_content(text)
+        with smtplib.SMTP(self.host, self.port, timeout=30) as s:
+            if self.starttls:
+                s.starttls()
+            if self.username:
+                s.login(self.username, self.password)
+            s.send_message(msg)
+
+
+class Webhook:
+    """a JSON POST, like {"text": "..."}, which is what Slack and friends take"""
+
+    limit = 32768
+
+    def __init__(self, spec):
+        assert "url" in spec, "webhook notifier needs a url"
+        self.url = spec["url"]
+        self.field = spec.get("field", "text")
+        self.limit = spec.get("limit", self.limit)
+
+    def send(self, text):
+        import urllib.request
+
+        req = urllib.request.Request(
+            self.url,
+            data=json.dumps({self.field: text}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        urllib.request.urlopen(req, timeout=30).close()
+
+
+class File:
+    """append to a file, or print if the path is "-" (or missing)"""
+
+    limit = None
+
+    def __init__(self, spec):
+        self.path = spec.get("path", "-")
+
+    def send(self, text):
+        if self.path == "-":
+            print(text)
+            return
+        with open(self.path, "a") as f:
+            f.write(text + "\n")
+
+
+BACKENDS = {"telegram": Telegram, "smtp": SMTP, "webhook": Webhook, "file": File}
+
+
+def make_backend(spec):
+    """a notifier from its settings, like {"kind": "webhook", "url": ...}; just
+    the kind's name will do when it needs no settings"""
+    spec = config.notifier_spec(spec)
+    kind = spec["kind"]
+    backend = BACKENDS[kind](spec)
+    # what spooled messages are filed under; the same settings, the same key
+    blob = json.dumps(spec, sort_keys=True, default=str)
+    backend.key = f"{kind}-{hashlib.sha1(blob.encode()).hexdigest()[:8]}"
+    return backend
+
+
+def chunk(text, limit):
+    """split text into pieces of at most 'limit' characters, at line ends where
+    that's possible"""
+    if not limit or len(text) <= limit:
+        return [text]
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        else:
+            cut += 1
+        chunks.append(text[:cut])
+        text = text[cut:]
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def claim(path):
+    """the spool file at path, open and locked, or None if another rsyncr has
+    it (or it's been sent, or replaced, while we were getting the lock)"""
+    try:
+        f = open(path)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+            raise OSError("not the spool file any more")
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class Dispatcher:
+    """Sends messages from its own thread. notify() only queues; close() waits
+    (a while) for the queue to empty."""
+
+    STOP = object()
+
+    def __init__(self, backends, spool_dir=None, batch_seconds=2, retry=60):
+        self.backends = {b.key: b for b in backends}
+        self.spool_dir = spool_dir
+        self.batch_seconds = batch_seconds
+        self.retry = retry
+        # what's waiting to go: dicts of backend key, chunks, how many have gone,
+        # and when to next try (and its spool file, and the lock on that)
+        self.pending = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def notify(self, text):
+        self._queue.put(text)
+
+    def close(self, timeout=30):
+        self._queue.put(self.STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive() or self.pending:
+            log.warning("some notifications haven't gone yet; they're in the spool")
+        if not self._thread.is_alive():
+            # let some other rsyncr have a go at them
+            for entry in self.pending:
+                self._release(entry)
+
+    def _run(self):
+        self._load_spool()
+        stopping = False
+        while not stopping:
+            wait = None
+            if self.pending:
+                wait = max(0, min(p["next_try"] for p in self.pending) - time.time())
+            try:
+                batch = [self._queue.get(timeout=wait)]
+            except queue.Empty:
+                batch = []
+            # whatever else turns up soon goes along in the same message
+            deadline = time.time() + self.batch_seconds
+            while batch and batch[-1] is not self.STOP:
+                try:
+                    left = max(0, deadline - time.time())
+                    batch.append(self._queue.get(timeout=left))
+                except queue.Empty:
+                    break
+            if batch and batch[-1] is self.STOP:
+                stopping = True
+                batch.pop()
+            if batch:
+                self._add("\n\n".join(batch))
+            self._deliver(everything=stopping)
+
+    def _add(self, text):
+        for key, backend in self.backends.items():
+            entry = {
+                "backend": key,
+                "chunks": chunk(text, backend.limit),
+                "sent": 0,
+                "tries": 0,
+                "next_try": 0,
+                "path": None,
+                "lock": None,
+            }
+            self._save(entry)
+            self.pending.append(entry)
+
+    def _deliver(self, everything=False):
+        now = time.time()
+        for entry in list(self.pending):
+            if entry["next_try"] > now and not everything:
+                continue
+            backend = self.backends[entry["backend"]]
+            try:
+                while entry["sent"] < len(entry["chunks"]):
+                    piece = entry["chunks"][entry["sent"]]
+                    with trace.span("message.send", backend=entry["backend"]):
+                        backend.send(piece)
+                    entry["sent"] += 1
+            except Exception as e:
+                entry["tries"] += 1
+                delay = min(self.retry * 2 ** (entry["tries"] - 1), 3600)
+                entry["next_try"] = time.time() + delay
+                log.warning(
+                    f"couldn't send notification via {entry['backend']}"
+                    f" (try {entry['tries']}), again in {delay}s: {e}"
+                )
+                self._save(entry)
+                continue
+            self.pending.remove(entry)
+            if entry["path"]:
+                try:
+                    os.unlink(entry["path"])
+                except OSError:
+                    pass
+            self._release(entry)
+
+    def _release(self, entry):
+        if entry["lock"] is not None:
+            entry["lock"].close()
+            entry["lock"] = None
+
+    def _save(self, entry):
+        if not self.spool_dir:
+            return
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            if entry["path"] is None:
+                name = f"{time.time():.6f}-{uuid.uuid4().hex[:8]}.json"
+                entry["path"] = os.path.join(self.spool_dir, name)
+            tmp = entry["path"] + ".tmp"
+            f = open(tmp, "w")
+            # locked before it's in place, so it's never up for grabs
+            fcntl.flock(f, fcntl.LOCK_EX)
+            json.dump({k: v for k, v in entry.items() if k not in ("path", "lock")}, f)
+            f.flush()
+            os.replace(tmp, entry["path"])
+            self._release(entry)
+            entry["lock"] = f
+        except OSError as e:
+            log.warning(f"couldn't spool notification: {e}")
+
+    def _load_spool(self):
+        """pick up what earlier runs didn't manage to send"""
+        if not self.spool_dir or not os.path.isdir(self.spool_dir):
+            return
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            lock = claim(path)
+            if lock is None:
+                # another rsyncr's already on it
+                continue
+            try:
+                entry = json.load(lock)
+            except ValueError:
+                lock.close()
+                continue
+            if entry.get("backend") not in self.backends:
+                # sent somewhere that isn't set up any more; leave it be
+                lock.close()
+                continue
+            entry["path"] = path
+            entry["lock"] = lock
+            entry["next_try"] = 0
+            self.pending.append(entry)
+
+
+_dispatcher = None
+_lock = threading.Lock()
+
+
+def dispatcher(conf):
+    """the one dispatcher for this process, made from the first conf to ask"""
+    global _dispatcher
+    with _lock:
+        if _dispatcher is None:
+            backends = [make_backend(spec) for spec in conf["notifiers"]]
+            _dispatcher = Dispatcher(
+                backends,
+                os.path.join(conf["state_dir"], "spool"),
+                conf["notify_batch_seconds"],
+                conf["notify_retry"],
+            )
+            _dispatcher.timeout = conf["notify_timeout"]
+            atexit.register(shutdown)
+        return _dispatcher
+
+
+def notify(conf, message):
+    """queue 'message' to go to conf's notifiers"""
+    dispatcher(conf).notify(message)
 
 
-import telegram_send
+def shutdown():
+    """give queued messages a chance to go before the process ends"""
+    global _dispatcher
+    with _lock:
+        d, _dispatcher = _dispatcher, None
+    if d is not None:
+        d.close(d.timeout)
 
 
 def send(message):
-    """Send 'message' using telegram_send"""
-    telegram_send.send(messages=[message])
+    """Send 'message' using telegram_send, right now"""
+    for piece in chunk(message, Telegram.limit):
+        Telegram({}).send(piece)
@@ -0,0 +1,196 @@
+"""Run a command and deal with its output a line at a time, as it arrives.
+
+rsync with --verbose on a big tree can spit out millions of lines; we don't want
+all of that sitting in memory just to put the first and last bits of it in a
+notification. So lines get handed to 'sinks' (like the capture file) as they come
+in, and only a bounded head and tail are kept around for the report.
+"""
+
+import os
+import re
+import signal
+import logging
+import threading
+import subprocess
+from collections import deque
+
+from rsyncr import trace
+
+log = logging.getLogger()
+
+# what stream_command has running right now, for stop_all
+_running = set()
+_running_lock = threading.Lock()
+
+# progress lines end in a bare \r, so with a watchdog they count as lines too
+LINE_RE = re.compile(rb"[^\r\n]*(?:\r\n|\r|\n)")
+
+
+class OutputTail:
+    """Keep the first 'head' lines and the last 'tail' lines of some output, and
+    count whatever fell out of the middle."""
+
+    def __init__(self, head=50, tail=200):
+        self.head_size = head
+        self.head = []
+        self.tail = deque(maxlen=tail)
+        self.lines = 0
+        self.rusage = None
+
+    def add(self, line):
+        self.lines += 1
+        if len(self.head) < self.head_size:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+
+    @property
+    def dropped(self):
+        return self.lines - len(self.head) - len(self.tail)
+
+    def text(self):
+        parts = list(self.head)
+        if self.dropped:
+            parts.append(f"[... {self.dropped} lines omitted ...]\n")
+        parts.extend(self.tail)
+        return "".join(parts)
+
+
+class Capture:
+    """An append-only, thread-safe writer for capture_file, so several sources
+    running at once can all stream into the one file. When 'tagged', each line
+    gets the source name in front of it so the interleaving can be untangled."""
+
+    def __init__(self, path, tagged=False):
+        self.path = path
+        self.tagged = tagged
+        self._lock = threading.Lock()
+        self._f = open(path, "w")
+
+    def write(self, text):
+        with self._lock:
+            self._f.write(text)
+
+    def sink(self, source_name):
+        """a callable that writes one source's lines into the file"""
+        if not self.tagged:
+            return self.write
+        tag = f"[{source_name}] "
+        return lambda text: self.write(
+            "".join(tag + line for line in text.splitlines(True))
+        )
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+def reap(proc):
+    """wait for a process to finish; returns its return code, and what it used
+    (see trace.rusage), or None if something else got to it first"""
+    try:
+        _, status, ru = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        return proc.wait(), None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, trace.rusage(ru)
+
+
+def signal_group(proc, signum):
+    """signal a process started by stream_command and everything it started
+    (rsync's ssh, which holds the output pipe open too); they're a group of
+    their own"""
+    try:
+        os.killpg(proc.pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def stream_command(cmdargs, sinks=(), head=50, tail=200, watchdog=None):
+    """run cmdargs, passing each line of (combined stdout and stderr) output to
+    every sink as it shows up; returns (OutputTail, returncode). What the process
+    used (see reap) is left in the OutputTail's .rusage.
+
+    With a watchdog (see watchdog.py), progress lines go to it instead of the
+    sinks, and it may kill the command; then the return code is its say-so.
+
+    The command gets a session (and so a process group) of its own, so killing
+    it gets its children as well; that also means a ^C doesn't reach it, so
+    rsyncr going down has to take it along (see stop_all)."""
+    kept = OutputTail(head, tail)
+    proc = subprocess.Popen(
+        cmdargs,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=1 << 16,
+        start_new_session=True,
+    )
+    with _running_lock:
+        _running.add(proc)
+    try:
+        return _stream(proc, kept, sinks, watchdog)
+    except BaseException:
+        if proc.returncode is None:
+            signal_group(proc, signal.SIGTERM)
+        raise
+    finally:
+        with _running_lock:
+            _running.discard(proc)
+
+
+def stop_all():
+    """SIGTERM whatever stream_command still has running, when rsyncr's going
+    down without waiting for it (the workers are daemon threads)"""
+    with _running_lock:
+        procs = list(_running)
+    for proc in procs:
+        if proc.returncode is None:
+            signal_group(proc, signal.SIGTERM)
+
+
+def _stream(proc, kept, sinks, watchdog):
+    """the reading (and reaping) half of stream_command"""
+
+    def take(line):
+        kept.add(line)
+        for sink in sinks:
+            sink(line)
+
+    if watchdog is None:
+        with proc.stdout:
+            for raw in proc.stdout:
+                take(raw.decode("utf-8", errors="replace"))
+        returncode, kept.rusage = reap(proc)
+        return kept, returncode
+
+    watchdog.watch(proc)
+    try:
+        with proc.stdout:
+            pending = b""
+            while True:
+                chunk = proc.stdout.read1(1 << 16)
+                if not chunk:
+                    break
+                pending += chunk
+                end = 0
+                for m in LINE_RE.finditer(pending):
+                    if m.end() == len(pending) and pending.endswith(b"\r"):
+                        # might be half of a \r\n
+                        break
+                    end = m.end()
+                    line = m.group().decode("utf-8", errors="replace")
+                    if not watchdog.progress(line):
+                        take(line.rstrip("\r\n") + "\n")
+                pending = pending[end:]
+            if pending:
+                take(pending.decode("utf-8", errors="replace") + "\n")
+        returncode, kept.rusage = reap(proc)
+    finally:
+        watchdog.stop()
+    if watchdog.reason is not None:
+        take(f"[rsyncr killed this: {watchdog.reason}]\n")
+        returncode = watchdog.RETURNCODE
+    return kept, returncode
@@ -0,0 +1,203 @@
+"""'rsyncr plan <config>': what would a run do, and will it fit?
+
+Every source's real command is run with --dry-run --stats (several at once),
+which gives the number of files and bytes that would be transferred and the
+number of files that would be deleted. Those get added up per target filesystem
+and compared against its free space, which is a lot cheaper than finding out
+about a full disk 40 minutes into a job.
+
+A real run can do the same check first, with 'preflight': "refuse" won't start
+a job whose targets wouldn't fit, and "reorder" starts the smallest transfers
+first, so as much as possible gets done before space runs out.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+from functools import partial
+
+from rsyncr import run
+from rsyncr import stats
+from rsyncr import schedule
+
+
+def dry_run_command(cmdlist):
+    """a source's command, but only pretending, and telling us about it (but not
+    with running progress, which only the watchdog wants)"""
+    extra = [a for a in ("--dry-run", "--stats") if a not in cmdlist]
+    rest = [a for a in cmdlist[1:] if a != "--info=progress2"]
+    return cmdlist[:1] + extra + rest
+
+
+def existing_parent(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def plan_source(conf, source_name):
+    """dry-run one source; returns a row for the plan"""
+    d = conf["sources"][source_name]
+    cmdlist = dry_run_command(run.build_command(conf, source_name))
+    parser = stats.StatsParser()
+    out, returncode = run.run_command(cmdlist, [parser], head=0, tail=20)
+    s = parser.stats
+    if returncode:
+        # whatever it got through before failing says nothing about the whole
+        return dict(unplanned(conf, source_name), returncode=returncode, output=out)
+    return {
+        "job": conf.get("job_name"),
+        "source": source_name,
+        "target": d["target"],
+        "replicas": d.get("replicas", []),
+        "device": schedule.target_device(d["target"]),
+        "files": s.files_transferred,
+        "bytes": s.transferred_file_size,
+        "deletes": s.files_deleted,
+        "returncode": returncode,
+        "output": "",
+    }
+
+
+def unplanned(conf, source_name, why=""):
+    """the row for a source whose dry run didn't tell us anything"""
+    d = conf["sources"][source_name]
+    return {
+        "job": conf.get("job_name"),
+        "source": source_name,
+        "target": d["target"],
+        "replicas": d.get("replicas", []),
+        "device": schedule.target_device(d["target"]),
+        "files": None,
+        "bytes": None,
+        "deletes": None,
+        "returncode": None,
+        "output": why,
+    }
+
+
+def make_plan(confs, parallel=None):
+    """dry-run every source of every conf, several at once; rows come back in
+    config order"""
+    conf = confs[0]
+    pool = schedule.Scheduler(
+        parallel or max(conf["max_parallel"], 4),
+        {"host": conf["max_per_host"]},
+        {("host", h): n for h, n in conf["host_limits"].items()},
+    )
+    tasks = []
+    owners = []
+    for c in confs:
+        for n in c["sources"]:
+            tasks.append((partial(plan_source, c, n), run.source_keys(c, n)))
+            owners.append((c, n))
+    rows = pool.run(tasks)
+    for i, r in enumerate(rows):
+        if isinstance(r, Exception):
+            rows[i] = unplanned(*owners[i], repr(r))
+    return rows
+
+
+def device_totals(rows):
+    """{device: {"path", "need", "free", "unknown", "fits"}} for the target
+    filesystems; every replica of a source needs the same again on its own"""
+    devices = {}
+    for r in rows:
+        for target in [r["target"]] + r["replicas"]:
+            device = r["device"]
+            if target != r["target"]:
+                device = schedule.target_device(target)
+            dev = devices.setdefault(
+                device,
+                {"path": existing_parent(target), "need": 0, "unknown": False},
+            )
+            if r["bytes"] is None:
+                dev["unknown"] = True
+            else:
+                dev["need"] += r["bytes"]
+    for dev in devices.values():
+        dev["free"] = shutil.disk_usage(dev["path"]).free
+        # this doesn't take credit for old copies of files being replaced, or for
+        # deletions, so it errs on the side of 'won't fit'; so does a source we
+        # couldn't size up at all
+        dev["fits"] = dev["need"] <= dev["free"] and not dev["unknown"]
+    return devices
+
+
+def human(n):
+    if n is None:
+        return "?"
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(n) < 1024 or unit == "TiB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+        n /= 1024
+
+
+def format_plan(rows, devices):
+    lines = [f"{'job':12} {'source':16} {'files':>10} {'transfer':>12} {'deletes':>8}"]
+    for r in rows:
+        files = r["files"] if r["files"] is not None else "?"
+        deletes = r["deletes"] if r["deletes"] is not None else "?"
+        lines.append(
+            f"{r['job'] or '':12} {r['source']:16} {files:>10}"
+            f" {human(r['bytes']):>12} {deletes:>8}"
+        )
+        if r["returncode"]:
+            lines.append(
+                f"    dry run failed ({r['returncode']}): {r['output'].strip()}"
+            )
+        elif r["bytes"] is None:
+            lines.append(f"    dry run failed: {r['output'].strip()}")
+    lines.append("")
+    for dev in devices.values():
+        verdict = "ok" if dev["fits"] else "WON'T FIT"
+        if dev["unknown"]:
+            verdict = "WON'T FIT (a dry run failed, so how much is needed is unknown)"
+        lines.append(
+            f"{dev['path']}: needs {human(dev['need'])}, {human(dev['free'])} free"
+            f" -- {verdict}"
+        )
+    return "\n".join(lines)
+
+
+def preflight(confs):
+    """plan a run before doing it; returns (ok, text, {(job, source): bytes})"""
+    rows = make_plan(confs)
+    devices = device_totals(rows)
+    sizes = {(r["job"], r["source"]): r["bytes"] or 0 for r in rows}
+    ok = all(d["fits"] for d in devices.values())
+    return ok, format_plan(rows, devices), sizes
+
+
+def cli(argv):
+    """'rsyncr plan <config>': dry-run a job and say whether it'll fit"""
+    parser = argparse.ArgumentParser(prog="rsyncr plan")
+    parser.add_argument("config", help="job/config name to plan")
+    parser.add_argument(
+        "--job-config-path", help="(optional) what job toml file to use"
+    )
+    parser.add_argument("--configs-dir", help="(optional) where to look for toml files")
+    parser.add_argument(
+        "--global-config-path", help="(optional) override global config settings"
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, help="how many dry runs to do at the same time"
+    )
+    args = parser.parse_args(argv)
+
+    conf = run.load_job(
+        args.config,
+        job_config_path=args.job_config_path,
+        config_dir=args.configs_dir,
+        global_config_path=args.global_config_path,
+    )
+    rows = make_plan([conf], args.jobs)
+    devices = device_totals(rows)
+    print(format_plan(rows, devices))
+    if not all(d["fits"] for d in devices.values()):
+        sys.exit(1)
@@ -1,19 +1,36 @@
 """Build and run the rsync commands"""
 
+import sys
+import time
 import os.path
+import glob
+import fnmatch
 import logging
 import argparse
+import importlib
+import threading
+from functools import partial
 
-from executor import execute, ExternalCommandFailed
-
+# only what building commands needs is imported up here; the rest (notifiers,
+# the run history, process handling...) is imported where it's used, so things
+# like 'rsyncr check' start quickly. tests/test_startup.py keeps it that way.
+from rsyncr import checkpoint
 from rsyncr import config
-from rsyncr import message
+from rsyncr import filters
+from rsyncr import governor
+from rsyncr import schedule
+from rsyncr import trace
+from rsyncr import watchdog
 
 log = logging.getLogger()
 
 
-def build_command(conf, src):
-    """Make a list that corresponds to the rsync command line"""
+@trace.traced("build_command")
+def build_command(conf, src, rsh=None, tuned=(), bwlimit=None):
+    """Make a list that corresponds to the rsync command line; rsh is a remote
+    shell to pass along to rsync, like a shared ssh connection, tuned are
+    flags from auto-tuning (see tune.py), and bwlimit (KiB/s) is what the
+    governor allows, if not the source's own bwlimit (see governor.py)"""
     log.debug(f"""running build_command with source={src}, """)
     command = []
     command.append(conf["rsync_command"])
@@ -21,18 +38,32 @@ def build_command(conf, src):
         command.append("--dry-run")
     if conf["verbose"]:
         command.append("--verbose")
+    if conf["stats"]:
+        command.append("--stats")
+    if conf["itemize_changes"]:
+        command.append("--itemize-changes")
+    if watchdog.wants_progress(conf, conf["sources"][src]):
+        command.append("--info=progress2")
+    if conf["partial"]:
+        partial_dir = conf["partial"] if isinstance(conf["partial"], str) else None
+        command.append(f"--partial-dir={partial_dir or '.rsync-partial'}")
     for g in conf["global_rsync_params"]:
         command.append(g)
+    if tuned:
+        from rsyncr import tune
+
+        # whatever's been set explicitly wins
+        command.extend(tune.drop_overridden(tuned, command))
+    if bwlimit is None:
+        bwlimit = governor.bwlimit(conf, conf["sources"][src])
+    if bwlimit and not any(a.startswith("--bwlimit") for a in command):
+        command.append(f"--bwlimit={bwlimit}")
+    command.extend(daemon_args(conf, conf["sources"][src]))
+    if rsh:
+        command.append(f"--rsh={rsh}")
 
-    # global excludes
-    for e in conf.get("global_excludes", []):
-        command.append(f"--exclude={e}")
-    # job excludes
-    for e in conf.get("excludes", []):
-        command.append(f"--exclude={e}")
-    # source excludes
-    for e in conf["sources"][src].get("excludes", []):
-        command.append(f"--exclude={e}")
+    # global, job, and source excludes, all together
+    command.extend(filters.exclude_args(conf, src))
 
     command.append(conf["sources"][src]["location"])
     command.append(conf["sources"][src]["target"])
@@ -41,34 +72,817 @@ def build_command(conf, src):
     return command
 
 
-def call_command(cmdargs):
-    # check tells it to not throw exception if there is a non-zero return code
+def daemon_args(conf, d):
+    """what a source on an rsync daemon needs on the command line"""
+    if not schedule.is_daemon(d["location"]):
+        return []
+    password_file = d.get("password_file", conf["password_file"])
+    return [f"--password-file={password_file}"] if password_file else []
+
+
+def run_command(cmdargs, sinks=(), head=50, tail=200, dog=None):
+    """run a command, streaming its output to sinks as it goes; returns a trimmed
+    copy of the output (first 'head' and last 'tail' lines) and the return code.
+    'dog' is a watchdog.Watchdog, for commands that might hang"""
+    from rsyncr import output
+
+    with trace.span("run_command", command=cmdargs[0]) as args:
+        try:
+            kept, returncode = output.stream_command(cmdargs, sinks, head, tail, dog)
+        except OSError as e:
+            # no such rsync_command, or similar
+            log.error(f"Couldn't run {cmdargs[0]}: {e}")
+            return f"Couldn't run {cmdargs[0]}: {e}\n", 127
+        args["returncode"] = returncode
+        args["lines"] = kept.lines
+        args.update(kept.rusage or {})
+    if returncode in (23, 24):
+        log.warning(f"Return code {returncode}! -- likely permissions?")
+    elif returncode:
+        log.error(f"Return code {returncode} from {cmdargs[0]}!")
+    return kept.text(), returncode
+
+
+def call_command(cmdargs, sinks=()):
+    """run a command, returning its (trimmed) output and whether it failed"""
+    out, returncode = run_command(cmdargs, sinks)
+    return out, returncode != 0
+
+
+RULE = "\n--------------------------------------------------------------------\n"
+
+
+def format_command(cmdlist, max_excludes=5):
+    """the command as a string for the report, with long runs of --exclude=
+    trimmed down to a count"""
+    parts = []
+    run_of = 0
+    for arg in cmdlist:
+        if arg.startswith("--exclude="):
+            run_of += 1
+            if run_of > max_excludes:
+                continue
+        elif run_of > max_excludes:
+            parts.append(f"[+{run_of - max_excludes} more excludes]")
+            run_of = 0
+        else:
+            run_of = 0
+        parts.append(arg)
+    if run_of > max_excludes:
+        parts.append(f"[+{run_of - max_excludes} more excludes]")
+    return " ".join(parts)
+
+
+def source_header(name, d, cmdlist):
+    """the bit of the report that says what is about to be rsync'd, and how"""
+    text = f"\nSource {name}: {d['location']} to {d['target']}\n"
+    if d.get("shards"):
+        text += f"(in {d['shards']} shards)\n"
+    if d.get("replicas"):
+        text += f"(and replayed onto {', '.join(d['replicas'])})\n"
+    if d.get("large_file_threshold"):
+        text += f"(files over {d['large_file_threshold']} in a pass of their own)\n"
+    text += "Command:\n" + format_command(cmdlist)
+    text += RULE
+    return text
+
+
+class RunContext:
+    """The things shared by all the sources in one run of rsyncr (one job, or a
+    whole fleet of them): capture files, ssh connections, the run history...
+
+    'conf' is the conf that decides how the run as a whole goes; 'confs' are the
+    jobs in it. 'header' gets written at the top of each capture file."""
+
+    def __init__(self, conf, confs, header=""):
+        from rsyncr import history
+        from rsyncr import output
+        from rsyncr import ssh
+
+        self.conf = conf
+        # remote sources can share an ssh connection per host for the whole run
+        self.sshpool = ssh.SSHPool.from_conf(conf)
+        self.history = None
+        if conf["history"]:
+            self.history = history.History(history.history_path(conf))
+        # the capture files get rsync's output as it happens; several jobs might
+        # share one, and sources running at once need their lines tagged
+        tagged = conf["max_parallel"] > 1 or len(confs) > 1
+        self.captures = {}
+        for c in confs:
+            path = c["capture_file"]
+            if path and path not in self.captures:
+                self.captures[path] = output.Capture(path, tagged=tagged)
+                self.captures[path].write(header)
+        self.hashes = {c.get("job_name"): config.config_hash(c) for c in confs}
+        self._fingerprints = None
+        self._checkpoints = {}
+        self._lock = threading.Lock()
+        # {(job, source): planned bytes}, if a preflight plan says to reorder
+        self.sizes = None
+        self.tuner = None
+        self.governor = None
+        self.board = None
+        if conf["status_file"]:
+            self.board = watchdog.StatusBoard(conf["status_file"])
+
+    def capture(self, conf):
+        return self.captures.get(conf["capture_file"])
+
+    def watchdog(self, conf, d, tag):
+        """a watchdog for one rsync, if it needs watching"""
+        stall, timeout = watchdog.settings(conf, d)
+        if not (stall or timeout or self.board or self.governor):
+            return None
+        name = f"{conf.get('job_name')}/{tag}" if conf.get("job_name") else tag
+        return watchdog.Watchdog(
+            stall, timeout, name=name, board=self.board, governor=self.governor
+        )
+
+    def govern(self, pool):
+        """start the governor on pool, if the run wants one; returns it"""
+        if self.conf["governor"]:
+            self.governor = governor.Governor.from_conf(self.conf, pool).start()
+        return self.governor
+
+    def bwlimit(self, conf, source_name):
+        """a source's bwlimit, cut back if the governor says the machine's busy"""
+        factor = self.governor.factor if self.governor is not None else 1.0
+        return governor.bwlimit(conf, conf["sources"][source_name], factor)
+
+    def rsh(self, conf, source_name):
+        """the --rsh to use for a source; only remote sources in jobs that want
+        ssh multiplexing get one"""
+        if not conf["ssh_multiplex"]:
+            return None
+        location = conf["sources"][source_name]["location"]
+        host = schedule.source_host(location)
+        # an rsync daemon is talked to directly; with --rsh, rsync would go
+        # through ssh and start a daemon of its own over there instead
+        if host == "local" or schedule.is_daemon(location):
+            return None
+        return self.sshpool.rsh(host)
+
+    def tuned(self, conf, source_name, rsh=None):
+        """auto-tuned flags for a source, if it wants them"""
+        d = conf["sources"][source_name]
+        if not d.get("auto_tune", conf["auto_tune"]):
+            return []
+        from rsyncr import tune
+
+        with self._lock:
+            if self.tuner is None:
+                path = os.path.join(self.conf["state_dir"], "tune.json")
+                self.tuner = tune.Tuner(path, self.conf["tune_ttl"])
+        return self.tuner.flags(conf, source_name, rsh)
+
+    def fingerprints(self):
+        """the fingerprint store, read in the first time something needs it"""
+        from rsyncr import fingerprint
+
+        with self._lock:
+            if self._fingerprints is None:
+                path = fingerprint_path(self.conf)
+                self._fingerprints = fingerprint.Store(path)
+            return self._fingerprints
+
+    def checkpoint(self, conf):
+        """a job's checkpoint; a run that isn't resuming starts a fresh one"""
+        job = conf.get("job_name")
+        with self._lock:
+            if job not in self._checkpoints:
+                cp = checkpoint.Checkpoint(checkpoint.checkpoint_path(conf))
+                if not conf["resume"]:
+                    cp.clear()
+                self._checkpoints[job] = cp
+            return self._checkpoints[job]
+
+    def job_started(self, conf):
+        """bookkeeping for a job that's about to run: one that isn't resuming
+        throws away the old checkpoint now, so it can't outlive a run where
+        nothing worked"""
+        if conf["dry_run"]:
+            return
+        try:
+            self.checkpoint(conf)
+        except OSError as e:
+            log.warning(f"couldn't read the checkpoint: {e}")
+
+    def finished(self, conf, result):
+        """bookkeeping for a source that's done"""
+        if result.get("resumed"):
+            # it was done (and recorded) last time
+            return
+        # a dry run or a skipped source didn't copy anything, so how long it
+        # took says nothing about the next real run
+        real = not (conf["dry_run"] or result.get("skipped"))
+        if self.history is not None and real:
+            job = conf.get("job_name")
+            self.history.record(job, result, self.hashes.get(job))
+        if conf["dry_run"] or result["error"] or not checkpoint.wanted(conf):
+            return
+        name = result["name"]
+        try:
+            self.checkpoint(conf).mark(name, conf["sources"][name])
+        except OSError as e:
+            # the copy itself went fine; a run that can't be resumed isn't a
+            # reason to fail the source
+            log.warning(f"couldn't write the checkpoint for {name}: {e}")
+
+    def job_finished(self, conf, results):
+        """bookkeeping for a job that's done; one with no errors has nothing left
+        to resume"""
+        if conf["dry_run"] or any(r["error"] for r in results):
+            return
+        try:
+            self.checkpoint(conf).clear()
+        except OSError as e:
+            log.warning(f"couldn't remove the checkpoint: {e}")
+
+    def close(self):
+        self.sshpool.close()
+        if self.history is not None:
+            self.history.close()
+        for capture in self.captures.values():
+            capture.close()
+
+
+def rsync_pass(conf, cmdlist, ctx=None, tag=None, header="", d=None):
+    """run one rsync command for source d, streaming its output into the capture
+    file (if any) under 'tag'; returns a dict of how it went"""
+    from rsyncr import stats
+
+    capture = ctx.capture(conf) if ctx else None
+    if ctx is not None:
+        dog = ctx.watchdog(conf, d, tag)
+    else:
+        stall, timeout = watchdog.settings(conf, d)
+        dog = watchdog.Watchdog(stall, timeout, name=tag) if stall or timeout else None
+    # numbers get counted as the output streams past, not picked out afterwards
+    parser = stats.StatsParser()
+    sinks = [parser]
+    if capture is not None:
+        sink = capture.sink(tag)
+        sink(header)
+        sinks.append(sink)
+    # nice and ionice go in front of rsync, but not in what gets reported
+    spawned = governor.priority_prefix(conf, d) + cmdlist
+    started = time.time()
+    out, returncode = run_command(
+        spawned, sinks, conf["output_head_lines"], conf["output_tail_lines"], dog
+    )
+    finished = time.time()
+    if capture is not None:
+        sink(RULE)
+    return {
+        "command": cmdlist,
+        "output": out,
+        "returncode": returncode,
+        "stats": parser.stats,
+        "started": started,
+        "finished": finished,
+    }
+
+
+def source_result(source_name, d, rsync_result):
+    """the dict describing how a source went, from how its rsync(s) went"""
+    result = {"name": source_name, "location": d["location"], "target": d["target"]}
+    result.update(rsync_result)
+    result["error"] = result["returncode"] != 0
+    result["bytes_sent"] = result["stats"].bytes_sent
+    result["bytes_received"] = result["stats"].bytes_received
+    return result
+
+
+def skipped_result(source_name, d, why=None):
+    """the result for a source that didn't need rsync-ing at all"""
+    from rsyncr import stats
+
+    now = time.time()
+    if why is None:
+        why = (
+            "Skipped: nothing has changed since the last successful run"
+            " (--force to run it anyway)\n"
+        )
+    result = source_result(
+        source_name,
+        d,
+        {
+            "command": [],
+            "output": why,
+            "returncode": 0,
+            "stats": stats.TransferStats(),
+            "started": now,
+            "finished": now,
+        },
+    )
+    result["skipped"] = True
+    return result
+
+
+def run_source(conf, source_name, ctx=None):
+    """rsync one source, and hand back a dict describing how it went; if there's a
+    capture file, the output is streamed into it as rsync runs.
+
+    Local sources with skip_unchanged on are fingerprinted first, and skipped if
+    nothing has changed since their last successful run. With --resume, sources
+    the job's checkpoint says are done are skipped too."""
+    d = conf["sources"][source_name]
+    if ctx is not None and conf["resume"] and ctx.checkpoint(conf).done(source_name, d):
+        log.info(f"{source_name} was done last time, skipping it")
+        result = skipped_result(
+            source_name, d, "Skipped: finished in the run being resumed\n"
+        )
+        del result["skipped"]
+        result["resumed"] = True
+        return result
+    check = (
+        d.get("skip_unchanged", conf["skip_unchanged"])
+        and not conf["force"]
+        and d["location"].startswith("/")
+        and os.path.isdir(d["location"])
+    )
+    if check:
+        from rsyncr import fingerprint
+
+        store = ctx.fingerprints() if ctx else fingerprint.Store(fingerprint_path(conf))
+        key = fingerprint.source_key(d, filters.compile_excludes(conf, source_name))
+        # taken before rsync runs, so anything that changes during the run will
+        # still be different next time
+        digest = fingerprint.fingerprint(d["location"])
+        if store.get(key) == digest and os.path.isdir(d["target"]):
+            log.info(f"{source_name} hasn't changed, skipping it")
+            return skipped_result(source_name, d)
+    result = run_with_retries(conf, source_name, ctx)
+    if check and result["returncode"] == 0 and not conf["dry_run"]:
+        store.set(key, digest)
+    return result
+
+
+def fingerprint_path(conf):
+    return os.path.join(conf["state_dir"], "fingerprints.json")
+
+
+def run_with_retries(conf, source_name, ctx=None):
+    """rsync a source, and again (after a wait that doubles each time) if it
+    fails with one of retry_codes; the result is the last attempt's, with notes
+    about the earlier ones at the top of the output"""
+    d = conf["sources"][source_name]
+    retries = d.get("retries", conf["retries"])
+    notes = []
+    first_started = None
+    attempt = 0
+    while True:
+        result = _run_source(conf, source_name, ctx)
+        if first_started is None:
+            first_started = result.get("started")
+        returncode = result["returncode"]
+        if attempt >= retries or returncode not in conf["retry_codes"]:
+            break
+        delay = conf["retry_backoff"] * 2 ** attempt
+        attempt += 1
+        note = (
+            f"[attempt {attempt} failed with return code {returncode},"
+            f" trying again in {delay:g}s]\n"
+        )
+        log.warning(f"{source_name}: {note.strip()}")
+        notes.append(note)
+        time.sleep(delay)
+    if notes:
+        result["output"] = "".join(notes) + result["output"]
+        result["attempts"] = attempt + 1
+        result["started"] = first_started
+    return result
+
+
+def _run_source(conf, source_name, ctx=None):
+    d = conf["sources"][source_name]
+    if d.get("shards", 1) > 1:
+        return run_sharded_source(conf, source_name, ctx)
+    if d.get("replicas"):
+        return run_replicated_source(conf, source_name, ctx)
+    if d.get("large_file_threshold"):
+        return run_split_source(conf, source_name, ctx)
+    rsh = ctx.rsh(conf, source_name) if ctx else None
+    tuned = ctx.tuned(conf, source_name, rsh) if ctx else ()
+    limit = ctx.bwlimit(conf, source_name) if ctx else None
+    cmdlist = build_command(conf, source_name, rsh=rsh, tuned=tuned, bwlimit=limit)
+    header = source_header(source_name, d, cmdlist)
+    return source_result(
+        source_name, d, rsync_pass(conf, cmdlist, ctx, source_name, header, d)
+    )
+
+
+def run_sharded_source(conf, source_name, ctx=None):
+    """rsync one big source as several rsyncs at once (see shard.py), reported as
+    if it were one"""
+    import subprocess
+
+    from rsyncr import shard
+    from rsyncr import stats
+
+    d = conf["sources"][source_name]
+    rsh = ctx.rsh(conf, source_name) if ctx else None
+    tuned = ctx.tuned(conf, source_name, rsh) if ctx else ()
+    # the source's bwlimit is shared out between its shards
+    limit = ctx.bwlimit(conf, source_name) if ctx else governor.bwlimit(conf, d)
+    limit = max(1, limit // d["shards"]) if limit else 0
+    cmdlist = build_command(conf, source_name, rsh=rsh, tuned=tuned, bwlimit=limit)
+    key = shard.shard_key(d)
     try:
-        output = execute(*cmdargs, capture=True)
-        error_flag = False
-    except ExternalCommandFailed as e:
-        output = e.error_message
-        error_flag = True
-        if e.returncode in (23, 24):
-            log.warning(
-                f"Return code {e.returncode}! {e.error_message} -- likely permissions?"
+        names = shard.list_entries(
+            d["location"], conf["rsync_command"], rsh, daemon_args(conf, d)
+        )
+        cache = os.path.join(shard.shard_dir(conf), f"{key}.json")
+        weights = shard.estimate(d["location"], names, cache)
+        bins = shard.pack(weights, d["shards"])
+        lists = shard.write_lists(bins, shard.shard_dir(conf), key)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning(f"couldn't shard {source_name}, running it whole: {e}")
+        header = source_header(source_name, d, cmdlist)
+        return source_result(
+            source_name, d, rsync_pass(conf, cmdlist, ctx, source_name, header, d)
+        )
+
+    tasks = []
+    for i, path in enumerate(lists):
+        c = shard.shard_command(cmdlist, path)
+        tag = f"{source_name}#{i}"
+        header = source_header(f"{source_name} (shard {i})", d, c)
+        tasks.append((partial(rsync_pass, conf, c, ctx, tag, header, d), {}))
+    passes = schedule.Scheduler(len(tasks)).run(tasks)
+    for i, p in enumerate(passes):
+        if isinstance(p, Exception):
+            passes[i] = failed_pass(tasks[i][0].args[1], "shard", p)
+
+    # only clear out deleted files once every shard has made it; a failed shard
+    # might mean a half-listed source
+    final = None
+    delete_cmd = shard.delete_command(cmdlist)
+    if delete_cmd and all(p["returncode"] == 0 for p in passes):
+        header = source_header(f"{source_name} (deletions)", d, delete_cmd)
+        final = rsync_pass(
+            conf, delete_cmd, ctx, f"{source_name}#delete", header, d
+        )
+
+    parts = []
+    for i, (p, names) in enumerate(zip(passes, bins)):
+        parts.append(
+            f"[shard {i}: {len(names)} entries, return code {p['returncode']}]\n"
+        )
+        parts.append(p["output"])
+    combined = stats.combine([p["stats"] for p in passes])
+    every = passes
+    if final is not None:
+        parts.append(f"[deletions: return code {final['returncode']}]\n")
+        parts.append(final["output"])
+        combined.files_deleted = final["stats"].files_deleted
+        if "deleted" in final["stats"].itemized:
+            combined.itemized["deleted"] = final["stats"].itemized["deleted"]
+        every = passes + [final]
+    returncodes = [p["returncode"] for p in every]
+    started = [p["started"] for p in every if p["started"] is not None]
+    finished = [p["finished"] for p in every if p["finished"] is not None]
+    return source_result(
+        source_name,
+        d,
+        {
+            "command": cmdlist,
+            "output": "".join(parts),
+            # the first thing that went wrong, if anything did
+            "returncode": next((r for r in returncodes if r != 0), 0),
+            "stats": combined,
+            "started": min(started) if started else None,
+            "finished": max(finished) if finished else None,
+            "shards": len(passes),
+        },
+    )
+
+
+def failed_pass(cmdlist, what, exc):
+    """a stand-in for one of a source's rsyncs, where rsyncr itself fell over"""
+    from rsyncr import stats
+
+    return {
+        "command": cmdlist,
+        "output": f"rsyncr failed to run this {what}: {exc!r}",
+        "returncode": None,
+        "stats": stats.TransferStats(),
+        "started": None,
+        "finished": None,
+    }
+
+
+def run_split_source(conf, source_name, ctx=None):
+    """rsync a source's large files and the rest of it side by side (see
+    sizes.py), reported as one source"""
+    from rsyncr import sizes
+    from rsyncr import stats
+
+    d = conf["sources"][source_name]
+    threshold = sizes.parse_size(d["large_file_threshold"])
+    rsh = ctx.rsh(conf, source_name) if ctx else None
+    tuned = ctx.tuned(conf, source_name, rsh) if ctx else ()
+    # the source's bwlimit is shared out between the two
+    limit = ctx.bwlimit(conf, source_name) if ctx else governor.bwlimit(conf, d)
+    limit = max(1, limit // 2) if limit else 0
+    cmdlist = build_command(conf, source_name, rsh=rsh, tuned=tuned, bwlimit=limit)
+    commands = [
+        (f"files over {sizes.human(threshold)}", "large", sizes.large_command),
+        ("everything else", "small", sizes.small_command),
+    ]
+    tasks = []
+    for what, kind, make in commands:
+        c = make(cmdlist, threshold)
+        header = source_header(f"{source_name} ({what})", d, c)
+        tag = f"{source_name}#{kind}"
+        tasks.append((partial(rsync_pass, conf, c, ctx, tag, header, d), {}))
+    passes = schedule.Scheduler(len(tasks)).run(tasks)
+    parts = []
+    for i, ((what, _, _), p) in enumerate(zip(commands, passes)):
+        if isinstance(p, Exception):
+            p = passes[i] = failed_pass(tasks[i][0].args[1], "pass", p)
+        parts.append(f"[{what}: return code {p['returncode']}]\n")
+        parts.append(p["output"])
+
+    large, small = passes
+    combined = stats.combine([large["stats"], small["stats"]])
+    # both passes list the whole tree; only the amounts sent add up
+    combined.files = small["stats"].files
+    combined.total_file_size = small["stats"].total_file_size
+    returncodes = [p["returncode"] for p in passes]
+    started = [p["started"] for p in passes if p["started"] is not None]
+    finished = [p["finished"] for p in passes if p["finished"] is not None]
+    return source_result(
+        source_name,
+        d,
+        {
+            "command": cmdlist,
+            "output": "".join(parts),
+            "returncode": next((r for r in returncodes if r != 0), 0),
+            "stats": combined,
+            "started": min(started) if started else None,
+            "finished": max(finished) if finished else None,
+            "large_file_threshold": sizes.human(threshold),
+        },
+    )
+
+
+def run_replicated_source(conf, source_name, ctx=None):
+    """rsync a source to its first target, then replay that onto the rest (see
+    batch.py), reported as one source"""
+    from rsyncr import batch
+
+    d = conf["sources"][source_name]
+    rsh = ctx.rsh(conf, source_name) if ctx else None
+    tuned = ctx.tuned(conf, source_name, rsh) if ctx else ()
+    limit = ctx.bwlimit(conf, source_name) if ctx else None
+    cmdlist = build_command(conf, source_name, rsh=rsh, tuned=tuned, bwlimit=limit)
+    path = batch.batch_path(conf, d)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_cmd = batch.write_batch_command(cmdlist, path)
+    header = source_header(source_name, d, write_cmd)
+    first = rsync_pass(conf, write_cmd, ctx, source_name, header, d)
+    parts = [f"[{d['target']}: return code {first['returncode']}]\n", first["output"]]
+    every = [first]
+
+    if first["returncode"] != 0 or conf["dry_run"]:
+        why = "dry run" if first["returncode"] == 0 else "the first target failed"
+        parts.append(f"[not replayed onto the other targets: {why}]\n")
+    else:
+
+        def replay(target):
+            tag = f"{source_name}>{target}"
+            c = batch.read_batch_command(cmdlist, path, target)
+            p = rsync_pass(conf, c, ctx, tag, source_header(tag, d, c), d)
+            if p["returncode"] == 0:
+                return [p]
+            # not the same as the first target was; bring it in line the long way
+            log.warning(f"replaying onto {target} failed, copying it instead")
+            c = batch.copy_command(cmdlist, d["target"], target)
+            return [p, rsync_pass(conf, c, ctx, tag, source_header(tag, d, c), d)]
+
+        tasks = [(partial(replay, t), {}) for t in d["replicas"]]
+        replays = schedule.Scheduler(len(tasks)).run(tasks)
+        for target, passes in zip(d["replicas"], replays):
+            if isinstance(passes, Exception):
+                parts.append(f"[{target}: rsyncr failed to replay: {passes!r}]\n")
+                every.append({"returncode": None, "started": None, "finished": None})
+                continue
+            how = "replayed" if len(passes) == 1 else "replay failed, copied"
+            parts.append(
+                f"[{target}: {how}, return code {passes[-1]['returncode']}]\n"
             )
-        else:
-            raise e
+            parts.append(passes[-1]["output"])
+            every.append(passes[-1])
+    batch.remove(path)
+
+    returncodes = [p["returncode"] for p in every]
+    started = [p["started"] for p in every if p["started"] is not None]
+    finished = [p["finished"] for p in every if p["finished"] is not None]
+    return source_result(
+        source_name,
+        d,
+        {
+            "command": cmdlist,
+            "output": "".join(parts),
+            "returncode": next((r for r in returncodes if r != 0), 0),
+            # what came over from the source; the replays are all local
+            "stats": first["stats"],
+            "started": min(started) if started else None,
+            "finished": max(finished) if finished else None,
+            "replicas": d["replicas"],
+        },
+    )
+
+
+def source_report(result):
+    """the chunk of the message text that describes one source's run"""
+    d = {
+        "location": result["location"],
+        "target": result["target"],
+        "shards": result.get("shards"),
+        "replicas": result.get("replicas"),
+        "large_file_threshold": result.get("large_file_threshold"),
+    }
+    text = source_header(result["name"], d, result["command"])
+    text += result["output"]
+    text += RULE
+    return text
+
+
+def source_keys(conf, source_name):
+    """what a source competes for when running in parallel: the host it reads
+    from, and the filesystem it writes to"""
+    d = conf["sources"][source_name]
+    host = schedule.source_host(d["location"])
+    return {
+        # local sources are limited by the device they land on, not by 'host'
+        "host": None if host == "local" else host,
+        "device": schedule.target_device(d["target"]),
+    }
+
+
+def failed_result(conf, source_name, exc):
+    """a stand-in result for a source where rsyncr itself fell over"""
+    from rsyncr import stats
+
+    d = conf["sources"][source_name]
+    return {
+        "name": source_name,
+        "location": d["location"],
+        "target": d["target"],
+        "command": build_command(conf, source_name),
+        "output": f"rsyncr failed to run this source: {exc!r}",
+        "returncode": None,
+        "error": True,
+        "stats": stats.TransferStats(),
+    }
+
+
+def make_scheduler(conf):
+    """a worker pool sized by the settings in conf"""
+    caps = {("host", h): n for h, n in conf["host_limits"].items()}
+    return schedule.Scheduler(
+        conf["max_parallel"],
+        {"host": conf["max_per_host"], "device": conf["max_per_device"]},
+        caps,
+    )
+
+
+def run_sources(conf, ctx=None):
+    """rsync all the sources in a conf, maybe several at once; results come back
+    in config order"""
+    return run_fleet([conf], make_scheduler(conf), ctx)[0]
+
+
+def _run_and_finish(conf, source_name, ctx):
+    with trace.span("source", job=conf.get("job_name"), source=source_name):
+        result = run_source(conf, source_name, ctx)
+    if ctx is not None:
+        ctx.finished(conf, result)
+    return result
+
+
+def run_fleet(confs, pool, ctx=None):
+    """rsync the sources of several jobs through one scheduler; returns a list of
+    results for each conf, each in config order"""
+    tasks = []
+    owners = []
+    priorities = []
+    for i, conf in enumerate(confs):
+        took = {}
+        if ctx is not None and ctx.history is not None and pool.max_parallel > 1:
+            took = ctx.history.durations(conf.get("job_name"))
+        for n in conf["sources"]:
+            keys = source_keys(conf, n)
+            keys["job"] = conf.get("job_name")
+            tasks.append((partial(_run_and_finish, conf, n, ctx), keys))
+            owners.append((i, n))
+            if ctx is not None and ctx.sizes is not None:
+                # short on space: smallest transfers first, to get the most done
+                priorities.append(-ctx.sizes.get((conf.get("job_name"), n), 0))
+            else:
+                # longest first; never-seen-before sources are assumed to be slow
+                priorities.append(took.get(n, float("inf")))
+    if ctx is not None:
+        for conf in confs:
+            ctx.job_started(conf)
+    gov = ctx.govern(pool) if ctx is not None else None
+    try:
+        results = pool.run(tasks, priorities)
     finally:
-        return output, error_flag
+        if gov is not None:
+            gov.stop()
+    grouped = [[] for _ in confs]
+    for (i, n), r in zip(owners, results):
+        if isinstance(r, Exception):
+            # one source blowing up shouldn't sink the report for all the others
+            r = failed_result(confs[i], n, r)
+        grouped[i].append(r)
+    return grouped
 
 
-def process_job(
+def preflight(conf, confs):
+    """dry-run everything first, if conf says to (see plan.py). Returns the plan
+    text if the run should be refused, and the planned sizes if the sources
+    should be reordered; (None, None) means just go ahead"""
+    if not conf["preflight"]:
+        return None, None
+    # plan uses this module, so it can't be imported at the top
+    from rsyncr import plan
+
+    ok, text, sizes = plan.preflight(confs)
+    if ok:
+        return None, None
+    if conf["preflight"] == "refuse":
+        return text, None
+    log.warning("targets look like they'll fill up; smallest transfers first")
+    return None, sizes
+
+
+def refused_results(conf, why):
+    """results for the sources of a job that preflight wouldn't let run"""
+    from rsyncr import stats
+
+    results = []
+    for n, d in conf["sources"].items():
+        results.append(
+            source_result(
+                n,
+                d,
+                {
+                    "command": [],
+                    "output": why,
+                    "returncode": None,
+                    "stats": stats.TransferStats(),
+                    "started": None,
+                    "finished": None,
+                },
+            )
+        )
+        results[-1]["error"] = True
+    return results
+
+
+def skipped_note(results):
+    """the end of the summary sentence; mentions skipped sources if there were any"""
+    notes = []
+    skipped = sum(1 for r in results if r.get("skipped"))
+    if skipped:
+        notes.append(f"{skipped} unchanged, so skipped")
+    resumed = sum(1 for r in results if r.get("resumed"))
+    if resumed:
+        notes.append(f"{resumed} already done in the run being resumed")
+    if notes:
+        return f" ({'; '.join(notes)})."
+    return "."
+
+
+def send_report(conf, message_text, any_errors, summary):
+    """print or send off the results; the whole thing if there were errors,
+    otherwise just the summary"""
+    if conf["console_override"]:
+        print(message_text)
+    else:
+        from rsyncr import message
+
+        # send the output off, but only detailed if there is an error; this only
+        # queues it, the sending happens in the background
+        if any_errors:
+            message.notify(conf, message_text)
+        else:
+            message.notify(conf, summary)
+
+
+def load_job(
     config_name,
     job_config_path=None,
     config_dir=None,
     global_config_path=None,
     args=None,
 ):
-    """Handle the directories associated with 'config_name' for backups"""
-    message_text = f"RsyncR is processing config {config_name}\n"
-
+    """read and merge all the configs for one job"""
     # determine where our config files are...
     if config_dir is None:
         config_dir = config.DEFAULTS["configs_dir"]
@@ -89,37 +903,174 @@ def process_job(
 
     # merge all the configs properly
     conf = config.merge_configs(gconf, jconf, aconf)
+    conf["job_name"] = config_name
+    return conf
 
-    # now the directories/sources for sync'ing
-    any_errors = False
-    for source_name, d in conf["sources"].items():
-        cmdlist = build_command(conf, source_name)
-        message_text += f"\nSource {source_name}: {d['location']} to {d['target']}\n"
-        message_text += "Command:\n" + " ".join(cmdlist)
-        message_text += (
-            "\n--------------------------------------------------------------------\n"
-        )
-        out, source_error_flag = call_command(cmdlist)
-        # keep track of whether any of the sources had an error
-        any_errors = any_errors or source_error_flag
-        message_text += out
-        message_text += (
-            "\n--------------------------------------------------------------------\n"
+
+def process_job(
+    config_name,
+    job_config_path=None,
+    config_dir=None,
+    global_config_path=None,
+    args=None,
+):
+    """Handle the directories associated with 'config_name' for backups"""
+    conf = load_job(
+        config_name,
+        job_config_path=job_config_path,
+        config_dir=config_dir,
+        global_config_path=global_config_path,
+        args=args,
+    )
+    return run_job(conf)
+
+
+def run_job(conf):
+    """rsync all the sources of an already loaded (merged) job conf, and report
+    on how it went; returns the results"""
+    from rsyncr import stats
+
+    config_name = conf["job_name"]
+    message_text = f"RsyncR is processing config {config_name}\n"
+
+    refusal, sizes = preflight(conf, [conf])
+    if refusal is not None:
+        send_report(
+            conf,
+            f"RsyncR refused to run config {config_name}; not enough space:\n"
+            + refusal,
+            True,
+            "",
         )
-    if conf["console_override"]:
-        print(message_text)
-    else:
-        # send the output off, but only detailed if there is an error
-        if any_errors:
-            message.send(message_text)
+        return refused_results(conf, "not run: preflight check failed\n")
+
+    # now the directories/sources for sync'ing
+    ctx = RunContext(conf, [conf], header=message_text)
+    ctx.sizes = sizes
+    try:
+        with trace.span("job", job=config_name):
+            results = run_sources(conf, ctx)
+        ctx.job_finished(conf, results)
+    finally:
+        ctx.close()
+    stats.write_metrics([conf], [results])
+    # keep track of whether any of the sources had an error
+    any_errors = any(r["error"] for r in results)
+    message_text += "".join(source_report(r) for r in results)
+
+    how_many = len(conf["sources"].items())
+    send_report(
+        conf,
+        message_text,
+        any_errors,
+        f"RsyncR processed {how_many} sources in config {config_name} without errors"
+        + skipped_note(results),
+    )
+    return results
+
+
+def find_jobs(config_dir=None, patterns=None):
+    """names of the job configs in config_dir that match any of the (glob)
+    patterns, or all of them if there are no patterns; names that aren't
+    patterns are passed through even if there's no such file, so that they fail
+    loudly later on rather than being silently skipped"""
+    if config_dir is None:
+        config_dir = config.DEFAULTS["configs_dir"]
+    found = sorted(
+        os.path.basename(p)[len("config.") : -len(".toml")]
+        for p in glob.glob(os.path.join(config_dir, "config.*.toml"))
+    )
+    if not patterns:
+        return found
+    names = []
+    for pat in patterns:
+        if glob.has_magic(pat):
+            matches = fnmatch.filter(found, pat)
         else:
-            how_many = len(conf["sources"].items())
-            message.send(
-                f"RsyncR processed {how_many} sources in config {config_name} without errors."
-            )
-    if conf["capture_file"]:
-        with open(conf["capture_file"], "w") as f:
-            f.write(message_text)
+            matches = [pat]
+        names.extend(m for m in matches if m not in names)
+    return names
+
+
+def process_fleet(names, config_dir=None, global_config_path=None, args=None):
+    """Run several jobs at once, sharing one global config, one scheduler, and
+    one notification at the end"""
+    from rsyncr import stats
+
+    if config_dir is None:
+        config_dir = config.DEFAULTS["configs_dir"]
+    if global_config_path is None:
+        global_config_path = os.path.join(config_dir, "global.toml")
+
+    # the global config (plus command line) decides how the whole fleet is run
+    gconf = config.make("global", global_config_path)
+    aconf = config.command_line_config(args)
+    fleet_conf = config.merge_configs(gconf, {}, aconf)
+    pool = make_scheduler(fleet_conf)
+
+    confs = []
+    # {name: why} for the jobs whose configs couldn't be loaded
+    broken = {}
+    for name in names:
+        path = os.path.join(config_dir, f"config.{name}.toml")
+        try:
+            jconf = config.make(name, path)
+        except Exception as e:
+            # a broken file shouldn't take down every other job
+            log.error(f"couldn't load {path}: {e}")
+            broken[name] = f"Couldn't load {path}: {e}\n"
+            continue
+        conf = config.merge_configs(gconf, jconf, aconf)
+        conf["job_name"] = name
+        confs.append(conf)
+        # a job that sets its own max_parallel gets held to it inside the fleet
+        if "max_parallel" in jconf:
+            pool.caps[("job", name)] = jconf["max_parallel"]
+
+    refusal, sizes = preflight(fleet_conf, confs)
+    if refusal is not None:
+        send_report(
+            fleet_conf,
+            f"RsyncR refused to run configs {', '.join(names)}; not enough space:\n"
+            + refusal,
+            True,
+            "",
+        )
+        return
+
+    message_text = f"RsyncR is processing configs {', '.join(names)}\n"
+    ctx = RunContext(fleet_conf, confs, header=message_text)
+    ctx.sizes = sizes
+    try:
+        with trace.span("fleet", jobs=len(confs)):
+            grouped = run_fleet(confs, pool, ctx)
+        for conf, results in zip(confs, grouped):
+            ctx.job_finished(conf, results)
+    finally:
+        ctx.close()
+    stats.write_metrics(confs, grouped)
+
+    any_errors = bool(broken)
+    ran = {conf["job_name"]: results for conf, results in zip(confs, grouped)}
+    for name in names:
+        if name in broken:
+            message_text += f"\n==== config {name}: ERRORS ====\n" + broken[name]
+            continue
+        results = ran[name]
+        job_errors = any(r["error"] for r in results)
+        any_errors = any_errors or job_errors
+        message_text += f"\n==== config {name}: "
+        message_text += "ERRORS ====\n" if job_errors else "ok ====\n"
+        message_text += "".join(source_report(r) for r in results)
+
+    how_many = sum(len(c["sources"]) for c in confs)
+    send_report(
+        fleet_conf,
+        message_text,
+        any_errors,
+        f"RsyncR processed {how_many} sources in {len(confs)} configs without errors"
+        + skipped_note([r for results in grouped for r in results]),
+    )
 
 
 def parse_command_line(force_args=None):
@@ -127,7 +1078,14 @@ def parse_command_line(force_args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "config",
-        help="unique job/config name to read for rsync commands. example: mycomp",
+        nargs="*",
+        help="unique job/config name(s) to read for rsync commands. example: mycomp"
+        " -- several names, or a glob like 'web*', runs them all together",
+    )
+    parser.add_argument(
+        "--all",
+        help="run every config.*.toml in the configs dir together",
+        action="store_true",
     )
     parser.add_argument(
         "--job-config-path", help="(optional) what job toml file to use"
@@ -150,27 +1108,109 @@ def parse_command_line(force_args=None):
         action="store_true",
     )
     parser.add_argument("--capture-output", help="Filename to store output")
+    parser.add_argument(
+        "--force",
+        help="rsync every source, even ones that look unchanged",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help="only run the sources that didn't finish last time",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="(optional) write a Chrome trace of where the time went to FILE",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="(optional) run under cProfile (every thread), and write the stats"
+        " to FILE",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="(optional) how many sources to rsync at the same time",
+    )
+
+    args = parser.parse_args(args=force_args)
+    if not args.config and not args.all:
+        parser.error("need a config name, or --all")
+    if args.job_config_path and (args.all or len(args.config) > 1):
+        parser.error("--job-config-path only makes sense with one config")
+    return args
+
+
+# things like 'rsyncr history' that aren't running a job; a job named one of
+# these would need to be run with --job-config-path. Each module has a cli(argv),
+# and is only imported when it's asked for.
+SUBCOMMANDS = {
+    "history": "rsyncr.history",
+    "daemon": "rsyncr.daemon",
+    "plan": "rsyncr.plan",
+    "check": "rsyncr.check",
+    "verify": "rsyncr.verify",
+    "watch": "rsyncr.watch",
+}
+
 
-    return parser.parse_args(args=force_args)
+def wind_down():
+    """what has to happen on the way out, however rsyncr is leaving"""
+    # rsyncs are in sessions of their own, so a ^C doesn't get them
+    output = sys.modules.get("rsyncr.output")
+    if output is not None:
+        output.stop_all()
+    # flush whatever reports are still queued; if nothing was sent, the
+    # notifiers were never loaded
+    message = sys.modules.get("rsyncr.message")
+    if message is not None:
+        message.shutdown()
 
 
-def cli():
+def cli(argv=None):
     """hook for command line access"""
-    args = parse_command_line()
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in SUBCOMMANDS:
+        # the daemon and watch run rsyncs too, and get stopped the same way
+        try:
+            return importlib.import_module(SUBCOMMANDS[argv[0]]).cli(argv[1:])
+        finally:
+            wind_down()
+    args = parse_command_line(argv)
 
     # we need some of this stuff to know how/where to find other configs
-    name = args.config
     jpath = args.job_config_path
     gcfg = args.global_config_path
     cfgdir = args.configs_dir
 
-    process_job(
-        name,
-        job_config_path=jpath,
-        config_dir=cfgdir,
-        global_config_path=gcfg,
-        args=args,
-    )
+    if args.trace:
+        trace.start()
+    if args.profile:
+        trace.profile_start()
+    try:
+        if args.all or len(args.config) > 1 or glob.has_magic(args.config[0]):
+            names = find_jobs(cfgdir, None if args.all else args.config)
+            process_fleet(names, config_dir=cfgdir, global_config_path=gcfg, args=args)
+            return
+
+        name = args.config[0]
+        process_job(
+            name,
+            job_config_path=jpath,
+            config_dir=cfgdir,
+            global_config_path=gcfg,
+            args=args,
+        )
+    finally:
+        wind_down()
+        if args.profile:
+            trace.profile_write(args.profile)
+        if args.trace:
+            trace.write(args.trace)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+"""Run a bunch of rsync sources at the same time, but not *too* many at the same time.
+
+Each task has some keys (which host it reads from, which device it writes to) and
+the scheduler makes sure that no more than N tasks share any one key, and no more
+than max_parallel tasks run overall. Results come back in the order the tasks went
+in, no matter what order they finish in.
+"""
+
+import os
+import logging
+import threading
+
+log = logging.getLogger()
+
+
+def target_device(path):
+    """find the st_dev of the filesystem a target lives on; the target itself might
+    not exist yet (rsync will make it) so walk up until something does"""
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+def is_daemon(location):
+    """whether a location is a module on an rsync daemon, rather than over ssh"""
+    return location.startswith("rsync://")
+
+
+def source_host(location):
+    """the machine part of a source location; 'local' for a plain path"""
+    if location.startswith("/"):
+        return "local"
+    if is_daemon(location):
+        # rsync://[user@]host[:port]/module/path
+        return location[len("rsync://") :].split("/", 1)[0].split(":", 1)[0]
+    return location.split(":", 1)[0]
+
+
+class Scheduler:
+    """A small worker pool; tasks are started in order, skipping over any whose
+    keys are already at their limit, so a busy disk doesn't block an idle one.
+
+    limits is a dict like {"host": 2, "device": 1}; a limit of 0 or None means
+    unlimited for that key. caps is for particular values that need their own
+    limit, like {("host", "pasilla"): 4}, and wins over limits.
+    """
+
+    def __init__(self, max_parallel=1, limits=None, caps=None):
+        self.max_parallel = max(1, int(max_parallel or 1))
+        self.limits = dict(limits or {})
+        self.caps = dict(caps or {})
+        self._cond = threading.Condition()
+        self._pending = []
+        self._busy = {}
+        self._running = 0
+
+    def set_max_parallel(self, n):
+        """change how many tasks can run at once, even while running; lowering it
+        doesn't stop anything, it just holds back what starts next"""
+        with self._cond:
+            self.max_parallel = max(1, int(n))
+            self._cond.notify_all()
+
+    def _limit(self, key, value):
+        if (key, value) in self.caps:
+            return self.caps[(key, value)] or 0
+        return self.limits.get(key) or 0
+
+    def _runnable(self, task):
+        for key, value in task["keys"].items():
+            limit = self._limit(key, value)
+            if limit and value is not None and self._busy.get((key, value), 0) >= limit:
+                return False
+        return True
+
+    def _next_task(self):
+        """called with the lock held; pop the first task we're allowed to start"""
+        if self._running >= self.max_parallel:
+            return None
+        for i, task in enumerate(self._pending):
+            if self._runnable(task):
+                return self._pending.pop(i)
+        return None
+
+    def _claim(self, task, amount):
+        self._running += amount
+        for key, value in task["keys"].items():
+            k = (key, value)
+            self._busy[k] = self._busy.get(k, 0) + amount
+
+    def _worker(self, results):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    if not self._pending:
+                        return
+                    self._cond.wait()
+                    task = self._next_task()
+                self._claim(task, 1)
+            try:
+                results[task["index"]] = task["func"]()
+            except Exception as e:
+                log.exception(f"task {task['index']} blew up")
+                results[task["index"]] = e
+            finally:
+                with self._cond:
+                    self._claim(task, -1)
+                    self._cond.notify_all()
+
+    def run(self, tasks, priorities=None):
+        """tasks is a list of (callable, keys) pairs; returns a list of whatever the
+        callables returned, in the same order as tasks. A task that raises gets
+        its exception in its slot rather than taking down its siblings.
+
+        If given, priorities (one number per task) decides the order tasks get
+        started in, biggest first; otherwise they start in the order given."""
+        results = [None] * len(tasks)
+        self._pending = [
+            {"index": i, "func": func, "keys": dict(keys or {})}
+            for i, (func, keys) in enumerate(tasks)
+        ]
+        if priorities is not None:
+            self._pending.sort(key=lambda t: -priorities[t["index"]])
+        if self.max_parallel == 1:
+            # no sense spinning up threads for the plain old sequential case
+            self._worker(results)
+            return results
+        workers = [
+            threading.Thread(target=self._worker, args=(results,), daemon=True)
+            for _ in range(min(self.max_parallel, len(tasks)))
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return results
@@ -0,0 +1,144 @@
+"""Split a huge source into several rsyncs running side by side.
+
+One rsync walks and sends a tree serially, which is slow for tens of millions of
+small files. With 'shards = N' on a source, rsyncr lists the top level of the
+source, guesses how much work each entry is, and deals the entries out into N
+balanced --files-from lists. The shard rsyncs don't delete anything; one last
+pass with --existing --ignore-existing (so it transfers nothing) does the
+deleting, so the target still ends up an exact mirror.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import subprocess
+
+log = logging.getLogger()
+
+# for balancing, a file costs about as much as this many bytes of data; small
+# files are mostly per-file overhead
+PER_FILE_COST = 64 * 1024
+
+
+def shard_dir(conf):
+    return os.path.join(conf["state_dir"], "shards")
+
+
+def shard_key(d):
+    """a stable name for a source's shard files"""
+    return hashlib.sha1(f"{d['location']}\0{d['target']}".encode()).hexdigest()[:16]
+
+
+def list_entries(location, rsync_command="rsync", rsh=None, extra=()):
+    """the names at the top of a source; asks rsync for remote ones (with extra
+    options, like a daemon's --password-file)"""
+    if location.startswith("/"):
+        return sorted(os.listdir(location))
+    cmd = [rsync_command, "--list-only"] + list(extra)
+    if rsh:
+        cmd.append(f"--rsh={rsh}")
+    cmd.append(location)
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    names = []
+    for line in out.decode("utf-8", errors="surrogateescape").splitlines():
+        # drwxr-xr-x          4,096 2020/01/01 12:00:00 name with spaces
+        parts = line.split(None, 4)
+        if len(parts) == 5 and parts[4] != ".":
+            names.append(parts[4])
+    return sorted(names)
+
+
+def entry_weight(path):
+    """how much work syncing path (and everything under it) is, roughly"""
+    total = 0
+    stack = [path]
+    while stack:
+        p = stack.pop()
+        try:
+            st = os.lstat(p)
+        except OSError:
+            continue
+        total += st.st_size + PER_FILE_COST
+        if os.path.isdir(p) and not os.path.islink(p):
+            try:
+                with os.scandir(p) as it:
+                    stack.extend(e.path for e in it)
+            except OSError:
+                continue
+    return total
+
+
+def estimate(location, names, cache_path=None):
+    """{name: weight} for the top-level entries of a source. Walking the tree is
+    the expensive bit, so weights are cached, and reused for as long as an entry's
+    own mtime hasn't changed; that's only a hint for the deeper levels, but a
+    stale guess just makes the shards a bit lopsided, not wrong. Remote sources
+    aren't walked at all, so their entries are all weighed the same."""
+    if not location.startswith("/"):
+        return {n: 1 for n in names}
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    weights = {}
+    fresh = {}
+    for n in names:
+        path = os.path.join(location, n)
+        try:
+            mtime = os.lstat(path).st_mtime_ns
+        except OSError:
+            continue
+        cached = cache.get(n)
+        if cached and cached[0] == mtime:
+            weights[n] = cached[1]
+        else:
+            weights[n] = entry_weight(path)
+        fresh[n] = [mtime, weights[n]]
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(fresh, f)
+    return weights
+
+
+def pack(weights, n):
+    """deal names out into n bins of about equal total weight; biggest first,
+    each into the lightest bin so far. Empty bins are dropped."""
+    bins = [[] for _ in range(n)]
+    totals = [0] * n
+    for name in sorted(weights, key=lambda k: (-weights[k], k)):
+        i = totals.index(min(totals))
+        bins[i].append(name)
+        totals[i] += weights[name]
+    return [b for b in bins if b]
+
+
+def write_lists(bins, directory, key):
+    """a NUL-separated --files-from list per bin (for --from0); returns paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, names in enumerate(bins):
+        path = os.path.join(directory, f"{key}-{i}.list")
+        with open(path, "wb") as f:
+            for name in names:
+                f.write(os.fsencode(name) + b"\0")
+        paths.append(path)
+    return paths
+
+
+def shard_command(cmdlist, files_from):
+    """turn a source's rsync command into one shard's: just the listed entries,
+    and no deleting"""
+    opts = [a for a in cmdlist[:-2] if not a.startswith("--delete")]
+    # --files-from turns off the recursion that --archive would give us
+    listed = [f"--files-from={files_from}", "--from0", "--recursive"]
+    return opts + listed + cmdlist[-2:]
+
+
+def delete_command(cmdlist):
+    """the last pass: the whole source, but only deleting, never transferring;
+    None if the command doesn't delete anything anyway"""
+    if not any(a.startswith("--delete") for a in cmdlist):
+        return None
+    return cmdlist[:-2] + ["--existing", "--ignore-existing"] + cmdlist[-2:]
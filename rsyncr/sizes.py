@@ -0,0 +1,64 @@
+"""Huge files and tiny files want different rsyncs: 'large_file_threshold'.
+
+A source that mixes a few huge files (VM images, databases) with a great many
+small ones is done badly by one set of flags. Delta transfer is what makes
+updating a 100 GB image cheap, and it's pure overhead on a 2 KB file. With
+large_file_threshold set on a source, it's done as two rsyncs at once:
+
+- files over the threshold, with --inplace --partial and delta transfer, so an
+  update only rewrites the blocks that changed (rather than building a whole
+  new copy next to the old one), and an interrupted one carries on next time
+- everything else, with --whole-file (unless the command already says), and
+  the deleting. Files of every size are in its file list, the big ones just
+  aren't sent, so it only deletes what's really gone from the source
+
+Both show up in the report as the one source.
+"""
+
+import re
+
+from rsyncr import config
+
+SUFFIXES = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+# flags that choose for or against delta transfer
+WHOLE_FILE_FLAGS = ("-W", "--whole-file", "--no-whole-file", "--no-W")
+
+
+def parse_size(value):
+    """a size in bytes, from a number (already bytes) or a string like "1.5G" """
+    if isinstance(value, (int, float)):
+        return int(value)
+    m = re.match(r"^\s*([\d.]+)\s*([kmgt]?)(?:i?b)?\s*$", str(value).lower())
+    if not m:
+        raise config.BadConfig(f"can't make sense of the size {value!r}")
+    return int(float(m.group(1)) * SUFFIXES[m.group(2)])
+
+
+def human(n):
+    for unit in ("", "K", "M", "G"):
+        if n < 1024 or unit == "G":
+            break
+        n /= 1024
+    return f"{n:g}{unit}"
+
+
+def large_command(cmdlist, threshold):
+    """the pass for the files over threshold bytes; no deleting, and no
+    --partial-dir, which rsync won't have with --inplace"""
+    opts = [
+        a
+        for a in cmdlist[:-2]
+        if not a.startswith(("--delete", "--partial-dir"))
+        and a not in WHOLE_FILE_FLAGS
+    ]
+    extra = [f"--min-size={threshold + 1}", "--inplace", "--partial", "--no-whole-file"]
+    return opts + extra + cmdlist[-2:]
+
+
+def small_command(cmdlist, threshold):
+    """the pass for everything else, which does the deleting too"""
+    extra = [f"--max-size={threshold}"]
+    if not any(a in WHOLE_FILE_FLAGS for a in cmdlist):
+        extra.append("--whole-file")
+    return cmdlist[:-2] + extra + cmdlist[-2:]
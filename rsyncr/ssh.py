@@ -0,0 +1,152 @@
+"""Share ssh connections between all the rsyncs that go to the same host.
+
+Without this, every source on a remote host pays for its own TCP + ssh handshake.
+With it, rsyncr opens a ControlMaster connection per host (or a few, see
+ssh_pool_size) the first time a host is needed, points each rsync at it with
+'--rsh', and shuts the masters down when the job or fleet is done. A host whose
+master can't be opened (or takes too long about it) just gets plain ssh, and
+doesn't hold up the first contact with any other host.
+"""
+
+import os
+import shlex
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+
+log = logging.getLogger()
+
+# seconds for ssh to connect, and for a master to be up and running
+CONNECT_TIMEOUT = 15
+OPEN_TIMEOUT = 30
+
+
+class SSHPool:
+    """ControlMaster connections, opened on demand, one set per host"""
+
+    def __init__(self, ssh_command="ssh", size=1, sizes=None):
+        self.ssh_command = shlex.split(ssh_command)
+        self.size = max(1, int(size or 1))
+        self.sizes = dict(sizes or {})
+        self._lock = threading.Lock()
+        # one per host, so opening masters to one doesn't wait on another
+        self._host_locks = {}
+        self._dir = None
+        # host -> list of control paths that came up ok ([] if none did)
+        self._masters = {}
+        # host -> how many rsh's have been handed out, for round-robin
+        self._handed_out = {}
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(conf["ssh_command"], conf["ssh_pool_size"], conf["ssh_pool_sizes"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _control_path(self, host, i):
+        # unix socket paths have to be short, so don't use the host name directly
+        digest = hashlib.sha1(host.encode()).hexdigest()[:10]
+        return os.path.join(self._dir, f"{digest}-{i}")
+
+    def _open(self, host):
+        """start the masters for one host; returns the control paths of the
+        ones that came up. Called with the host's lock held"""
+        with self._lock:
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix="rsyncr-ssh-")
+        paths = []
+        for i in range(self.sizes.get(host) or self.size):
+            path = self._control_path(host, i)
+            cmd = self.ssh_command + [
+                "-M",
+                "-N",
+                "-f",
+                "-o",
+                "ControlMaster=yes",
+                "-o",
+                f"ControlPath={path}",
+                "-o",
+                "ControlPersist=yes",
+                # nobody's there to type a password, and a dead host shouldn't
+                # take forever to say so
+                "-o",
+                "BatchMode=yes",
+                "-o",
+                f"ConnectTimeout={CONNECT_TIMEOUT}",
+                host,
+            ]
+            log.debug(f"opening ssh master: {cmd}")
+            try:
+                proc = subprocess.run(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    timeout=OPEN_TIMEOUT,
+                )
+            except (OSError, subprocess.TimeoutExpired) as e:
+                log.warning(f"couldn't open ssh master {i} to {host}: {e}")
+                continue
+            if proc.returncode == 0:
+                paths.append(path)
+            else:
+                err = proc.stderr.decode(errors="replace").strip()
+                log.warning(f"couldn't open ssh master {i} to {host}: {err}")
+        if not paths:
+            log.warning(f"no ssh masters for {host}, rsync will use plain ssh")
+        return paths
+
+    def rsh(self, host):
+        """the '--rsh' string to use for an rsync to host; plain ssh_command if
+        there's no master to share"""
+        with self._lock:
+            lock = self._host_locks.setdefault(host, threading.Lock())
+        with lock:
+            with self._lock:
+                opened = host in self._masters
+            if not opened:
+                paths = self._open(host)
+                with self._lock:
+                    self._masters[host] = paths
+                    self._handed_out[host] = 0
+            with self._lock:
+                paths = self._masters[host]
+                if not paths:
+                    return " ".join(shlex.quote(a) for a in self.ssh_command)
+                path = paths[self._handed_out[host] % len(paths)]
+                self._handed_out[host] += 1
+        return " ".join(
+            shlex.quote(a)
+            for a in self.ssh_command
+            + ["-o", "ControlMaster=no", "-o", f"ControlPath={path}"]
+        )
+
+    def close(self):
+        """tell every master to exit, and tidy up the socket dir"""
+        with self._lock:
+            for host, paths in self._masters.items():
+                for path in paths:
+                    cmd = self.ssh_command + [
+                        "-o",
+                        f"ControlPath={path}",
+                        "-O",
+                        "exit",
+                        host,
+                    ]
+                    subprocess.run(
+                        cmd,
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+            self._masters = {}
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
@@ -0,0 +1,257 @@
+"""Pull numbers out of rsync's output, and write them somewhere graphable.
+
+rsyncr asks rsync for --stats (and, optionally, --itemize-changes), and feeds each
+line of output through a StatsParser as it streams past, so even a run that
+itemizes millions of files is counted in one pass without keeping the lines.
+The numbers end up in a TransferStats, and from there in a Prometheus textfile
+(for node_exporter's textfile collector) and a JSON summary.
+"""
+
+import os
+import re
+import json
+import time
+from dataclasses import dataclass, field, asdict
+
+# the summary rsync prints at the end of a run (always with --verbose or --stats):
+# sent 1,234 bytes  received 56 bytes  2,580.00 bytes/sec
+TOTALS_RE = re.compile(r"sent ([\d,.]+) bytes\s+received ([\d,.]+) bytes")
+SPEEDUP_RE = re.compile(r"total size is ([\d,.]+)\s+speedup is ([\d,.]+)")
+# the --stats block; 'label: number' lines
+STATS_RE = re.compile(r"^([A-Z][A-Za-z ]+): ([\d,.]+)")
+STATS_FIELDS = {
+    "Number of files": "files",
+    "Number of created files": "files_created",
+    "Number of deleted files": "files_deleted",
+    "Number of regular files transferred": "files_transferred",
+    "Total file size": "total_file_size",
+    "Total transferred file size": "transferred_file_size",
+    "Literal data": "literal_data",
+    "Matched data": "matched_data",
+    "File list size": "file_list_size",
+    "Total bytes sent": "bytes_sent",
+    "Total bytes received": "bytes_received",
+}
+# --itemize-changes lines look like '>f.st...... some/file' or '*deleting   file'
+ITEMIZE_RE = re.compile(r"^([<>ch.])([fdLDS])([^ ]{7,9}) ")
+
+
+def to_int(number):
+    """rsync puts commas (or dots, depending on locale) in its numbers"""
+    return int(re.sub(r"[,.]", "", number))
+
+
+def to_float(number):
+    """the few non-integer numbers rsync prints, like '9,282.46' or '9.282,46';
+    the last separator is the decimal point"""
+    point = max(number.rfind("."), number.rfind(","))
+    if point < 0:
+        return float(number)
+    return float(re.sub(r"[,.]", "", number[:point]) + "." + number[point + 1 :])
+
+
+@dataclass
+class TransferStats:
+    """What one rsync run did, as far as its output says. Anything rsync didn't
+    report stays None."""
+
+    files: int = None
+    files_created: int = None
+    files_deleted: int = None
+    files_transferred: int = None
+    total_file_size: int = None
+    transferred_file_size: int = None
+    literal_data: int = None
+    matched_data: int = None
+    file_list_size: int = None
+    bytes_sent: int = None
+    bytes_received: int = None
+    speedup: float = None
+    # counted from --itemize-changes, if it was on
+    itemized: dict = field(default_factory=dict)
+
+    def as_dict(self):
+        return asdict(self)
+
+
+class StatsParser:
+    """Feed it rsync's output a line at a time (it's a sink, see output.py), then
+    look at .stats"""
+
+    def __init__(self):
+        self.stats = TransferStats()
+
+    def __call__(self, line):
+        self.feed(line)
+
+    def feed(self, line):
+        s = self.stats
+        if line.startswith("*deleting "):
+            s.itemized["deleted"] = s.itemized.get("deleted", 0) + 1
+            return
+        m = ITEMIZE_RE.match(line)
+        if m:
+            if m.group(1) in "<>":
+                kind = "transferred"
+            elif m.group(1) == "c":
+                kind = "created"
+            elif m.group(1) == "h":
+                kind = "hardlinked"
+            else:
+                kind = "changed"
+            s.itemized[kind] = s.itemized.get(kind, 0) + 1
+            return
+        m = STATS_RE.match(line)
+        if m and m.group(1) in STATS_FIELDS:
+            setattr(s, STATS_FIELDS[m.group(1)], to_int(m.group(2)))
+            return
+        m = TOTALS_RE.match(line)
+        if m:
+            # only fill these in if the --stats block didn't already
+            if s.bytes_sent is None:
+                s.bytes_sent = to_int(m.group(1))
+            if s.bytes_received is None:
+                s.bytes_received = to_int(m.group(2))
+            return
+        m = SPEEDUP_RE.match(line)
+        if m:
+            if s.total_file_size is None:
+                s.total_file_size = to_int(m.group(1))
+            s.speedup = to_float(m.group(2))
+
+
+def combine(many):
+    """add up the TransferStats of several rsyncs that together did one job"""
+    total = TransferStats()
+    for s in many:
+        for name in STATS_FIELDS.values():
+            value = getattr(s, name)
+            if value is not None:
+                setattr(total, name, (getattr(total, name) or 0) + value)
+        for kind, count in s.itemized.items():
+            total.itemized[kind] = total.itemized.get(kind, 0) + count
+    return total
+
+
+def parse(text):
+    """TransferStats from a chunk of rsync output"""
+    parser = StatsParser()
+    for line in text.splitlines():
+        parser.feed(line)
+    return parser.stats
+
+
+def metrics_paths(conf):
+    """where the .prom and .json files go: next to capture_file, unless
+    metrics_file says where the .prom goes"""
+    prom = conf.get("metrics_file")
+    base = None
+    if conf["capture_file"]:
+        base = os.path.splitext(conf["capture_file"])[0]
+    if prom is None and base is not None:
+        prom = base + ".prom"
+    summary = base + ".json" if base is not None else None
+    return prom, summary
+
+
+def _atomic_write(path, text):
+    # node_exporter may read the file at any moment, so never let it see half
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+PROM_METRICS = [
+    ("success", "1 if the source's rsync exited cleanly", None),
+    ("duration_seconds", "how long the source's rsync took", None),
+    ("last_run_timestamp_seconds", "when the source's rsync finished", None),
+    ("files", "files rsync looked at", "files"),
+    ("files_created", "files created on the target", "files_created"),
+    ("files_deleted", "files deleted from the target", "files_deleted"),
+    ("files_transferred", "regular files transferred", "files_transferred"),
+    ("total_file_size_bytes", "size of all files in the source", "total_file_size"),
+    (
+        "transferred_file_size_bytes",
+        "size of the files that were transferred",
+        "transferred_file_size",
+    ),
+    ("literal_data_bytes", "data sent that wasn't already there", "literal_data"),
+    ("matched_data_bytes", "data the delta algorithm didn't resend", "matched_data"),
+    ("sent_bytes", "bytes rsync sent", "bytes_sent"),
+    ("received_bytes", "bytes rsync received", "bytes_received"),
+    ("speedup", "rsync's own speedup figure", "speedup"),
+]
+
+
+def _prom_value(name, attr, row):
+    if attr is not None:
+        return getattr(row["stats"], attr)
+    if name == "success":
+        return 0 if row["error"] else 1
+    if name == "duration_seconds" and row.get("started") is not None:
+        return row["finished"] - row["started"]
+    if name == "last_run_timestamp_seconds":
+        return row.get("finished")
+    return None
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prom_text(rows):
+    """the node_exporter textfile format for a list of (job, result) pairs"""
+    lines = []
+    for name, help_text, attr in PROM_METRICS:
+        metric = f"rsyncr_source_{name}"
+        samples = []
+        for job, result in rows:
+            value = _prom_value(name, attr, result)
+            if value is None:
+                continue
+            labels = f'job="{_label(job)}",source="{_label(result["name"])}"'
+            samples.append(f"{metric}{{{labels}}} {value}")
+        if samples:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def summary_json(rows):
+    """a JSON summary for a list of (job, result) pairs"""
+    out = {"generated": time.time(), "sources": []}
+    for job, result in rows:
+        out["sources"].append(
+            {
+                "job": job,
+                "source": result["name"],
+                "location": result["location"],
+                "target": result["target"],
+                "returncode": result["returncode"],
+                "error": result["error"],
+                "started": result.get("started"),
+                "finished": result.get("finished"),
+                "stats": result["stats"].as_dict(),
+            }
+        )
+    return json.dumps(out, indent=2)
+
+
+def write_metrics(confs, grouped):
+    """write the .prom/.json files for a run; jobs that share a capture_file (or
+    metrics_file) share the files too"""
+    by_path = {}
+    for conf, results in zip(confs, grouped):
+        prom, summary = metrics_paths(conf)
+        rows = [(conf.get("job_name"), r) for r in results]
+        if prom:
+            by_path.setdefault((prom, "prom"), []).extend(rows)
+        if summary:
+            by_path.setdefault((summary, "json"), []).extend(rows)
+    for (path, kind), rows in by_path.items():
+        if kind == "prom":
+            _atomic_write(path, prom_text(rows))
+        else:
+            _atomic_write(path, summary_json(rows))
@@ -0,0 +1,165 @@
+"""Where does the time go? Timed spans, written out as a Chrome trace.
+
+'rsyncr --trace FILE <config>' records a span for each phase of a run (reading
+and merging configs, building commands, each rsync, sending reports), along
+with what each rsync process used (CPU time, peak memory, blocks read and
+written, from wait4), and writes them to FILE in the Chrome trace-event format;
+open it in chrome://tracing or https://ui.perfetto.dev. Sources running at once
+show up as separate threads.
+
+When tracing is off (which is always, unless asked for), a span costs next to
+nothing.
+
+'rsyncr --profile FILE <config>' runs under cProfile instead: a profiler for
+each thread (the sources running at once each have one, and that's where the
+rsync output gets read and parsed), all added up into the one FILE for pstats
+or snakeviz.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+_events = None
+_threads = {}
+_lock = threading.Lock()
+_t0 = 0
+_profilers = None
+
+
+def start():
+    """start recording spans"""
+    global _events, _t0
+    with _lock:
+        _events = []
+        _threads.clear()
+        _t0 = time.perf_counter()
+
+
+def enabled():
+    return _events is not None
+
+
+@contextmanager
+def span(name, cat="rsyncr", **args):
+    """time the 'with' block; yields a dict of args for the span, which the
+    block can add to"""
+    if _events is None:
+        yield args
+        return
+    began = time.perf_counter()
+    try:
+        yield args
+    finally:
+        ended = time.perf_counter()
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (began - _t0) * 1e6,
+            "dur": (ended - began) * 1e6,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": {
+                k: v if isinstance(v, (int, float)) else str(v)
+                for k, v in args.items()
+            },
+        }
+        with _lock:
+            if _events is not None:
+                _events.append(event)
+                _threads[thread.ident] = thread.name
+
+
+def traced(name):
+    """decorator: a span around every call of the function"""
+
+    def wrap(f):
+        @functools.wraps(f)
+        def inner(*args, **kwargs):
+            if _events is None:
+                return f(*args, **kwargs)
+            with span(name):
+                return f(*args, **kwargs)
+
+        return inner
+
+    return wrap
+
+
+def rusage(ru):
+    """the interesting bits of a resource.struct_rusage"""
+    return {
+        "cpu_user_s": ru.ru_utime,
+        "cpu_system_s": ru.ru_stime,
+        # kilobytes, on linux
+        "max_rss_kb": ru.ru_maxrss,
+        # in 512 byte blocks
+        "blocks_in": ru.ru_inblock,
+        "blocks_out": ru.ru_oublock,
+    }
+
+
+def _profile_thread(*args):
+    """threading.setprofile hook: the first thing a new thread does is start its
+    own profiler (which takes over from this hook)"""
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # python 3.12+: there's only one profiler at a time, and it sees every
+        # thread already; take this hook off, or it's back for every call
+        sys.setprofile(None)
+        return
+    with _lock:
+        if _profilers is not None:
+            _profilers.append(profiler)
+
+
+def profile_start():
+    """start profiling this thread, and every thread started from now on"""
+    global _profilers
+    with _lock:
+        _profilers = []
+    if sys.version_info < (3, 12):
+        # from 3.12 the one profiler covers every thread by itself
+        threading.setprofile(_profile_thread)
+    _profile_thread()
+
+
+def profile_write(path):
+    """stop profiling, and write the stats of every thread to path"""
+    import pstats
+
+    global _profilers
+    threading.setprofile(None)
+    with _lock:
+        profilers, _profilers = _profilers or [], None
+    # the one for this thread; any threads still going are left be
+    profilers[0].disable()
+    stats = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    stats.dump_stats(path)
+
+
+def write(path):
+    """stop recording, and write what was recorded to path"""
+    global _events
+    with _lock:
+        events, _events = _events or [], None
+        threads = dict(_threads)
+    pid = os.getpid()
+    meta = [
+        {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": n}}
+        for tid, n in threads.items()
+    ]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f)
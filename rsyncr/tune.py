@@ -0,0 +1,194 @@
+"""Pick transfer flags to suit each source's link, with 'auto_tune'.
+
+The same global_rsync_params go to every source, but what's quickest depends on
+where the data is coming from:
+
+- local to local, rsync's delta algorithm only costs CPU (reading both files to
+  save writing some of one), so --whole-file is quicker
+- over a slow link, compression pays; zstd where both ends have it, lz4 for a
+  middling link, plain -z for an old rsync
+- over a fast link, compression just gets in the way, so nothing
+
+Remote hosts get probed (over ssh): the round trip time, the throughput of a
+small sample of incompressible data, and what rsync version, compression and
+checksum algorithms the far end has. Probes are cached in state_dir/tune.json
+for tune_ttl seconds. Anything set explicitly (like -z, --compress-choice or
+--whole-file in the rsync params) wins over what tuning would pick.
+"""
+
+import os
+import re
+import json
+import time
+import shlex
+import logging
+import threading
+import subprocess
+
+from rsyncr import schedule
+
+log = logging.getLogger()
+
+SAMPLE_BYTES = 4 << 20
+
+# bytes/second; above FAST, compression costs more than it saves, and below SLOW,
+# it's worth zstd's extra CPU to squeeze as hard as possible
+FAST = 40e6
+SLOW = 5e6
+
+# flags that mean someone already decided, so tuning leaves that choice alone
+COMPRESS_FLAGS = ("-z", "--compress", "--compress-choice", "--zc", "--no-compress")
+WHOLE_FILE_FLAGS = ("-W", "--whole-file", "--no-whole-file", "--no-W")
+
+
+def parse_version(text):
+    """{"version", "compress", "checksum"} from the output of 'rsync --version';
+    the lists are empty for an rsync too old to say (before 3.2)"""
+    found = {"version": None, "compress": [], "checksum": []}
+    m = re.search(r"version\s+v?(\d+\.\d+\.\d+)", text)
+    if m:
+        found["version"] = m.group(1)
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        for key in ("compress", "checksum"):
+            if line.strip() == f"{key.title()} list:" and i + 1 < len(lines):
+                # '    xxh128 xxh3 xxh64 (xxhash) md5 md4 none'
+                found[key] = [w for w in lines[i + 1].split() if w[0] != "("]
+    return found
+
+
+def _timed(cmd, timeout=60):
+    started = time.monotonic()
+    out = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        timeout=timeout,
+        check=True,
+    ).stdout
+    return out, time.monotonic() - started
+
+
+def probe_local(rsync_command="rsync"):
+    """what the rsync here can do"""
+    out, _ = _timed([rsync_command, "--version"])
+    return parse_version(out.decode(errors="replace"))
+
+
+def probe_host(host, ssh_command="ssh"):
+    """time the link to host and ask its rsync what it can do; ssh_command can
+    be a shared connection's --rsh"""
+    ssh = shlex.split(ssh_command) + [host]
+    # with a shared (already open) connection this is about one round trip; a
+    # fresh one includes the handshake, so take the quicker of two
+    rtt = min(_timed(ssh + ["true"])[1] for _ in range(2))
+    out, _ = _timed(ssh + ["rsync", "--version"])
+    found = parse_version(out.decode(errors="replace"))
+    data, took = _timed(ssh + [f"head -c {SAMPLE_BYTES} /dev/urandom"])
+    found["rtt"] = rtt
+    found["throughput"] = len(data) / max(took - rtt, 1e-3)
+    return found
+
+
+def choose(location, remote=None, local=None):
+    """the flags for a source, from what the probes found"""
+    if schedule.source_host(location) == "local":
+        return ["--whole-file"]
+    if schedule.is_daemon(location):
+        # no ssh to probe with; daemons are for fast, trusted links anyway
+        return []
+    if not remote:
+        return []
+    throughput = remote.get("throughput") or 0
+    if throughput >= FAST:
+        return []
+    both = set(remote["compress"]) & set((local or {}).get("compress", []))
+    if throughput < SLOW and "zstd" in both:
+        return ["-z", "--compress-choice=zstd"]
+    if "lz4" in both:
+        return ["-z", "--compress-choice=lz4"]
+    if "zstd" in both:
+        return ["-z", "--compress-choice=zstd"]
+    return ["-z"]
+
+
+def drop_overridden(flags, command):
+    """leave out the tuned flags for any choice the command already makes"""
+    def has(names):
+        return any(a == n or a.startswith(n + "=") for a in command for n in names)
+
+    keep = []
+    for f in flags:
+        if f in ("-z", "--compress-choice=zstd", "--compress-choice=lz4"):
+            if has(COMPRESS_FLAGS):
+                continue
+        elif f in WHOLE_FILE_FLAGS and has(WHOLE_FILE_FLAGS):
+            continue
+        keep.append(f)
+    return keep
+
+
+class Tuner:
+    """Probe results for the hosts in a run, from the cache when they're fresh
+    enough; safe to share between threads, and a host being probed by one
+    source isn't probed again by another at the same time"""
+
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._probes = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._probes = json.load(f)
+            except ValueError:
+                pass
+
+    def _fresh(self, key):
+        p = self._probes.get(key)
+        if p and time.time() - p["probed"] < self.ttl:
+            return p
+        return None
+
+    def get(self, key, probe):
+        """the cached probe for key (a host, or 'local'), or probe() if it's
+        stale; None if probing fails"""
+        with self._lock:
+            lock = self._host_locks.setdefault(key, threading.Lock())
+        with lock:
+            with self._lock:
+                found = self._fresh(key)
+            if found is not None:
+                return found
+            try:
+                found = probe()
+            except (OSError, subprocess.SubprocessError) as e:
+                log.warning(f"couldn't probe {key} for tuning: {e}")
+                return None
+            found["probed"] = time.time()
+            with self._lock:
+                self._probes[key] = found
+                self._save()
+            return found
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self._probes, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.debug(f"couldn't save tuning probes: {e}")
+
+    def flags(self, conf, source_name, rsh=None):
+        """the tuned flags for a source"""
+        location = conf["sources"][source_name]["location"]
+        host = schedule.source_host(location)
+        if host == "local" or schedule.is_daemon(location):
+            return choose(location)
+        local = self.get("local", lambda: probe_local(conf["rsync_command"]))
+        remote = self.get(host, lambda: probe_host(host, rsh or conf["ssh_command"]))
+        return choose(location, remote, local)
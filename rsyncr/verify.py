@@ -0,0 +1,269 @@
+"""'rsyncr verify <config>': check that the targets really match the sources.
+
+rsync's quick check trusts size and mtime. This hashes both sides (local sources
+only) to prove the copies are good, without paying for --checksum every night:
+hashes are kept in a sqlite cache keyed on (path, inode, size, mtime_ns), so
+only files that changed since the last verify get read again. The reading is
+done by a pool of worker processes, in big chunks.
+"""
+
+import os
+import sys
+import stat
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from rsyncr import run
+from rsyncr import filters
+
+log = logging.getLogger()
+
+CHUNK = 1 << 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    inode INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    digest TEXT
+);
+"""
+
+
+def hash_file(path, chunk=CHUNK):
+    """(path, hex digest, bytes read, seconds taken); digest is None if the file
+    couldn't be read"""
+    started = time.monotonic()
+    h = hashlib.blake2b()
+    done = 0
+    try:
+        with open(path, "rb", buffering=0) as f:
+            buf = bytearray(chunk)
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                h.update(view[:n])
+                done += n
+    except OSError as e:
+        log.warning(f"couldn't read {path}: {e}")
+        return path, None, done, time.monotonic() - started
+    return path, h.hexdigest(), done, time.monotonic() - started
+
+
+def walk(root, excluded):
+    """{relative path: stat} of everything under root, minus the excludes"""
+    found = {}
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, rel)) as it:
+                entries = list(it)
+        except OSError as e:
+            log.warning(f"couldn't read {os.path.join(root, rel)}: {e}")
+            continue
+        for e in entries:
+            relpath = f"{rel}/{e.name}" if rel else e.name
+            is_dir = e.is_dir(follow_symlinks=False)
+            if excluded(relpath, is_dir):
+                continue
+            if is_dir:
+                stack.append(relpath)
+            else:
+                try:
+                    found[relpath] = e.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+    return found
+
+
+class HashCache:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.executescript(SCHEMA)
+
+    def get(self, path, st):
+        row = self._db.execute(
+            "SELECT inode, size, mtime_ns, digest FROM hashes WHERE path = ?", (path,)
+        ).fetchone()
+        if row and tuple(row[:3]) == (st.st_ino, st.st_size, st.st_mtime_ns):
+            return row[3]
+        return None
+
+    def put_many(self, rows):
+        """rows of (path, stat, digest)"""
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                [
+                    (p, st.st_ino, st.st_size, st.st_mtime_ns, digest)
+                    for p, st, digest in rows
+                ],
+            )
+
+    def close(self):
+        self._db.close()
+
+
+def digests(root, files, cache, pool, stats):
+    """{relpath: digest} for regular files, from the cache where it's still good;
+    symlinks 'hash' to where they point"""
+    out = {}
+    todo = {}
+    for rel, st in files.items():
+        path = os.path.join(root, rel)
+        if stat.S_ISLNK(st.st_mode):
+            out[rel] = "link:" + os.readlink(path)
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        cached = cache.get(path, st)
+        if cached is not None:
+            out[rel] = cached
+            stats["cached"] += 1
+        else:
+            todo[path] = (rel, st)
+    fresh = []
+    for path, digest, done, took in pool.map(hash_file, todo, chunksize=16):
+        rel, st = todo[path]
+        out[rel] = digest
+        stats["hashed"] += 1
+        stats["bytes"] += done
+        stats["hash_seconds"] += took
+        if took > 0 and done:
+            rate = done / took / 1e6
+            stats["rates"].append((rate, path))
+            log.debug(f"{path}: {rate:.1f} MB/s")
+        if digest is not None:
+            fresh.append((path, st, digest))
+    cache.put_many(fresh)
+    return out
+
+
+def target_root(d):
+    """where a source's files end up: like rsync, "/a/b" goes to target/b, and
+    "/a/b/" straight into target"""
+    if d["location"].endswith("/"):
+        return d["target"]
+    return os.path.join(d["target"], os.path.basename(d["location"]))
+
+
+def verify_source(conf, source_name, cache, pool):
+    """compare one local source with its target; returns (mismatches, stats)"""
+    d = conf["sources"][source_name]
+    excluded = filters.matcher(filters.compile_excludes(conf, source_name))
+    stats = {
+        "cached": 0,
+        "hashed": 0,
+        "bytes": 0,
+        "hash_seconds": 0.0,
+        "rates": [],
+        "started": time.monotonic(),
+    }
+    root = target_root(d)
+    src = walk(d["location"], excluded)
+    dst = walk(root, excluded)
+    mismatches = []
+    for rel in sorted(set(src) - set(dst)):
+        mismatches.append(("missing", rel))
+    for rel in sorted(set(dst) - set(src)):
+        mismatches.append(("extra", rel))
+    same_size = {}
+    for rel in sorted(set(src) & set(dst)):
+        if stat.S_ISREG(src[rel].st_mode) and src[rel].st_size != dst[rel].st_size:
+            mismatches.append(("size", rel))
+        else:
+            same_size[rel] = src[rel]
+    a = digests(d["location"], same_size, cache, pool, stats)
+    b = digests(root, {r: dst[r] for r in same_size}, cache, pool, stats)
+    for rel in sorted(a):
+        if a[rel] is None or b.get(rel) is None:
+            mismatches.append(("unreadable", rel))
+        elif a[rel] != b.get(rel):
+            mismatches.append(("content", rel))
+    stats["seconds"] = time.monotonic() - stats.pop("started")
+    stats["files"] = len(src)
+    stats["per_file"] = per_file(stats.pop("rates"))
+    return mismatches, stats
+
+
+def per_file(rates):
+    """what the per-file hashing rates (MB/s, path) came to, for the report"""
+    if not rates:
+        return None
+    rates.sort()
+    return {
+        "slowest": rates[0][0],
+        "slowest_path": rates[0][1],
+        "median": rates[len(rates) // 2][0],
+        "fastest": rates[-1][0],
+    }
+
+
+def format_verify(source_name, mismatches, stats):
+    rate = stats["bytes"] / stats["seconds"] / 1e6 if stats["seconds"] else 0
+    lines = [
+        f"Source {source_name}: {stats['files']} files, {len(mismatches)} mismatches;"
+        f" hashed {stats['hashed']} ({stats['bytes'] / 1e6:.1f} MB at {rate:.1f} MB/s),"
+        f" {stats['cached']} from cache, {stats['seconds']:.1f}s"
+    ]
+    pf = stats.get("per_file")
+    if pf:
+        lines.append(
+            f"  per file: {pf['median']:.1f} MB/s median, {pf['fastest']:.1f} fastest,"
+            f" {pf['slowest']:.1f} slowest ({pf['slowest_path']})"
+        )
+    for kind, rel in mismatches:
+        lines.append(f"  {kind:10} {rel}")
+    return "\n".join(lines)
+
+
+def cli(argv):
+    """'rsyncr verify <config>': hash sources and targets and compare them"""
+    parser = argparse.ArgumentParser(prog="rsyncr verify")
+    parser.add_argument("config", help="job/config name to verify")
+    parser.add_argument("--source", help="(optional) only verify this source")
+    parser.add_argument(
+        "--job-config-path", help="(optional) what job toml file to use"
+    )
+    parser.add_argument("--configs-dir", help="(optional) where to look for toml files")
+    parser.add_argument(
+        "--global-config-path", help="(optional) override global config settings"
+    )
+    parser.add_argument(
+        "--workers", type=int, help="how many processes to hash with (default: cpus)"
+    )
+    args = parser.parse_args(argv)
+
+    conf = run.load_job(
+        args.config,
+        job_config_path=args.job_config_path,
+        config_dir=args.configs_dir,
+        global_config_path=args.global_config_path,
+    )
+    cache = HashCache(os.path.join(conf["state_dir"], "hashes.sqlite"))
+    bad = 0
+    try:
+        with ProcessPoolExecutor(args.workers) as pool:
+            for n, d in conf["sources"].items():
+                if args.source and n != args.source:
+                    continue
+                if not d["location"].startswith("/"):
+                    print(f"Source {n}: remote, can't verify it")
+                    continue
+                mismatches, stats = verify_source(conf, n, cache, pool)
+                bad += len(mismatches)
+                print(format_verify(n, mismatches, stats))
+    finally:
+        cache.close()
+    if bad:
+        sys.exit(1)
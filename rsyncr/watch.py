@@ -0,0 +1,331 @@
+"""'rsyncr watch <config>': keep local sources mirrored as they change.
+
+Rather than rescanning whole trees, this puts inotify watches on every directory
+of a job's local sources and collects the paths that change. Every
+watch_batch_seconds (or sooner, once watch_batch_size paths are waiting) the
+batch goes to rsync with --files-from, so only those paths are looked at;
+anything in the batch that's gone from the source is deleted from the target
+(--delete-missing-args). The job's excludes are applied to the events before
+they're batched, and excluded directories aren't watched at all.
+
+inotify can miss things: its queue can overflow, and there's a limit on the
+number of watches (fs.inotify.max_user_watches). So a normal, full run of each
+source is done at the start, every watch_reconcile seconds after, and straight
+away when the queue overflows.
+
+Linux only; inotify is used directly (via ctypes), so there's nothing to install.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import logging
+import argparse
+
+from rsyncr import filters
+from rsyncr import governor
+from rsyncr import run
+
+log = logging.getLogger()
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+
+EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """a thin wrapper around the inotify syscalls"""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"inotify_init1: {os.strerror(e)}")
+
+    def add(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"inotify_add_watch {path}: {os.strerror(e)}")
+        return wd
+
+    def read(self, timeout):
+        """[(wd, mask, name)] for whatever happened, waiting up to timeout
+        seconds for something to"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 20)
+        except BlockingIOError:
+            return []
+        events = []
+        i = 0
+        while i < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, i)
+            i += EVENT.size
+            name = os.fsdecode(data[i : i + length].rstrip(b"\0"))
+            i += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch_command(cmdlist, files_from):
+    """a source's command, cut down to just the listed paths; the deleting is
+    done by --delete-missing-args, as --delete needs recursion"""
+    opts = [a for a in cmdlist[:-2] if not a.startswith("--delete")]
+    return (
+        opts
+        + [
+            f"--files-from={files_from}",
+            "--from0",
+            "--ignore-missing-args",
+            "--delete-missing-args",
+            # so a deleted directory goes even if it's not empty on the target
+            "--force",
+        ]
+        + cmdlist[-2:]
+    )
+
+
+class Watcher:
+    def __init__(self, conf):
+        self.conf = conf
+        self.sources = {}
+        for n, d in conf["sources"].items():
+            if d["location"].startswith("/"):
+                self.sources[n] = d
+            else:
+                log.warning(f"{n} isn't local, so it can't be watched")
+        self.excluded = {
+            n: filters.matcher(filters.compile_excludes(conf, n)) for n in self.sources
+        }
+        self.inotify = Inotify()
+        # wd: (source name, directory relative to the source)
+        self.watches = {}
+        # source name: set of relative paths
+        self.pending = {n: set() for n in self.sources}
+        self.first_pending = None
+        self.reconcile_at = 0
+        self.stopping = False
+        self.ctx = None
+
+    def watch_tree(self, source_name, rel=""):
+        """watch a directory and everything under it; returns the paths in it,
+        since anything in a new directory is new too"""
+        root = self.sources[source_name]["location"]
+        found = []
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            try:
+                wd = self.inotify.add(os.path.join(root, rel))
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    log.error(
+                        "out of inotify watches (see fs.inotify.max_user_watches);"
+                        " relying on reconciling for the rest"
+                    )
+                    self.reconcile_at = 0
+                    return found
+                # gone already, most likely
+                continue
+            self.watches[wd] = (source_name, rel)
+            try:
+                with os.scandir(os.path.join(root, rel)) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for e in entries:
+                relpath = f"{rel}/{e.name}" if rel else e.name
+                is_dir = e.is_dir(follow_symlinks=False)
+                if self.excluded[source_name](relpath, is_dir):
+                    continue
+                found.append(relpath)
+                if is_dir:
+                    stack.append(relpath)
+        return found
+
+    def handle(self, events, now=None):
+        """sort events into the pending batches"""
+        now = time.monotonic() if now is None else now
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                log.warning("inotify queue overflowed; reconciling")
+                self.reconcile_at = 0
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+            source_name, rel = self.watches[wd]
+            relpath = f"{rel}/{name}" if rel else name
+            is_dir = bool(mask & IN_ISDIR)
+            if self.excluded[source_name](relpath, is_dir):
+                continue
+            if is_dir and mask & IN_MOVED_FROM:
+                # the watches under it follow it to wherever it went; if that's
+                # in the tree, they get picked up again there
+                under = relpath + "/"
+                for w, (s, r) in list(self.watches.items()):
+                    if s == source_name and (r == relpath or r.startswith(under)):
+                        del self.watches[w]
+            batch = self.pending[source_name]
+            batch.add(relpath)
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                batch.update(self.watch_tree(source_name, relpath))
+            if self.first_pending is None:
+                self.first_pending = now
+
+    def batch_due(self, now):
+        if self.first_pending is None:
+            return False
+        if now - self.first_pending >= self.conf["watch_batch_seconds"]:
+            return True
+        waiting = sum(len(b) for b in self.pending.values())
+        return waiting >= self.conf["watch_batch_size"]
+
+    def push(self):
+        """send the pending batches off; a batch that fails is left for the
+        next reconcile"""
+        for source_name, batch in self.pending.items():
+            if not batch:
+                continue
+            paths = sorted(batch)
+            batch.clear()
+            listdir = os.path.join(self.conf["state_dir"], "watch")
+            os.makedirs(listdir, exist_ok=True)
+            files_from = os.path.join(listdir, f"{source_name}.list")
+            with open(files_from, "wb") as f:
+                for p in paths:
+                    f.write(os.fsencode(p) + b"\0")
+            cmdlist = run.build_command(self.conf, source_name)
+            cmdlist = watch_command(cmdlist, files_from)
+            prefix = governor.priority_prefix(self.conf, self.sources[source_name])
+            out, returncode = run.run_command(prefix + cmdlist, head=20, tail=20)
+            if returncode:
+                log.error(
+                    f"pushing {len(paths)} changes in {source_name} failed"
+                    f" ({returncode}), reconciling: {out.strip()}"
+                )
+                self.reconcile_at = 0
+            else:
+                log.info(f"pushed {len(paths)} changes in {source_name}")
+        self.first_pending = None
+
+    def reconcile(self):
+        """a normal, full run of every watched source"""
+        log.info("reconciling")
+        for batch in self.pending.values():
+            batch.clear()
+        self.first_pending = None
+        results = [run.run_source(self.conf, n, self.ctx) for n in self.sources]
+        if any(r["error"] for r in results):
+            run.send_report(
+                self.conf,
+                f"RsyncR watch of {self.conf['job_name']} failed to reconcile\n"
+                + "".join(run.source_report(r) for r in results),
+                True,
+                "",
+            )
+        self.reconcile_at = time.monotonic() + self.conf["watch_reconcile"]
+
+    def start(self):
+        # watches first, so nothing that happens during the first reconcile is
+        # missed; the events just wait in the queue
+        for n in self.sources:
+            self.watch_tree(n)
+        self.ctx = run.RunContext(self.conf, [self.conf])
+        self.reconcile()
+
+    def step(self, timeout=1.0):
+        """one go round: wait (up to timeout) for events, then do whatever's due"""
+        self.handle(self.inotify.read(timeout))
+        now = time.monotonic()
+        if now >= self.reconcile_at:
+            self.reconcile()
+        elif self.batch_due(now):
+            self.push()
+
+    def close(self):
+        self.inotify.close()
+        if self.ctx is not None:
+            self.ctx.close()
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def run_forever(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self.start()
+        try:
+            while not self.stopping:
+                self.step()
+            # don't leave what's already seen behind
+            if self.first_pending is not None:
+                self.push()
+        finally:
+            self.close()
+
+
+def cli(argv):
+    """'rsyncr watch <config>': mirror a job's local sources as they change"""
+    parser = argparse.ArgumentParser(prog="rsyncr watch")
+    parser.add_argument("config", help="job/config name to watch")
+    parser.add_argument(
+        "--job-config-path", help="(optional) what job toml file to use"
+    )
+    parser.add_argument("--configs-dir", help="(optional) where to look for toml files")
+    parser.add_argument(
+        "--global-config-path", help="(optional) override global config settings"
+    )
+    args = parser.parse_args(argv)
+
+    conf = run.load_job(
+        args.config,
+        job_config_path=args.job_config_path,
+        config_dir=args.configs_dir,
+        global_config_path=args.global_config_path,
+    )
+    w = Watcher(conf)
+    if not w.sources:
+        sys.exit(f"{args.config} has no local sources to watch")
+    w.run_forever()
@@ -0,0 +1,226 @@
+"""Keep an eye on a running rsync, and kill it if it's stuck.
+
+A hung ssh link or a dead NFS mount can leave rsync waiting forever, holding up
+every source queued behind it. With 'stall_timeout' set, rsync runs with
+--info=progress2, and its progress lines (which end in \\r, and don't go in the
+report or capture file) are read as they come; if neither the byte count nor the
+count of files checked moves for stall_timeout seconds, rsync is killed and the
+source fails. 'timeout' is a hard limit on the whole run of a source. Either way
+the source gets return code 30, rsync's own "timed out", so it can be retried.
+Time spent paused (by the governor, see governor.py) doesn't count towards
+either.
+
+With 'status_file' set, what each running source is doing (bytes, percent, and
+throughput) is kept in that JSON file, for whatever monitoring wants to look.
+"""
+
+import os
+import re
+import json
+import time
+import signal
+import logging
+import threading
+
+log = logging.getLogger()
+
+# rsync's code for a timeout in data send/receive
+RETURNCODE = 30
+
+# seconds between a polite SIGTERM and a SIGKILL
+KILL_GRACE = 10
+
+# '    123,456,789  45%   12.34MB/s    0:01:02 (xfr#12, to-chk=100/2000)'
+PROGRESS_RE = re.compile(
+    r"^\s*([\d,.]+)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d\d:\d\d)(?:\s+\((.*)\))?\s*$"
+)
+
+
+def settings(conf, d=None):
+    """(stall_timeout, timeout) for a source; either can be set per source"""
+    d = d or {}
+    return (
+        d.get("stall_timeout", conf["stall_timeout"]) or 0,
+        d.get("timeout", conf["timeout"]) or 0,
+    )
+
+
+def wants_progress(conf, d=None):
+    """whether rsync needs to be asked for --info=progress2"""
+    return bool(settings(conf, d)[0] or conf["status_file"])
+
+
+class StatusBoard:
+    """The status file: what every running source is up to. Safe to share
+    between threads; written at most once a second."""
+
+    def __init__(self, path, every=1.0):
+        self.path = path
+        self.every = every
+        self._lock = threading.Lock()
+        self._sources = {}
+        self._written = 0
+
+    def update(self, name, status, force=False):
+        with self._lock:
+            self._sources[name] = status
+            self._write(force)
+
+    def remove(self, name):
+        with self._lock:
+            self._sources.pop(name, None)
+            self._write(True)
+
+    def _write(self, force):
+        now = time.time()
+        if not force and now - self._written < self.every:
+            return
+        self._written = now
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"updated": now, "sources": self._sources}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.debug(f"couldn't write status file {self.path}: {e}")
+
+
+class Watchdog:
+    """Watches one rsync process. stream_command feeds it the output, and it
+    kills the process from its own thread if it stalls or runs too long."""
+
+    RETURNCODE = RETURNCODE
+
+    def __init__(
+        self, stall_timeout=0, timeout=0, name=None, board=None, tick=1.0, governor=None
+    ):
+        self.stall_timeout = stall_timeout
+        self.timeout = timeout
+        self.name = name
+        self.board = board
+        self.tick = tick
+        self.governor = governor
+        self.proc = None
+        self.paused_at = None
+        self._pause_lock = threading.Lock()
+        self.reason = None
+        self.bytes = 0
+        self.percent = None
+        self.rate = None
+        self.checked = None
+        self.started = self.last_move = time.monotonic()
+        self._rate_mark = (self.started, 0)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def progress(self, line):
+        """take a line of output; True if it was a progress line (which is then
+        used up), False for anything else"""
+        m = PROGRESS_RE.match(line)
+        if not m:
+            # real output still shows rsync's alive
+            self.last_move = time.monotonic()
+            return False
+        done = int(re.sub(r"[,.]", "", m.group(1)))
+        checked = m.group(5)
+        if done != self.bytes or checked != self.checked:
+            self.last_move = time.monotonic()
+        self.bytes = done
+        self.checked = checked
+        self.percent = int(m.group(2))
+        return True
+
+    def status(self, now):
+        """what goes in the status file; the rate is worked out from the byte
+        count since last time, rather than taken from rsync's per-file figure"""
+        then, then_bytes = self._rate_mark
+        if now - then >= 5:
+            self.rate = (self.bytes - then_bytes) / (now - then)
+            self._rate_mark = (now, self.bytes)
+        return {
+            "bytes": self.bytes,
+            "percent": self.percent,
+            "bytes_per_sec": self.rate,
+            "elapsed": round(now - self.started, 1),
+            "idle": round(now - self.last_move, 1),
+            "paused": self.paused_at is not None,
+            "updated": time.time(),
+        }
+
+    def overdue(self, now):
+        """why the process should be killed, or None if it shouldn't"""
+        if self.paused_at is not None:
+            return None
+        if self.timeout and now - self.started > self.timeout:
+            return f"still running after {self.timeout}s (timeout)"
+        if self.stall_timeout and now - self.last_move > self.stall_timeout:
+            return f"no progress for {self.stall_timeout}s (stall_timeout)"
+        return None
+
+    def pause(self):
+        """stop the process (and its children) until resume()"""
+        from rsyncr import governor
+
+        with self._pause_lock:
+            if self.paused_at is not None or self.proc is None:
+                return
+            self.paused_at = time.monotonic()
+            governor.signal_family(self.proc.pid, signal.SIGSTOP)
+        log.info(f"{self.name or self.proc.args[0]}: paused, the machine's busy")
+
+    def resume(self):
+        """carry on after pause(); the clocks skip over the time spent paused"""
+        from rsyncr import governor
+
+        with self._pause_lock:
+            if self.paused_at is None:
+                return
+            if self.proc.returncode is None:
+                governor.signal_family(self.proc.pid, signal.SIGCONT)
+            paused = time.monotonic() - self.paused_at
+            self.paused_at = None
+            self.started += paused
+            self.last_move += paused
+            self._rate_mark = (self._rate_mark[0] + paused, self._rate_mark[1])
+        log.info(f"{self.name or self.proc.args[0]}: resumed after {paused:.0f}s")
+
+    def watch(self, proc):
+        self.proc = proc
+        self.started = self.last_move = time.monotonic()
+        self._rate_mark = (self.started, 0)
+        self._thread = threading.Thread(target=self._run, args=(proc,), daemon=True)
+        self._thread.start()
+        if self.governor is not None:
+            self.governor.add(self)
+
+    def _run(self, proc):
+        # only ever running alongside stream_command, so it's loaded already
+        from rsyncr import output
+
+        while not self._stop.wait(self.tick):
+            now = time.monotonic()
+            if self.board is not None:
+                self.board.update(self.name, self.status(now))
+            reason = self.overdue(now)
+            if reason is not None:
+                self.reason = reason
+                log.error(f"{self.name or proc.args[0]}: {reason}, killing it")
+                # the whole group: a child (ssh) holding the output pipe would
+                # keep stream_command waiting just as well as rsync itself
+                output.signal_group(proc, signal.SIGTERM)
+                # stop() gets called once the process is gone; the process is
+                # left for stream_command to reap, so it can have its rusage
+                if not self._stop.wait(KILL_GRACE):
+                    output.signal_group(proc, signal.SIGKILL)
+                return
+
+    def stop(self):
+        if self.governor is not None:
+            self.governor.discard(self)
+        self.resume()
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.board is not None:
+            self.board.remove(self.name)
@@ -0,0 +1,63 @@
+import sys
+import json
+
+import pytest
+
+from rsyncr import config
+
+
+@pytest.fixture(autouse=True)
+def config_cache_dir(tmpdir, monkeypatch):
+    """keep the parsed-config cache out of the real ~/.cache"""
+    monkeypatch.setattr(config, "CACHE_DIR", str(tmpdir.join("config-cache")))
+
+
+class FakeRsync:
+    """An 'rsync' (or 'ssh', or whatever 'name' says) in tmpdir that's really
+    the python in 'script'. Scripts that want to say how they were called can
+    append to the file in $RSYNC_LOG, which is .log here."""
+
+    def __init__(self, tmpdir, script, name="rsync"):
+        self.tmpdir = tmpdir
+        source = tmpdir.join(f"fake_{name}.py")
+        source.write(script)
+        self.path = str(tmpdir.join(name))
+        tmpdir.join(name).write(f"#!/bin/sh\nexec {sys.executable} {source} \"$@\"\n")
+        tmpdir.join(name).chmod(0o755)
+        self.log = tmpdir.join("rsync.log")
+
+    def conf(self, job, **extra):
+        """a merged conf for job (a dict like a job config makes, or the toml
+        for one) that runs this rsync; extra goes on top, like command line
+        settings"""
+        if isinstance(job, str):
+            job = config.make("tst", string=job)
+        conf = config.merge_configs(
+            {
+                "rsync_command": self.path,
+                "console_override": True,
+                "state_dir": str(self.tmpdir.join("state")),
+            },
+            job,
+            extra,
+        )
+        conf["job_name"] = "tst"
+        return conf
+
+    def calls(self):
+        """what's been written to the log, a json line at a time"""
+        if not self.log.check():
+            return []
+        return [json.loads(line) for line in self.log.readlines()]
+
+
+@pytest.fixture
+def fake_rsync(tmpdir, monkeypatch):
+    """makes FakeRsyncs: fake_rsync(script) or fake_rsync(script, "ssh")"""
+
+    def make(script, name="rsync"):
+        fake = FakeRsync(tmpdir, script, name)
+        monkeypatch.setenv("RSYNC_LOG", str(fake.log))
+        return fake
+
+    return make
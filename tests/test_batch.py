@@ -0,0 +1,85 @@
+import json
+
+from rsyncr import run
+
+# an 'rsync' that writes down how it was called, makes the batch file it's asked
+# for, and can't replay a batch onto a target with 'drifted' in its name
+FAKE_RSYNC = """
+import json, os, sys
+args = sys.argv[1:]
+with open(os.environ["RSYNC_LOG"], "a") as f:
+    f.write(json.dumps(args) + "\\n")
+for a in args:
+    if a.startswith("--write-batch="):
+        open(a.split("=", 1)[1], "w").write("batch")
+    if a.startswith("--read-batch="):
+        assert os.path.exists(a.split("=", 1)[1])
+        if "drifted" in args[-1]:
+            sys.exit(12)
+"""
+
+
+def make_conf(fake_rsync, targets, host="pasilla:", extra=""):
+    fake = fake_rsync(FAKE_RSYNC)
+    conf = fake.conf(
+        f"""
+target_root = "{fake.tmpdir}/backups"
+host = "{host}"
+{extra}
+[sources.s]
+location = "/data"
+targets = {json.dumps(targets)}
+"""
+    )
+    return conf, fake
+
+
+def test_targets_config(fake_rsync, tmpdir):
+    conf, _ = make_conf(fake_rsync, ["one", "/mnt/two"])
+    d = conf["sources"]["s"]
+    assert d["target"] == f"{tmpdir}/backups/one/"
+    assert d["replicas"] == ["/mnt/two/"]
+
+
+def test_source_is_pulled_once_and_replayed(fake_rsync, tmpdir):
+    conf, fake = make_conf(fake_rsync, ["one", "two", "three"])
+    result = run.run_source(conf, "s")
+    assert not result["error"]
+    first, *replays = fake.calls()
+    assert first[-2] == "pasilla:/data"
+    assert any(a.startswith("--write-batch=") for a in first)
+    # the others never touch the source
+    assert len(replays) == 2
+    assert all(r[-2].startswith("--read-batch=") for r in replays)
+    assert {r[-1] for r in replays} == {
+        f"{tmpdir}/backups/two/",
+        f"{tmpdir}/backups/three/",
+    }
+    assert not tmpdir.join("state", "batches").listdir()
+
+
+def test_failed_replay_falls_back_to_copying(fake_rsync, tmpdir):
+    conf, fake = make_conf(fake_rsync, ["one", "drifted"])
+    result = run.run_source(conf, "s")
+    assert not result["error"]
+    assert "replay failed, copied" in result["output"]
+    copy = fake.calls()[-1]
+    assert copy[-2:] == [f"{tmpdir}/backups/one/", f"{tmpdir}/backups/drifted/"]
+
+
+def test_daemon_source_replicas(fake_rsync, tmpdir):
+    conf, fake = make_conf(
+        fake_rsync,
+        ["one", "drifted"],
+        host="rsync://nas/homes",
+        extra='password_file = "/etc/rsyncr/nas.secret"',
+    )
+    result = run.run_source(conf, "s")
+    assert not result["error"]
+    first, replay, copy = fake.calls()
+    assert "--password-file=/etc/rsyncr/nas.secret" in first
+    assert replay[-2].startswith("--read-batch=")
+    assert copy[-2:] == [f"{tmpdir}/backups/one/", f"{tmpdir}/backups/drifted/"]
+    # local to local: no daemon to give a password to
+    for c in (replay, copy):
+        assert not any(a.startswith("--password-file") for a in c)
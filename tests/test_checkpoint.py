@@ -0,0 +1,87 @@
+import os
+
+from rsyncr import checkpoint
+from rsyncr import run
+
+# an 'rsync' that fails with the code in the target's name, as many times as the
+# file 'fails' in the target says, then works
+FAKE_RSYNC = """
+import os, sys
+target = sys.argv[-1]
+counter = os.path.join(target, "fails")
+left = int(open(counter).read())
+if left:
+    open(counter, "w").write(str(left - 1))
+    sys.exit(int(os.path.basename(target.rstrip("/"))))
+"""
+
+
+def make_conf(fake_rsync, fails, **extra):
+    fake = fake_rsync(FAKE_RSYNC)
+    sources = {}
+    for name, (code, times) in fails.items():
+        target = fake.tmpdir.join(name, str(code))
+        target.join("fails").write(str(times), ensure=True)
+        sources[name] = {"location": "/nowhere/", "target": f"{target}/"}
+    return fake.conf({"sources": sources}, retry_backoff=0, **extra)
+
+
+def test_transient_failures_are_retried(fake_rsync, capsys):
+    conf = make_conf(fake_rsync, {"flaky": (12, 2), "broken": (1, 1)}, retries=2)
+    flaky, broken = run.run_job(conf)
+    assert not flaky["error"] and flaky["attempts"] == 3
+    assert "return code 12" in flaky["output"]
+    # 1 isn't a network sort of error, so there's no point trying again
+    assert broken["error"] and "attempts" not in broken
+
+
+def test_resume_runs_only_unfinished_sources(fake_rsync, capsys):
+    # only a job with retries keeps a checkpoint; 1 isn't one that gets retried
+    conf = make_conf(fake_rsync, {"good": (12, 0), "bad": (1, 1)}, retries=1)
+    run.run_job(conf)
+    cp = checkpoint.Checkpoint(checkpoint.checkpoint_path(conf))
+    assert cp.done("good", conf["sources"]["good"])
+    assert not cp.done("bad", conf["sources"]["bad"])
+
+    good, bad = run.run_job(dict(conf, resume=True))
+    assert good.get("resumed") and not bad["error"]
+    assert "1 already done" in run.skipped_note([good, bad])
+    assert "finished in the run being resumed" in capsys.readouterr().out
+    # and once everything's made it there's nothing left to resume
+    assert not checkpoint.Checkpoint(checkpoint.checkpoint_path(conf)).done(
+        "good", conf["sources"]["good"]
+    )
+
+
+def test_plain_run_starts_a_fresh_checkpoint(fake_rsync, tmpdir, capsys):
+    conf = make_conf(fake_rsync, {"a": (2, 0), "b": (1, 3)}, retries=1)
+    run.run_job(conf)
+    # now a fails too; nothing's marked, but the old checkpoint mustn't stay
+    tmpdir.join("a", "2", "fails").write("1")
+    a, b = run.run_job(conf)
+    assert a["error"] and b["error"]
+    a, b = run.run_job(dict(conf, resume=True))
+    assert not a.get("resumed")
+
+
+def test_no_checkpoint_without_retries(fake_rsync):
+    conf = make_conf(fake_rsync, {"a": (12, 0), "b": (1, 1)})
+    run.run_job(conf)
+    assert not os.path.exists(checkpoint.checkpoint_path(conf))
+
+
+def test_unwritable_checkpoint_doesnt_fail_the_source(fake_rsync, tmpdir, caplog):
+    # a state_dir under a plain file can't be made
+    tmpdir.join("blocker").write("")
+    state_dir = str(tmpdir.join("blocker", "state"))
+    conf = make_conf(fake_rsync, {"a": (12, 0)}, retries=1, state_dir=state_dir)
+    (a,) = run.run_job(conf)
+    assert not a["error"]
+    assert "couldn't write the checkpoint" in caplog.text
+
+
+def test_partial_dir_goes_into_command(fake_rsync):
+    conf = make_conf(fake_rsync, {"s": (12, 0)}, partial=True)
+    assert "--partial-dir=.rsync-partial" in run.build_command(conf, "s")
+    conf["partial"] = ".part"
+    assert "--partial-dir=.part" in run.build_command(conf, "s")
@@ -59,6 +59,32 @@ def test_globals_override_defaults():
     ), "added_rsync_params didn't override right"
 
 
+def test_global_zeros_are_kept():
+    """0 (or false) in the global config is a setting, not 'use the default'"""
+    gtoml = """
+max_per_device = 0
+retry_backoff = 0
+notify_batch_seconds = 0
+exclude_file_threshold = 0
+tune_ttl = 0
+output_head_lines = 0
+stats = false
+"""
+    merged = config.merge_configs(
+        globalconf=config._make_global_config(config.parse_string(gtoml))
+    )
+    for key in (
+        "max_per_device",
+        "retry_backoff",
+        "notify_batch_seconds",
+        "exclude_file_threshold",
+        "tune_ttl",
+        "output_head_lines",
+    ):
+        assert merged[key] == 0, f"{key} = 0 was dropped"
+    assert merged["stats"] is False
+
+
 override_jtoml = """
 target_root = "/path/to/my/backups/"
 host = "pasilla:"
@@ -172,3 +198,36 @@ target = "usr.local.share"
     assert (
         "--quiet" in merged["global_rsync_params"]
     ), "Oops; added rsync param --quiet is missing!"
+
+
+def test_config_files_are_cached(tmpdir, monkeypatch):
+    """an unchanged (or just touched) config file shouldn't be parsed again"""
+    path = tmpdir.join("config.cached.toml")
+    path.write(override_jtoml)
+    first = config.make("cached", str(path))
+
+    def no_parsing(*args):
+        raise AssertionError("parsed again!")
+
+    monkeypatch.setattr(config, "parse_string", no_parsing)
+    assert config.make("cached", str(path)) == first
+    path.setmtime(path.mtime() + 10)
+    assert config.make("cached", str(path)) == first
+
+    # but a real change is noticed
+    monkeypatch.undo()
+    monkeypatch.setattr(config, "CACHE_DIR", str(tmpdir.join("config-cache")))
+    path.write(override_jtoml.replace("verbose = true", "verbose = false"))
+    assert config.make("cached", str(path))["verbose"] is False
+
+
+def test_cache_keeps_up_with_defaults(tmpdir, monkeypatch):
+    """a newer rsyncr's DEFAULTS apply to a config cached by an older one"""
+    path = tmpdir.join("global.toml")
+    path.write('rsync_command = "/usr/local/bin/rsync"\n')
+    assert config.make("global", str(path))["max_parallel"] == 1
+    monkeypatch.setitem(config.DEFAULTS, "max_parallel", 3)
+    monkeypatch.setitem(config.DEFAULTS, "brand_new_setting", "hello")
+    conf = config.make("global", str(path))
+    assert conf["max_parallel"] == 3 and conf["brand_new_setting"] == "hello"
+    assert conf["rsync_command"] == "/usr/local/bin/rsync"
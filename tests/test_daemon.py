@@ -0,0 +1,79 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from rsyncr import config
+from rsyncr import daemon
+
+
+def test_cron_schedule():
+    c = daemon.CronSchedule("30 2 * * *")
+    assert c.next_after(datetime(2024, 1, 1, 2, 30)) == datetime(2024, 1, 2, 2, 30)
+    c = daemon.CronSchedule("*/15 * * * 1-5")
+    # Saturday evening -> Monday midnight
+    assert c.next_after(datetime(2024, 1, 6, 23, 50)) == datetime(2024, 1, 8, 0, 0)
+    # both day fields restricted means either one will do
+    c = daemon.CronSchedule("0 0 1 * 0")
+    assert c.next_after(datetime(2024, 1, 1, 0, 0)) == datetime(2024, 1, 7, 0, 0)
+    with pytest.raises(config.BadConfig):
+        daemon.CronSchedule("61 * * * *")
+
+
+JOB = """
+target_root = "{root}"
+interval = {interval}
+
+[sources.s]
+location = "/s/"
+target = "s"
+"""
+
+
+def make_daemon(tmpdir):
+    tmpdir.join("global.toml").write('rsync_command = "echo"\n')
+    tmpdir.join("config.j.toml").write(JOB.format(root=tmpdir, interval=60))
+    d = daemon.Daemon(str(tmpdir))
+    d.reload()
+    return d
+
+
+def test_reload_only_changed_files(tmpdir):
+    d = make_daemon(tmpdir)
+    state = d.jobs["j"]
+    assert state.conf["interval"] == 60
+    d.reload()
+    assert d.jobs["j"] is state and state.conf["interval"] == 60
+    job = tmpdir.join("config.j.toml")
+    job.write(JOB.format(root=tmpdir, interval=120))
+    job.setmtime(time.time() + 5)
+    d.reload()
+    assert d.jobs["j"].conf["interval"] == 120
+
+
+def test_overlapping_runs_are_coalesced(tmpdir, monkeypatch):
+    d = make_daemon(tmpdir)
+    release = threading.Event()
+    runs = []
+
+    def slow_job(conf):
+        runs.append(conf["job_name"])
+        release.wait(5)
+        return []
+
+    monkeypatch.setattr(daemon.run, "run_job", slow_job)
+    now = time.time()
+    for i in range(3):
+        # comes due three times while the first run is still going
+        d.tick(now + 61 * (i + 1))
+        time.sleep(0.05)
+    assert runs == ["j"]
+    assert d.jobs["j"].pending
+    release.set()
+    for _ in range(50):
+        if not d.jobs["j"].running:
+            break
+        time.sleep(0.05)
+    # one more run, not three
+    assert runs == ["j", "j"]
@@ -0,0 +1,42 @@
+from rsyncr import config
+from rsyncr import filters
+from rsyncr import run
+
+
+def make_conf(tmpdir, source_excludes, threshold=32):
+    conf = config.merge_configs(
+        {"global_excludes": ["a", "b"], "state_dir": str(tmpdir)},
+        {
+            "excludes": ["b", "c"],
+            "sources": {"s": {"location": "/x/", "target": "/y/"}},
+        },
+    )
+    conf["sources"]["s"]["excludes"] = source_excludes
+    conf["exclude_file_threshold"] = threshold
+    return conf
+
+
+def test_excludes_are_merged_in_order_without_repeats(tmpdir):
+    conf = make_conf(tmpdir, ["c", "d", "a"])
+    assert filters.compile_excludes(conf, "s") == ["a", "b", "c", "d"]
+
+
+def test_lots_of_excludes_go_in_a_shared_file(tmpdir):
+    many = [f"junk{i}" for i in range(100)]
+    conf = make_conf(tmpdir, many)
+    cmd = run.build_command(conf, "s")
+    assert not any(a.startswith("--exclude=") for a in cmd)
+    merges = [a for a in cmd if a.startswith("--filter=merge ")]
+    assert len(merges) == 1
+    path = merges[0][len("--filter=merge ") :]
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[:3] == ["- a", "- b", "- c"] and len(lines) == 103
+    # same excludes, same file
+    assert run.build_command(conf, "s") == cmd
+
+
+def test_report_trims_long_exclude_lists():
+    cmd = ["rsync"] + [f"--exclude={i}" for i in range(10)] + ["/x/", "/y/"]
+    text = run.format_command(cmd, max_excludes=2)
+    assert text == "rsync --exclude=0 --exclude=1 [+8 more excludes] /x/ /y/"
@@ -0,0 +1,45 @@
+import os
+
+from rsyncr import config
+from rsyncr import fingerprint
+from rsyncr import run
+
+
+def test_fingerprint_notices_changes(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.mkdir("deep").mkdir("er").join("f").write("one")
+    before = fingerprint.fingerprint(str(src))
+    assert fingerprint.fingerprint(str(src)) == before
+    f = src.join("deep", "er", "f")
+    f.write("two!")
+    os.utime(str(f), ns=(1, 1))
+    assert fingerprint.fingerprint(str(src)) != before
+
+
+def make_conf(tmpdir, **extra):
+    src = tmpdir.join("src")
+    if not src.check():
+        src.mkdir().join("f").write("x")
+    target = tmpdir.join("backup")
+    target.ensure(dir=True)
+    conf = config.merge_configs(
+        {"rsync_command": "echo", "state_dir": str(tmpdir.join("state"))},
+        {
+            "skip_unchanged": True,
+            "sources": {"s": {"location": f"{src}/", "target": f"{target}/"}},
+        },
+        extra,
+    )
+    return conf, src
+
+
+def test_unchanged_source_is_skipped(tmpdir):
+    conf, src = make_conf(tmpdir)
+    assert not run.run_source(conf, "s").get("skipped")
+    assert run.run_source(conf, "s").get("skipped")
+    # --force runs it anyway
+    forced, _ = make_conf(tmpdir, force=True)
+    assert not run.run_source(forced, "s").get("skipped")
+    # and a change means it runs again
+    src.join("new").write("y")
+    assert not run.run_source(conf, "s").get("skipped")
@@ -0,0 +1,156 @@
+import time
+import shutil
+import subprocess
+
+import pytest
+
+from rsyncr import config
+from rsyncr import governor
+from rsyncr import run
+from rsyncr import schedule
+from rsyncr import watchdog
+
+
+def make_conf(**extra):
+    conf = config.merge_configs(
+        {"rsync_command": "echo", "console_override": True},
+        {"sources": {"s": {"location": "/data/", "target": "/backups/data/"}}},
+        extra,
+    )
+    conf["job_name"] = "tst"
+    return conf
+
+
+def test_priority_prefix():
+    assert governor.priority_prefix(make_conf()) == []
+    conf = make_conf(nice=10, ionice_class="idle", ionice_level=4)
+    assert governor.priority_prefix(conf) == ["nice", "-n", "10", "ionice", "-c", "3"]
+    # per source wins
+    d = {"ionice_class": "best-effort", "ionice_level": 7}
+    prefix = governor.priority_prefix(conf, d)
+    assert prefix[3:] == ["ionice", "-c", "2", "-n", "7"]
+    with pytest.raises(config.BadConfig):
+        governor.priority_prefix(make_conf(ionice_class="whenever"))
+
+
+def test_bwlimit():
+    assert governor.parse_bwlimit(0) == 0
+    assert governor.parse_bwlimit(500) == 500
+    assert governor.parse_bwlimit("10m") == 10240
+    assert governor.parse_bwlimit("1.5g") == 1.5 * 1024 ** 2
+    with pytest.raises(config.BadConfig):
+        governor.parse_bwlimit("lots")
+
+    conf = make_conf(bwlimit="2m")
+    assert "--bwlimit=2048" in run.build_command(conf, "s")
+    assert "--bwlimit=512" in run.build_command(conf, "s", bwlimit=512)
+    conf["sources"]["s"]["bwlimit"] = 100
+    assert "--bwlimit=100" in run.build_command(conf, "s")
+    # set explicitly in the rsync params, that one wins
+    conf["global_rsync_params"] = ["-a", "--bwlimit=5"]
+    cmd = run.build_command(conf, "s")
+    assert [a for a in cmd if a.startswith("--bwlimit")] == ["--bwlimit=5"]
+
+
+@pytest.mark.skipif(not shutil.which("nice"), reason="no nice here")
+def test_prefix_not_reported():
+    conf = make_conf(nice=5)
+    cmdlist = run.build_command(conf, "s")
+    result = run.rsync_pass(conf, cmdlist, d=conf["sources"]["s"])
+    assert result["returncode"] == 0
+    assert result["command"][0] == "echo"
+    # nice ran echo, which said what it was given
+    assert result["output"] == " ".join(cmdlist[1:]) + "\n"
+
+
+def test_proc_readers(tmpdir):
+    tmpdir.join("loadavg").write("3.52 2.10 1.05 3/812 12345\n")
+    assert governor.read_loadavg(str(tmpdir.join("loadavg"))) == 3.52
+    line = "   8       0 sda 100 0 200 30 50 0 80 40 0 {} 70 0 0 0 0\n"
+    tmpdir.join("diskstats").write(
+        line.format(1000) + "   7       0 loop0 1 0 2 3 0 0 0 0 0 99999 3 0 0 0 0\n"
+    )
+    before = governor.read_diskstats(str(tmpdir.join("diskstats")))
+    assert before == {"sda": 1000}
+    assert governor.disk_util(before, {"sda": 1500}, 1.0) == 0.5
+    assert governor.disk_util(before, {"sda": 9000}, 1.0) == 1.0
+
+
+def test_adjust():
+    pool = schedule.Scheduler(4)
+    gov = governor.Governor(pool, max_load=1.0, max_util=0.8, cpus=1)
+    gov.adjust(2.0, 0.1)
+    assert pool.max_parallel == 3 and gov.factor == 0.5
+    gov.adjust(0.5, 0.95)
+    assert pool.max_parallel == 2 and gov.factor == 0.25
+    # in between: hold steady
+    gov.adjust(0.9, 0.1)
+    assert pool.max_parallel == 2
+    for _ in range(5):
+        gov.adjust(0.1, 0.1)
+    assert pool.max_parallel == 4 and gov.factor == 1.0
+
+    conf = make_conf(bwlimit=1000)
+    ctx = run.RunContext(conf, [conf])
+    ctx.governor = gov
+    gov.factor = 0.25
+    assert ctx.bwlimit(conf, "s") == 250
+    ctx.close()
+
+
+def test_sample():
+    loads = iter([4.0, 2.0])
+    stats = iter([{"sda": 0}, {"sda": 500}])
+    gov = governor.Governor(
+        schedule.Scheduler(2),
+        cpus=2,
+        loadavg=lambda: next(loads),
+        diskstats=lambda: next(stats),
+    )
+    assert gov.sample(0.0) == (2.0, None)
+    assert gov.sample(1.0) == (1.0, 0.5)
+
+
+def state(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().rsplit(")", 1)[1].split()[0]
+
+
+def test_pausing():
+    gov = governor.Governor(schedule.Scheduler(2), max_load=1.0, pause_load=3.0, cpus=1)
+    procs = [subprocess.Popen(["sleep", "30"]) for _ in range(2)]
+    dogs = []
+    try:
+        for p in procs:
+            dog = watchdog.Watchdog(timeout=60, governor=gov)
+            dog.watch(p)
+            dogs.append(dog)
+        gov.adjust(5.0, 0.0)
+        # the oldest keeps going
+        assert dogs[0].paused_at is None
+        assert dogs[1].paused_at is not None
+        time.sleep(0.1)
+        assert state(procs[1].pid) == "T"
+        # paused time doesn't count against the timeout
+        assert dogs[1].overdue(time.monotonic() + 3600) is None
+        dogs[1].paused_at -= 100
+        gov.adjust(0.5, 0.0)
+        assert dogs[1].paused_at is None
+        time.sleep(0.1)
+        assert state(procs[1].pid) != "T"
+        assert dogs[1].overdue(time.monotonic()) is None
+    finally:
+        gov.stop()
+        for p in procs:
+            p.kill()
+            p.wait()
+        for dog in dogs:
+            dog.stop()
+
+
+def test_governed_run(tmpdir):
+    """a run with the governor on still gets everything done"""
+    conf = make_conf(governor=True, governor_interval=0.05, max_parallel=2)
+    conf["sources"]["t"] = {"location": "/other/", "target": "/backups/other/"}
+    results = run.run_sources(conf, run.RunContext(conf, [conf]))
+    assert [r["returncode"] for r in results] == [0, 0]
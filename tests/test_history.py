@@ -0,0 +1,83 @@
+import types
+
+from rsyncr import config
+from rsyncr import history
+from rsyncr import run
+from rsyncr import schedule
+
+
+def fake_result(name, started, took, returncode=0):
+    parsed = types.SimpleNamespace(
+        files=1000,
+        files_transferred=3,
+        total_file_size=5000000,
+        transferred_file_size=30000,
+        literal_data=2000,
+        matched_data=28000,
+    )
+    return {
+        "name": name,
+        "location": f"/{name}/",
+        "target": f"/backups/{name}/",
+        "returncode": returncode,
+        "started": started,
+        "finished": started + took,
+        "bytes_sent": 100,
+        "bytes_received": 10,
+        "stats": parsed,
+    }
+
+
+def test_record_and_durations(tmpdir):
+    db = history.History(str(tmpdir.join("state", "history.sqlite")))
+    db.record("job", fake_result("fast", 0, 2))
+    db.record("job", fake_result("fast", 10, 4))
+    db.record("job", fake_result("slow", 0, 60))
+    # failed runs don't count towards how long a source usually takes
+    db.record("job", fake_result("slow", 100, 1, returncode=12))
+    assert db.durations("job") == {"fast": 3, "slow": 60}
+    runs = db.query("job", "slow")
+    assert [r["returncode"] for r in runs] == [12, 0]
+    assert "slow" in history.format_runs(runs)
+    assert runs[1]["duration"] == 60 and runs[1]["files_transferred"] == 3
+    assert runs[1]["literal_data"] == 2000 and runs[1]["matched_data"] == 28000
+    assert "28000" in history.format_runs(runs)
+    db.close()
+
+
+def test_only_real_runs_are_recorded(tmpdir):
+    """skipped sources and dry runs take no time, and would drag the averages
+    the longest-first ordering goes by down"""
+    src = tmpdir.mkdir("src")
+    src.join("f").write("x")
+    target = tmpdir.mkdir("backup")
+    conf = config.merge_configs(
+        {
+            "rsync_command": "echo",
+            "console_override": True,
+            "state_dir": str(tmpdir.join("state")),
+        },
+        {
+            "history": True,
+            "skip_unchanged": True,
+            "sources": {"s": {"location": f"{src}/", "target": f"{target}/"}},
+        },
+    )
+    conf["job_name"] = "tst"
+    run.run_job(conf)
+    (skipped,) = run.run_job(conf)
+    assert skipped.get("skipped")
+    run.run_job(dict(conf, dry_run=True, force=True))
+    db = history.History(history.history_path(conf))
+    assert len(db.query("tst")) == 1
+    db.close()
+
+
+def test_priorities_start_longest_first():
+    started = []
+    pool = schedule.Scheduler(max_parallel=1)
+    tasks = [(lambda n=n: started.append(n) or n, {}) for n in "abc"]
+    results = pool.run(tasks, priorities=[1, 30, 5])
+    assert started == ["b", "c", "a"]
+    # but results are still in task order
+    assert results == ["a", "b", "c"]
@@ -1,7 +1,106 @@
+import sys
+import time
+import subprocess
+
+import pytest
+
+from rsyncr import config
 from rsyncr import message
 
 
-def test_message_send():
-    # can't actually test anything, because I don't want to mock up reading the message, but...
-    ## message.send("from rsyncr.tests.test_message_send: Boognish")
-    pass
+class Flaky:
+    """a notifier that fails the first 'fails' times it's used"""
+
+    limit = 10
+
+    def __init__(self, fails=0):
+        self.key = "flaky"
+        self.fails = fails
+        self.sent = []
+
+    def send(self, text):
+        if self.fails:
+            self.fails -= 1
+            raise OSError("endpoint's down")
+        self.sent.append(text)
+
+
+def test_telegram_send_is_only_imported_when_used():
+    code = "import sys, rsyncr.message; print('telegram_send' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE)
+    assert out.stdout.strip() == b"False"
+
+
+def test_chunk_splits_at_line_ends():
+    text = "one\ntwo\nthree\n" + "x" * 12
+    chunks = message.chunk(text, 10)
+    assert "".join(chunks) == text
+    assert all(len(c) <= 10 for c in chunks)
+    assert chunks[:2] == ["one\ntwo\n", "three\n"]
+    assert message.chunk("short", 4096) == ["short"]
+
+
+def test_messages_are_batched_and_chunked(tmpdir):
+    backend = Flaky()
+    d = message.Dispatcher([backend], str(tmpdir), batch_seconds=0.5)
+    d.notify("job a ok")
+    d.notify("job b ok")
+    d.close()
+    assert "".join(backend.sent) == "job a ok\n\njob b ok"
+    assert len(backend.sent) == 2
+    assert tmpdir.listdir() == []
+
+
+def test_unsent_messages_wait_in_the_spool(tmpdir):
+    down = Flaky(fails=100)
+    d = message.Dispatcher([down], str(tmpdir), batch_seconds=0)
+    d.notify("backups done")
+    d.close(timeout=5)
+    assert down.sent == [] and len(tmpdir.listdir()) == 1
+
+    # the next run picks it up
+    up = Flaky()
+    d = message.Dispatcher([up], str(tmpdir), batch_seconds=0)
+    d.close(timeout=5)
+    assert "".join(up.sent) == "backups done"
+    assert tmpdir.listdir() == []
+
+
+def test_spooled_messages_go_once(tmpdir):
+    """a report another rsyncr is still trying to send is left to it"""
+    down = Flaky(fails=100)
+    first = message.Dispatcher([down], str(tmpdir), batch_seconds=0, retry=3600)
+    first.notify("backups done")
+    for _ in range(50):
+        if first.pending and down.fails < 100:
+            break
+        time.sleep(0.1)
+    up = Flaky()
+    second = message.Dispatcher([up], str(tmpdir), batch_seconds=0)
+    second.close(timeout=5)
+    assert up.sent == [] and len(tmpdir.listdir()) == 1
+
+    # once the first has given up on it, it's anyone's
+    first.close(timeout=5)
+    third = message.Dispatcher([up], str(tmpdir), batch_seconds=0)
+    third.close(timeout=5)
+    assert "".join(up.sent) == "backups done"
+    assert tmpdir.listdir() == []
+
+
+def test_file_notifier(tmpdir):
+    path = tmpdir.join("notes.txt")
+    backend = message.make_backend({"kind": "file", "path": str(path)})
+    assert backend.key.startswith("file-")
+    backend.send("hello")
+    assert path.read() == "hello\n"
+
+
+def test_bad_notifiers_fail_when_loaded():
+    """not at the end of a run, once the backups are done"""
+    ok = 'notifiers = ["file", {kind = "smtp", host = "mx", to = "me@here"}]\n'
+    assert len(config.make("global", string=ok)["notifiers"]) == 2
+    bad = ['["telegarm"]', '[{kind = "webhook"}]', '[{kind = "smtp", host = "mx"}]']
+    for notifiers in bad:
+        with pytest.raises(config.BadConfig):
+            config.make("global", string=f"notifiers = {notifiers}\n")
@@ -0,0 +1,38 @@
+import sys
+
+from rsyncr import output
+
+
+def test_output_tail_is_bounded():
+    """only the head and tail should be kept, however much output there is"""
+    kept = output.OutputTail(head=2, tail=3)
+    for i in range(10000):
+        kept.add(f"line {i}\n")
+    assert kept.head == ["line 0\n", "line 1\n"]
+    assert list(kept.tail) == ["line 9997\n", "line 9998\n", "line 9999\n"]
+    assert kept.dropped == 9995
+    assert "[... 9995 lines omitted ...]" in kept.text()
+
+
+def test_stream_command_feeds_sinks(tmpdir):
+    """every line goes to the capture file, even the ones trimmed from the report"""
+    path = str(tmpdir.join("capture.txt"))
+    capture = output.Capture(path)
+    script = "import sys\nfor i in range(500): print(i)\nsys.exit(23)"
+    kept, returncode = output.stream_command(
+        [sys.executable, "-c", script], [capture.sink("src")], head=1, tail=1
+    )
+    capture.close()
+    assert returncode == 23
+    assert kept.text() == "0\n[... 498 lines omitted ...]\n499\n"
+    with open(path) as f:
+        assert f.read().splitlines() == [str(i) for i in range(500)]
+
+
+def test_tagged_capture_marks_every_line(tmpdir):
+    path = str(tmpdir.join("capture.txt"))
+    capture = output.Capture(path, tagged=True)
+    capture.sink("src")("one\ntwo\n")
+    capture.close()
+    with open(path) as f:
+        assert f.read() == "[src] one\n[src] two\n"
@@ -0,0 +1,62 @@
+from rsyncr import plan
+from rsyncr import run
+
+# an 'rsync' that claims each source needs as many bytes as its target's name
+# says, and fails for a target named 0
+FAKE_RSYNC = """
+import os, sys
+size = int(os.path.basename(sys.argv[-1].rstrip("/")))
+if not size:
+    sys.exit(23)
+print("Number of regular files transferred: 3")
+print("Number of deleted files: 1")
+print(f"Total transferred file size: {size:,} bytes")
+"""
+
+
+def make_conf(fake_rsync, sizes, **extra):
+    fake = fake_rsync(FAKE_RSYNC)
+    sources = {
+        f"s{i}": {"location": "/nowhere/", "target": f"{fake.tmpdir}/{size}/"}
+        for i, size in enumerate(sizes)
+    }
+    return fake.conf({"sources": sources}, **extra)
+
+
+def test_plan_adds_up_per_device(fake_rsync):
+    conf = make_conf(fake_rsync, [1000, 2000])
+    rows = plan.make_plan([conf])
+    assert [(r["files"], r["bytes"], r["deletes"]) for r in rows] == [
+        (3, 1000, 1),
+        (3, 2000, 1),
+    ]
+    devices = plan.device_totals(rows)
+    assert len(devices) == 1
+    (dev,) = devices.values()
+    assert dev["need"] == 3000 and dev["fits"]
+    assert "s1" in plan.format_plan(rows, devices)
+
+
+def test_preflight_refuses_a_run_that_wont_fit(fake_rsync, capsys):
+    conf = make_conf(fake_rsync, [1000, 10 ** 18], preflight="refuse")
+    results = run.run_job(conf)
+    assert all(r["error"] for r in results)
+    assert "WON'T FIT" in capsys.readouterr().out
+
+
+def test_replicas_need_room_too(fake_rsync):
+    conf = make_conf(fake_rsync, [1000])
+    d = conf["sources"]["s0"]
+    d["replicas"] = [d["target"].replace("1000", "copy")]
+    (dev,) = plan.device_totals(plan.make_plan([conf])).values()
+    assert dev["need"] == 2000
+
+
+def test_failed_dry_run_doesnt_fit(fake_rsync):
+    conf = make_conf(fake_rsync, [1000, 0])
+    rows = plan.make_plan([conf])
+    assert rows[1]["bytes"] is None and rows[1]["returncode"] == 23
+    devices = plan.device_totals(rows)
+    (dev,) = devices.values()
+    assert dev["need"] == 1000 and not dev["fits"]
+    assert "how much is needed is unknown" in plan.format_plan(rows, devices)
@@ -0,0 +1,158 @@
+import os
+import time
+import shutil
+import socket
+import subprocess
+
+import pytest
+
+from rsyncr import config
+from rsyncr import run
+from rsyncr import schedule
+
+
+def make_conf(job, **extra):
+    conf = config.merge_configs({}, config.make("tst", string=job), extra)
+    conf["job_name"] = "tst"
+    return conf
+
+
+def test_daemon_host():
+    conf = make_conf(
+        """
+target_root = "/backups"
+host = "rsync://nas:8730/homes/"
+password_file = "/etc/rsyncr/nas.secret"
+
+[sources.me]
+location = "/me/"
+target = "me"
+""",
+        ssh_multiplex=True,
+    )
+    d = conf["sources"]["me"]
+    assert d["location"] == "rsync://nas:8730/homes/me/"
+    assert schedule.source_host(d["location"]) == "nas"
+    cmd = run.build_command(conf, "me")
+    assert "--password-file=/etc/rsyncr/nas.secret" in cmd
+    assert cmd[-2] == "rsync://nas:8730/homes/me/"
+    # straight to the daemon, never through ssh
+    ctx = run.RunContext(conf, [conf])
+    assert ctx.rsh(conf, "me") is None
+    ctx.close()
+
+
+def test_daemon_location():
+    conf = make_conf(
+        """
+target_root = "/backups"
+host = "pasilla:"
+
+[sources.lan]
+location = "rsync://backup@nas/media/films"
+target = "films"
+
+[sources.ssh]
+location = "/srv/"
+target = "srv"
+"""
+    )
+    assert conf["sources"]["lan"]["location"] == "rsync://backup@nas/media/films/"
+    assert conf["sources"]["ssh"]["location"] == "pasilla:/srv/"
+    assert schedule.source_host("rsync://backup@nas/media/films/") == "backup@nas"
+    # no password file, nothing extra
+    assert not any(a.startswith("--password") for a in run.build_command(conf, "lan"))
+
+
+def test_bad_daemon_urls():
+    for host in ("rsync://nas", "rsync://nas:port/mod"):
+        with pytest.raises(AssertionError):
+            config.make(
+                "tst",
+                string=f"""
+target_root = "/backups"
+host = "{host}"
+
+[sources.s]
+location = "/s/"
+target = "s"
+""",
+            )
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def rsyncd(tmpdir):
+    """an rsync daemon on loopback, with a password protected module"""
+    src = tmpdir.mkdir("src")
+    src.join("a.txt").write("hello")
+    src.mkdir("sub").join("b.txt").write("world")
+    secrets = tmpdir.join("secrets")
+    secrets.write("rsyncr:sekrit\n")
+    secrets.chmod(0o600)
+    port = free_port()
+    tmpdir.join("rsyncd.conf").write(
+        f"""
+pid file = {tmpdir}/rsyncd.pid
+use chroot = false
+
+[mod]
+path = {src}
+read only = true
+uid = {os.getuid()}
+gid = {os.getgid()}
+auth users = rsyncr
+secrets file = {secrets}
+"""
+    )
+    proc = subprocess.Popen(
+        [
+            "rsync",
+            "--daemon",
+            "--no-detach",
+            "--address=127.0.0.1",
+            f"--port={port}",
+            f"--config={tmpdir.join('rsyncd.conf')}",
+        ]
+    )
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield port
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.mark.skipif(not shutil.which("rsync"), reason="needs a real rsync")
+def test_loopback_daemon(tmpdir, rsyncd):
+    password = tmpdir.join("password")
+    password.write("sekrit\n")
+    password.chmod(0o600)
+    conf = make_conf(
+        f"""
+target_root = "{tmpdir}/backups"
+host = "rsync://rsyncr@127.0.0.1:{rsyncd}/mod"
+password_file = "{password}"
+
+[sources.all]
+location = "/"
+target = "all"
+"""
+    )
+    result = run.run_source(conf, "all")
+    assert result["returncode"] == 0, result["output"]
+    assert tmpdir.join("backups", "all", "sub", "b.txt").read() == "world"
+
+    # and the wrong password gets nowhere
+    password.write("wrong\n")
+    assert run.run_source(conf, "all")["returncode"] != 0
@@ -1,6 +1,11 @@
 import logging
 import os.path
 
+import pytest
+
+from rsyncr import message
+from rsyncr import run
+
 logging.getLogger().setLevel(logging.DEBUG)
 
 
@@ -12,3 +17,106 @@ logging.getLogger().setLevel(logging.DEBUG)
 #     dir = os.path.split(__file__)[:-1]
 #     fn = os.path.join(*dir, "test1.toml")
 #     process_job("dude", override_filename=fn)
+
+
+def write_configs(tmpdir, jobtoml, globaltoml='rsync_command = "echo"\n'):
+    """stuff a configs dir with a global and one job config, named 'tst'"""
+    globaltoml += f'state_dir = "{tmpdir}/state"\n'
+    tmpdir.join("global.toml").write(globaltoml)
+    tmpdir.join("config.tst.toml").write(jobtoml)
+    return str(tmpdir)
+
+
+def test_parallel_job_report_keeps_config_order(tmpdir, capsys):
+    """sources running at once should still be reported in config order"""
+    target = tmpdir.mkdir("backups")
+    jobtoml = f"""
+target_root = "{target}"
+console_override = true
+max_parallel = 4
+max_per_device = 0
+"""
+    for n in ("one", "two", "three", "four"):
+        jobtoml += f"""
+[sources.{n}]
+location = "/{n}/"
+target = "{n}"
+"""
+    cfgdir = write_configs(tmpdir, jobtoml)
+    run.process_job("tst", config_dir=cfgdir)
+    out = capsys.readouterr().out
+    positions = [out.index(f"Source {n}:") for n in ("one", "two", "three", "four")]
+    assert positions == sorted(positions)
+
+
+def test_find_jobs(tmpdir):
+    for n in ("web1", "web2", "db"):
+        tmpdir.join(f"config.{n}.toml").write("")
+    tmpdir.join("global.toml").write("")
+    assert run.find_jobs(str(tmpdir)) == ["db", "web1", "web2"]
+    assert run.find_jobs(str(tmpdir), ["web*"]) == ["web1", "web2"]
+    # plain names come through as-is, so a typo fails loudly later on
+    assert run.find_jobs(str(tmpdir), ["db", "nope"]) == ["db", "nope"]
+
+
+def test_fleet_sends_one_report(tmpdir, monkeypatch):
+    """several configs run together should make one notification"""
+    sent = []
+    monkeypatch.setattr(message, "notify", lambda conf, text: sent.append(text))
+    tmpdir.join("global.toml").write(
+        f'rsync_command = "echo"\nmax_parallel = 3\nstate_dir = "{tmpdir}/state"\n'
+    )
+    for job in ("alpha", "beta"):
+        tmpdir.join(f"config.{job}.toml").write(
+            f"""
+target_root = "{tmpdir}"
+
+[sources.{job}src]
+location = "/{job}/"
+target = "{job}"
+"""
+        )
+    run.process_fleet(run.find_jobs(str(tmpdir)), config_dir=str(tmpdir))
+    assert sent == ["RsyncR processed 2 sources in 2 configs without errors."]
+
+
+def test_fleet_runs_past_a_broken_config(tmpdir, monkeypatch):
+    """one bad config file is an error in the report, not a fleet that never ran"""
+    sent = []
+    monkeypatch.setattr(message, "notify", lambda conf, text: sent.append(text))
+    tmpdir.join("global.toml").write(
+        f'rsync_command = "echo"\nstate_dir = "{tmpdir}/state"\n'
+    )
+    tmpdir.join("config.alpha.toml").write(
+        f"""
+target_root = "{tmpdir}"
+
+[sources.alphasrc]
+location = "/alpha/"
+target = "alpha"
+"""
+    )
+    tmpdir.join("config.beta.toml").write("this isn't toml")
+    run.process_fleet(run.find_jobs(str(tmpdir)), config_dir=str(tmpdir))
+    (report,) = sent
+    assert "==== config alpha: ok ====" in report
+    assert "Source alphasrc:" in report
+    assert "==== config beta: ERRORS ====" in report
+    assert "config.beta.toml" in report
+
+
+def test_subcommands_stop_their_rsyncs(monkeypatch):
+    """a daemon or watch that's interrupted mustn't leave rsyncs behind"""
+    from rsyncr import output
+    from rsyncr import watch
+
+    stopped = []
+    monkeypatch.setattr(output, "stop_all", lambda: stopped.append(True))
+
+    def interrupted(argv):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(watch, "cli", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run.cli(["watch", "tst"])
+    assert stopped
@@ -0,0 +1,49 @@
+import threading
+import time
+
+from rsyncr import schedule
+
+
+def test_results_keep_task_order():
+    """tasks finishing out of order still report in the order they went in"""
+    pool = schedule.Scheduler(max_parallel=4)
+    tasks = [
+        (lambda n=n: time.sleep(0.05 * (4 - n)) or n, {}) for n in range(4)
+    ]
+    assert pool.run(tasks) == [0, 1, 2, 3]
+
+
+def test_per_key_limits():
+    """no more than the limit should share a device at once"""
+    lock = threading.Lock()
+    busy = {}
+    worst = {}
+
+    def work(dev):
+        with lock:
+            busy[dev] = busy.get(dev, 0) + 1
+            worst[dev] = max(worst.get(dev, 0), busy[dev])
+        time.sleep(0.02)
+        with lock:
+            busy[dev] -= 1
+        return dev
+
+    pool = schedule.Scheduler(max_parallel=6, limits={"device": 1})
+    tasks = [(lambda d=d: work(d), {"device": d}) for d in "aabbbc"]
+    assert pool.run(tasks) == list("aabbbc")
+    assert worst == {"a": 1, "b": 1, "c": 1}
+
+
+def test_exceptions_stay_in_their_slot():
+    def boom():
+        raise ValueError("nope")
+
+    pool = schedule.Scheduler(max_parallel=2)
+    results = pool.run([(boom, {}), (lambda: "fine", {})])
+    assert isinstance(results[0], ValueError)
+    assert results[1] == "fine"
+
+
+def test_source_host():
+    assert schedule.source_host("/usr/local/") == "local"
+    assert schedule.source_host("george@10.0.0.2:/home/") == "george@10.0.0.2"
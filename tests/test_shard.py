@@ -0,0 +1,57 @@
+from rsyncr import config
+from rsyncr import run
+from rsyncr import shard
+
+
+def test_pack_balances():
+    weights = {"big": 10, "mid": 6, "a": 3, "b": 3, "c": 2}
+    bins = shard.pack(weights, 2)
+    totals = sorted(sum(weights[n] for n in b) for b in bins)
+    assert totals == [12, 12]
+    # more bins than entries just leaves some out
+    assert len(shard.pack({"x": 1}, 4)) == 1
+
+
+def test_estimate_uses_cache_until_entry_changes(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.mkdir("d").join("f").write("x" * 1000)
+    cache = str(tmpdir.join("cache.json"))
+    first = shard.estimate(str(src), ["d"], cache)
+    assert first["d"] > 1000
+    # a deep change without touching the entry's own mtime isn't noticed...
+    src.join("d", "f").write("x" * 100000)
+    assert shard.estimate(str(src), ["d"], cache) == first
+
+
+def test_shard_and_delete_commands():
+    cmd = ["rsync", "--archive", "--delete", "--delete-excluded", "/x/", "/y/"]
+    s = shard.shard_command(cmd, "/tmp/list")
+    assert "--delete" not in s and "--delete-excluded" not in s
+    assert s[-2:] == ["/x/", "/y/"]
+    assert "--files-from=/tmp/list" in s and "--recursive" in s
+    d = shard.delete_command(cmd)
+    assert "--existing" in d and "--ignore-existing" in d and "--delete" in d
+    assert shard.delete_command(["rsync", "--archive", "/x/", "/y/"]) is None
+
+
+def test_sharded_source_reports_as_one(tmpdir):
+    src = tmpdir.mkdir("src")
+    for n in "abcdef":
+        src.join(n).write(n)
+    conf = config.merge_configs(
+        {"rsync_command": "echo", "state_dir": str(tmpdir.join("state"))},
+        {
+            "sources": {
+                "big": {
+                    "location": f"{src}/",
+                    "target": f"{tmpdir}/backup/",
+                    "shards": 3,
+                }
+            }
+        },
+    )
+    result = run.run_source(conf, "big")
+    assert result["shards"] == 3
+    assert result["error"] is False
+    assert result["output"].count("[shard ") == 3
+    assert "[deletions: return code 0]" in result["output"]
@@ -0,0 +1,134 @@
+import json
+import shutil
+
+import pytest
+
+from rsyncr import config
+from rsyncr import run
+from rsyncr import sizes
+
+# an 'rsync' that writes down how it was called, prints a bit of --stats, and
+# fails the pass for big files if the target's name says to
+FAKE_RSYNC = """
+import json, os, sys
+args = sys.argv[1:]
+with open(os.environ["RSYNC_LOG"], "a") as f:
+    f.write(json.dumps(args) + "\\n")
+print("Number of files: 10")
+print("Total transferred file size: 100 bytes")
+if "--inplace" in args and "badbig" in args[-1]:
+    sys.exit(23)
+"""
+
+
+def make_conf(fake_rsync, threshold="1G", target="t", **extra):
+    fake = fake_rsync(FAKE_RSYNC)
+    conf = fake.conf(
+        f"""
+target_root = "{fake.tmpdir}/backups"
+
+[sources.vms]
+location = "/srv/vms"
+target = "{target}"
+large_file_threshold = {json.dumps(threshold)}
+""",
+        **extra,
+    )
+    return conf, fake
+
+
+def test_parse_size():
+    assert sizes.parse_size(5000) == 5000
+    assert sizes.parse_size("1G") == 1 << 30
+    assert sizes.parse_size("1.5m") == 1.5 * (1 << 20)
+    assert sizes.parse_size("200KiB") == 200 << 10
+    with pytest.raises(config.BadConfig):
+        sizes.parse_size("big")
+    assert sizes.human(1 << 30) == "1G"
+
+
+def test_commands():
+    cmd = ["rsync", "-a", "--delete", "--partial-dir=.p", "--whole-file", "/s/", "/t/"]
+    large = sizes.large_command(cmd, 1000)
+    assert large == [
+        "rsync",
+        "-a",
+        "--min-size=1001",
+        "--inplace",
+        "--partial",
+        "--no-whole-file",
+        "/s/",
+        "/t/",
+    ]
+    small = sizes.small_command(cmd, 1000)
+    assert small[:-2] == cmd[:-2] + ["--max-size=1000"]
+    assert "--whole-file" in sizes.small_command(["rsync", "-a", "/s/", "/t/"], 1000)
+
+
+def test_split_source(fake_rsync):
+    conf, fake = make_conf(fake_rsync, partial=True)
+    result = run.run_source(conf, "vms")
+    assert not result["error"]
+    large, small = sorted(fake.calls(), key=lambda c: "--inplace" not in c)
+    assert "--min-size=1073741825" in large
+    assert not any(a.startswith(("--delete", "--partial-dir")) for a in large)
+    assert "--max-size=1073741824" in small
+    assert "--delete" in small
+    # reported as one source: both passes, and the whole tree counted once
+    assert "[files over 1G: return code 0]" in result["output"]
+    assert "[everything else: return code 0]" in result["output"]
+    assert result["stats"].files == 10
+    assert result["stats"].transferred_file_size == 200
+    assert "(files over 1G in a pass of their own)" in run.source_report(result)
+
+
+def test_split_source_failure(fake_rsync):
+    conf, _ = make_conf(fake_rsync, threshold=5000, target="badbig")
+    result = run.run_source(conf, "vms")
+    assert result["error"]
+    assert result["returncode"] == 23
+
+
+def test_not_with_shards(tmpdir):
+    with pytest.raises(AssertionError):
+        config.make(
+            "tst",
+            string="""
+target_root = "/b"
+
+[sources.s]
+location = "/s"
+target = "s"
+shards = 4
+large_file_threshold = "1G"
+""",
+        )
+
+
+@pytest.mark.skipif(not shutil.which("rsync"), reason="needs a real rsync")
+def test_real_rsync(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.join("big.img").write("x" * 5000)
+    src.mkdir("small").join("a").write("a")
+    dst = tmpdir.mkdir("backups").mkdir("s")
+    dst.join("gone.img").write("y" * 5000)
+    dst.join("gone.txt").write("y")
+    jconf = config.make(
+        "tst",
+        string=f"""
+target_root = "{tmpdir}/backups"
+
+[sources.s]
+location = "{src}"
+target = "s"
+large_file_threshold = 1000
+""",
+    )
+    conf = config.merge_configs({"console_override": True}, jconf, {})
+    result = run.run_source(conf, "s")
+    assert result["returncode"] == 0, result["output"]
+    assert dst.join("big.img").read() == "x" * 5000
+    assert dst.join("small", "a").read() == "a"
+    # deleted whatever their size
+    assert not dst.join("gone.img").exists()
+    assert not dst.join("gone.txt").exists()
@@ -0,0 +1,70 @@
+import sys
+import time
+import threading
+
+from rsyncr import config
+from rsyncr import run
+from rsyncr import ssh
+
+
+def fake_ssh(tmpdir, returncode=0):
+    """an 'ssh' that just writes down how it was called (and takes its time
+    over a host called 'slow')"""
+    log = tmpdir.join("ssh.log")
+    script = tmpdir.join("fake_ssh.py")
+    script.write(
+        "import sys, time\n"
+        f"open({str(log)!r}, 'a').write(' '.join(sys.argv[1:]) + '\\n')\n"
+        "if sys.argv[-1] == 'slow':\n"
+        "    time.sleep(10)\n"
+        f"sys.exit({returncode})\n"
+    )
+    return f"{sys.executable} {script}", log
+
+
+def test_masters_are_shared_and_closed(tmpdir):
+    command, log = fake_ssh(tmpdir)
+    pool = ssh.SSHPool(command, size=2)
+    first, second, third = (pool.rsh("george@pasilla") for _ in range(3))
+    # two masters, handed out round-robin
+    assert first != second and first == third
+    assert "ControlMaster=no" in first
+    pool.close()
+    calls = log.read().splitlines()
+    assert len([c for c in calls if c.startswith("-M ")]) == 2
+    assert len([c for c in calls if "-O exit" in c]) == 2
+
+
+def test_failed_master_falls_back_to_plain_ssh(tmpdir):
+    command, log = fake_ssh(tmpdir, returncode=255)
+    pool = ssh.SSHPool(command)
+    assert pool.rsh("pasilla") == command
+    pool.close()
+
+
+def test_slow_host_holds_up_nobody(tmpdir, monkeypatch):
+    monkeypatch.setattr(ssh, "OPEN_TIMEOUT", 1)
+    command, log = fake_ssh(tmpdir)
+    pool = ssh.SSHPool(command)
+    found = {}
+    slow = threading.Thread(target=lambda: found.update(slow=pool.rsh("slow")))
+    slow.start()
+    time.sleep(0.2)
+    began = time.monotonic()
+    assert "ControlPath" in pool.rsh("fast")
+    assert time.monotonic() - began < 0.9
+    slow.join()
+    # gave up on the master, so plain ssh
+    assert found["slow"] == command
+    assert "BatchMode=yes" in log.read()
+    pool.close()
+
+
+def test_rsh_goes_into_command():
+    conf = config.merge_configs(
+        {"stats": False, "global_rsync_params": ["--archive"]},
+        {"sources": {"s": {"location": "pasilla:/x/", "target": "/y/"}}},
+        {},
+    )
+    cmd = run.build_command(conf, "s", rsh="ssh -o ControlPath=/tmp/c")
+    assert "--rsh=ssh -o ControlPath=/tmp/c" in cmd
@@ -0,0 +1,110 @@
+"""rsyncr gets started a lot (timers, cron, a fleet of them at once), so how much
+it imports before doing anything matters; these keep 'rsyncr check' light"""
+
+import os
+import sys
+import json
+import subprocess
+
+from rsyncr import config
+
+# run in a fresh python, so nothing the other tests imported counts
+PROBE = """
+import sys, json, time, io, contextlib
+before = set(sys.modules)
+started = time.perf_counter()
+from rsyncr import run
+with contextlib.redirect_stdout(io.StringIO()) as out:
+    run.cli(["check", "--configs-dir", sys.argv[1], "tst"])
+took = time.perf_counter() - started
+print(json.dumps({
+    "seconds": took,
+    "modules": sorted(set(sys.modules) - before),
+    "out": out.getvalue(),
+}))
+"""
+
+# a notifier, the process handling, or anything only a real run needs
+NOT_NEEDED = [
+    "rsyncr.message",
+    "rsyncr.history",
+    "rsyncr.output",
+    "rsyncr.stats",
+    "rsyncr.ssh",
+    "rsyncr.tune",
+    "telegram_send",
+    "subprocess",
+    "sqlite3",
+    "concurrent.futures",
+    "dataclasses",
+]
+MAX_MODULES = 60
+MAX_SECONDS = 0.5
+
+
+def probe(tmpdir):
+    tmpdir.join("global.toml").write('rsync_command = "echo"\n')
+    tmpdir.join("config.tst.toml").write(
+        f"""
+target_root = "{tmpdir}/backups"
+excludes = ["*.tmp"]
+
+[sources.docs]
+location = "/home/me/docs"
+target = "docs"
+"""
+    )
+    env = dict(os.environ, RSYNCR_CACHE_DIR="")
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE, str(tmpdir)],
+        stdout=subprocess.PIPE,
+        env=env,
+        check=True,
+    ).stdout
+    return json.loads(out)
+
+
+def test_check_prints_commands(tmpdir):
+    found = probe(tmpdir)
+    assert "tst: ok, 1 source(s)" in found["out"]
+    assert "    echo " in found["out"]
+    assert "'--exclude=*.tmp'" in found["out"]
+    assert "/home/me/docs/" in found["out"]
+
+
+def test_check_stays_light(tmpdir):
+    found = probe(tmpdir)
+    loaded = set(found["modules"])
+    assert not loaded & set(NOT_NEEDED)
+    if config.fast_toml_parse is not None:
+        assert "tomlkit" not in loaded
+    assert len(loaded) <= MAX_MODULES, sorted(loaded)
+    assert found["seconds"] < MAX_SECONDS
+
+
+def test_check_bad_config(tmpdir, capsys):
+    from rsyncr import run
+
+    tmpdir.join("global.toml").write("")
+    tmpdir.join("config.broken.toml").write("[sources.x]\nlocation = 'relative'\n")
+    try:
+        run.cli(["check", "--configs-dir", str(tmpdir), "broken"])
+    except SystemExit as e:
+        assert e.code == 1
+    else:
+        assert False, "a bad config should fail the check"
+    assert "broken: BAD" in capsys.readouterr().out
+
+
+def test_check_bad_notifier(tmpdir, capsys):
+    from rsyncr import run
+
+    tmpdir.join("global.toml").write('notifiers = [{kind = "webhook"}]\n')
+    tmpdir.join("config.tst.toml").write(f'target_root = "{tmpdir}"\n')
+    try:
+        run.cli(["check", "--configs-dir", str(tmpdir), "tst"])
+    except SystemExit as e:
+        assert e.code == 1
+    else:
+        assert False, "a bad notifier should fail the check"
+    assert "the webhook notifier needs url" in capsys.readouterr().out
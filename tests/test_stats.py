@@ -0,0 +1,76 @@
+import json
+
+from rsyncr import stats
+
+RSYNC_OUTPUT = """\
+>f+++++++++ new.txt
+>f.st...... changed.bin
+cd+++++++++ newdir/
+.d..t...... olddir/
+*deleting   gone.txt
+
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 10 (reg: 9, dir: 1)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 2
+Total file size: 123,456,789 bytes
+Total transferred file size: 12,345 bytes
+Literal data: 12,000 bytes
+Matched data: 345 bytes
+File list size: 4,321
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 13,000
+Total bytes received: 300
+
+sent 13,000 bytes  received 300 bytes  26,600.00 bytes/sec
+total size is 123,456,789  speedup is 9,282.46
+"""
+
+
+def test_parse_stats_and_itemized():
+    s = stats.parse(RSYNC_OUTPUT)
+    assert s.files == 1234
+    assert s.files_created == 10
+    assert s.files_deleted == 1
+    assert s.files_transferred == 2
+    assert s.total_file_size == 123456789
+    assert s.transferred_file_size == 12345
+    assert s.literal_data == 12000
+    assert s.matched_data == 345
+    assert s.bytes_sent == 13000
+    assert s.bytes_received == 300
+    assert s.speedup == 9282.46
+    assert s.itemized == {
+        "transferred": 2,
+        "created": 1,
+        "changed": 1,
+        "deleted": 1,
+    }
+
+
+def test_totals_without_stats_block():
+    s = stats.parse("sent 1,234 bytes  received 89 bytes  2,580.00 bytes/sec\n")
+    assert (s.bytes_sent, s.bytes_received) == (1234, 89)
+    assert s.files is None
+
+
+def test_write_metrics(tmpdir):
+    conf = {"capture_file": str(tmpdir.join("out.txt")), "job_name": "web"}
+    result = {
+        "name": "www",
+        "location": "/var/www/",
+        "target": "/backups/www/",
+        "returncode": 0,
+        "error": False,
+        "started": 100.0,
+        "finished": 160.0,
+        "stats": stats.parse(RSYNC_OUTPUT),
+    }
+    stats.write_metrics([conf], [[result]])
+    prom = tmpdir.join("out.prom").read()
+    assert 'rsyncr_source_success{job="web",source="www"} 1' in prom
+    assert 'rsyncr_source_duration_seconds{job="web",source="www"} 60.0' in prom
+    assert 'rsyncr_source_sent_bytes{job="web",source="www"} 13000' in prom
+    summary = json.loads(tmpdir.join("out.json").read())
+    assert summary["sources"][0]["stats"]["files_transferred"] == 2
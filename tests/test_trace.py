@@ -0,0 +1,62 @@
+import json
+import pstats
+
+from rsyncr import run
+from rsyncr import trace
+
+
+def write_configs(tmpdir):
+    tmpdir.join("global.toml").write(
+        f'rsync_command = "echo"\nconsole_override = true\nstate_dir = "{tmpdir}"\n'
+    )
+    tmpdir.join("config.tst.toml").write(
+        f"""
+target_root = "{tmpdir}"
+
+[sources.s]
+location = "/s/"
+target = "s"
+"""
+    )
+
+
+def test_trace_covers_the_phases(tmpdir, capsys):
+    write_configs(tmpdir)
+    path = tmpdir.join("trace.json")
+    run.cli(["--configs-dir", str(tmpdir), "--trace", str(path), "tst"])
+    events = json.loads(path.read())["traceEvents"]
+    names = {e["name"] for e in events if e["ph"] == "X"}
+    assert {"config.make", "config.merge_configs", "build_command"} <= names
+    assert {"run_command", "source", "job"} <= names
+    (rsync,) = [e for e in events if e["name"] == "run_command"]
+    assert rsync["args"]["returncode"] == 0
+    assert "max_rss_kb" in rsync["args"]
+    assert any(e["ph"] == "M" for e in events)
+    # and it's off again afterwards
+    assert not trace.enabled()
+
+
+def test_profile(tmpdir, capsys):
+    write_configs(tmpdir)
+    path = tmpdir.join("profile.out")
+    run.cli(["--configs-dir", str(tmpdir), "--profile", str(path), "tst"])
+    assert pstats.Stats(str(path)).total_calls > 0
+
+
+def test_profile_sees_the_workers(tmpdir, capsys):
+    write_configs(tmpdir)
+    tmpdir.join("config.tst.toml").write(
+        '\n[sources.t]\nlocation = "/t/"\ntarget = "t"\n', mode="a"
+    )
+    path = tmpdir.join("profile.out")
+    run.cli(["--configs-dir", str(tmpdir), "--profile", str(path), "-j", "2", "tst"])
+    stats = pstats.Stats(str(path)).stats
+    # the rsync output's read in the worker threads
+    (calls,) = [v[1] for k, v in stats.items() if k[2] == "stream_command"]
+    assert calls == 2
+
+
+def test_spans_are_free_when_off():
+    with trace.span("nothing", x=1) as args:
+        args["y"] = 2
+    assert not trace.enabled()
@@ -0,0 +1,89 @@
+from rsyncr import config
+from rsyncr import run
+from rsyncr import tune
+
+VERSION = """rsync  version 3.2.7  protocol version 31
+Copyright (C) 1996-2022 by Andrew Tridgell, Wayne Davison, and others.
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+Optimizations:
+    SIMD-roll, no asm-roll, openssl-crypto, no asm-MD5
+Checksum list:
+    xxh128 xxh3 xxh64 (xxhash) md5 md4 none
+Compress list:
+    zstd lz4 zlibx zlib none
+"""
+
+# an 'ssh' that runs things here instead, and has an rsync that says VERSION
+FAKE_SSH = f"""
+import subprocess, sys
+host, *cmd = sys.argv[1:]
+if cmd == ["rsync", "--version"]:
+    print({VERSION!r})
+else:
+    sys.exit(subprocess.call(" ".join(cmd), shell=True))
+"""
+
+
+def test_parse_version():
+    found = tune.parse_version(VERSION)
+    assert found["version"] == "3.2.7"
+    assert found["compress"][:2] == ["zstd", "lz4"]
+    assert "(xxhash)" not in found["checksum"]
+    old = tune.parse_version("rsync  version 3.1.3  protocol version 31\n")
+    assert old["version"] == "3.1.3" and old["compress"] == []
+
+
+def test_choose():
+    new = tune.parse_version(VERSION)
+    old = tune.parse_version("rsync  version 3.1.3  protocol version 31\n")
+    assert tune.choose("/home/") == ["--whole-file"]
+    assert tune.choose("h:/x/", dict(new, throughput=100e6), new) == []
+    assert tune.choose("h:/x/", dict(new, throughput=1e6), new)[-1].endswith("zstd")
+    assert tune.choose("h:/x/", dict(new, throughput=10e6), new)[-1].endswith("lz4")
+    assert tune.choose("h:/x/", dict(old, throughput=1e6), new) == ["-z"]
+    # a probe that failed means leaving things alone
+    assert tune.choose("h:/x/", None, new) == []
+
+
+def test_explicit_settings_win():
+    conf = config.merge_configs(
+        {"global_rsync_params": ["--archive", "--no-whole-file"]},
+        {"sources": {"s": {"location": "/a/", "target": "/b/"}}},
+        {},
+    )
+    cmd = run.build_command(conf, "s", tuned=["--whole-file"])
+    assert "--whole-file" not in cmd
+    assert tune.drop_overridden(["-z", "--compress-choice=lz4"], ["--zc=zstd"]) == []
+
+
+def test_probe_is_cached(fake_rsync, tmpdir):
+    ssh = fake_rsync(FAKE_SSH, "ssh").path
+    path = str(tmpdir.join("tune.json"))
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return tune.probe_host("pasilla", ssh)
+
+    found = tune.Tuner(path).get("pasilla", probe)
+    assert found["version"] == "3.2.7" and found["throughput"] > 0
+    # a new run, and it's still fresh
+    assert tune.Tuner(path).get("pasilla", probe)["version"] == "3.2.7"
+    assert len(calls) == 1
+    tune.Tuner(path, ttl=0).get("pasilla", probe)
+    assert len(calls) == 2
+
+
+def test_local_source_gets_whole_file(tmpdir):
+    conf = config.merge_configs(
+        {"rsync_command": "echo", "state_dir": str(tmpdir)},
+        {"auto_tune": True, "sources": {"s": {"location": "/a/", "target": "/b/"}}},
+        {},
+    )
+    ctx = run.RunContext(conf, [conf])
+    try:
+        result = run.run_source(conf, "s", ctx)
+    finally:
+        ctx.close()
+    assert "--whole-file" in result["command"]
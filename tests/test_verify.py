@@ -0,0 +1,68 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from rsyncr import config
+from rsyncr import filters
+from rsyncr import verify
+
+
+def make_trees(tmpdir):
+    data = os.urandom(3 * verify.CHUNK + 7)
+    for side in ("src", "dst"):
+        tmpdir.join(side, "a.txt").write("hello", ensure=True)
+        tmpdir.join(side, "sub", "b.bin").write_binary(data, ensure=True)
+        tmpdir.join(side, "cache", "junk").write(side, ensure=True)
+    conf = config.merge_configs(
+        {"state_dir": str(tmpdir.join("state"))},
+        {
+            "excludes": ["cache/"],
+            "sources": {
+                "s": {"location": f"{tmpdir}/src/", "target": f"{tmpdir}/dst/"}
+            },
+        },
+        {},
+    )
+    return conf
+
+
+def check(conf, tmpdir):
+    cache = verify.HashCache(str(tmpdir.join("state", "hashes.sqlite")))
+    try:
+        with ProcessPoolExecutor(2) as pool:
+            return verify.verify_source(conf, "s", cache, pool)
+    finally:
+        cache.close()
+
+
+def test_verify_finds_differences_and_caches_hashes(tmpdir):
+    conf = make_trees(tmpdir)
+    mismatches, stats = check(conf, tmpdir)
+    assert mismatches == []
+    assert stats["hashed"] == 4 and stats["cached"] == 0
+    assert "0 mismatches" in verify.format_verify("s", mismatches, stats)
+    pf = stats["per_file"]
+    assert 0 < pf["slowest"] <= pf["median"] <= pf["fastest"]
+    assert "MB/s median" in verify.format_verify("s", mismatches, stats)
+
+    # same size, different bytes, and a file that never got copied
+    tmpdir.join("dst", "a.txt").write("jello")
+    tmpdir.join("src", "new.txt").write("new")
+    mismatches, stats = check(conf, tmpdir)
+    assert sorted(mismatches) == [("content", "a.txt"), ("missing", "new.txt")]
+    # only the rewritten file gets read again
+    assert stats["hashed"] == 1 and stats["cached"] == 3
+
+
+def test_target_root_follows_rsync_trailing_slash():
+    assert verify.target_root({"location": "/a/b/", "target": "/t/"}) == "/t/"
+    assert verify.target_root({"location": "/a/b", "target": "/t"}) == "/t/b"
+
+
+def test_matcher():
+    excluded = filters.matcher(["*.tmp", "cache/", "/top", "a/b"])
+    assert excluded("x/y.tmp")
+    assert excluded("deep/cache", is_dir=True)
+    assert not excluded("deep/cache")
+    assert excluded("top") and not excluded("x/top")
+    assert excluded("a/b") and excluded("x/a/b")
+    assert not excluded("keep.txt")
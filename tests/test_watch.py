@@ -0,0 +1,100 @@
+import sys
+
+import pytest
+
+from rsyncr import watch
+
+if not sys.platform.startswith("linux"):
+    pytest.skip("inotify is linux only", allow_module_level=True)
+
+# an 'rsync' that writes down how it was called, and what was in its --files-from
+FAKE_RSYNC = """
+import json, os, sys
+args = sys.argv[1:]
+listed = None
+for a in args:
+    if a.startswith("--files-from="):
+        listed = open(a.split("=", 1)[1], "rb").read().decode().split("\\0")[:-1]
+with open(os.environ["RSYNC_LOG"], "a") as f:
+    f.write(json.dumps({"args": args, "listed": listed}) + "\\n")
+"""
+
+
+@pytest.fixture
+def watcher(fake_rsync, tmpdir):
+    fake = fake_rsync(FAKE_RSYNC)
+    src = tmpdir.mkdir("src")
+    src.mkdir("old").join("a").write("a")
+    conf = fake.conf(
+        f"""
+target_root = "{tmpdir}/backups"
+excludes = ["*.tmp", "cache/"]
+
+[sources.s]
+location = "{src}"
+target = "s"
+"""
+    )
+    w = watch.Watcher(conf)
+    w.start()
+    yield w, src, fake
+    w.close()
+
+
+def test_watch_command():
+    cmd = watch.watch_command(
+        ["rsync", "-a", "--delete", "--delete-excluded", "/src/", "/dst/"], "/l"
+    )
+    assert "--delete" not in cmd and "--delete-excluded" not in cmd
+    assert "--files-from=/l" in cmd and "--delete-missing-args" in cmd
+    assert cmd[-2:] == ["/src/", "/dst/"]
+
+
+def test_start_reconciles(watcher):
+    w, src, fake = watcher
+    (first,) = fake.calls()
+    assert first["listed"] is None
+    assert "--delete" in first["args"]
+
+
+def test_changes_are_batched(watcher):
+    w, src, fake = watcher
+    src.join("new.txt").write("x")
+    src.join("junk.tmp").write("x")
+    src.mkdir("cache").join("c").write("x")
+    src.join("old", "a").remove()
+    # a new directory, with things in it already by the time it's seen
+    sub = src.mkdir("sub")
+    sub.mkdir("deeper").join("f").write("x")
+    w.handle(w.inotify.read(1.0), now=0)
+    assert not w.batch_due(0)
+    assert w.batch_due(w.conf["watch_batch_seconds"])
+    w.push()
+    last = fake.calls()[-1]
+    assert last["listed"] == ["new.txt", "old/a", "sub", "sub/deeper", "sub/deeper/f"]
+    assert "--delete" not in last["args"]
+
+    # and the new directory is watched
+    sub.join("deeper", "g").write("x")
+    w.handle(w.inotify.read(1.0))
+    w.push()
+    assert fake.calls()[-1]["listed"] == ["sub/deeper/g"]
+
+
+def test_big_batches_go_early(watcher):
+    w, src, fake = watcher
+    w.conf["watch_batch_size"] = 3
+    for i in range(3):
+        src.join(f"f{i}").write("x")
+    w.handle(w.inotify.read(1.0), now=0)
+    assert w.batch_due(0)
+
+
+def test_overflow_reconciles(watcher):
+    w, src, fake = watcher
+    assert w.reconcile_at > 0
+    w.handle([(-1, watch.IN_Q_OVERFLOW, "")])
+    assert w.reconcile_at == 0
+    w.step(0)
+    assert len(fake.calls()) == 2
+    assert fake.calls()[-1]["listed"] is None
@@ -0,0 +1,104 @@
+import sys
+import json
+import time
+
+from rsyncr import output
+from rsyncr import run
+from rsyncr import watchdog
+
+# an 'rsync' that shows progress for a while, then goes quiet for as long as
+# the target's name says
+FAKE_RSYNC = """
+import sys, time
+for i in range(1, 6):
+    sys.stdout.write(f"     {i * 1000:,}  {i * 10}%   1.00MB/s    0:00:0{i}\\r")
+    sys.stdout.flush()
+    time.sleep(0.3)
+print("     5,000  50%   1.00MB/s    0:00:05 (xfr#1, to-chk=0/1)")
+print("sent 100 bytes  received 5,000 bytes  1,000.00 bytes/sec")
+sys.stdout.flush()
+time.sleep(float(sys.argv[-1].strip("/").rsplit("/", 1)[-1]))
+"""
+
+
+# one that leaves a child (like rsync's ssh) holding the output pipe, then hangs
+FORKING_RSYNC = """
+import subprocess, sys, time
+print("connecting")
+sys.stdout.flush()
+subprocess.Popen(["sleep", "60"])
+time.sleep(60)
+"""
+
+
+def make_conf(fake_rsync, hang, script=FAKE_RSYNC, **extra):
+    fake = fake_rsync(script)
+    d = {"location": "/nowhere/", "target": f"{fake.tmpdir}/{hang}/"}
+    return fake.conf({"sources": {"s": d}}, **extra)
+
+
+def test_progress_lines():
+    dog = watchdog.Watchdog()
+    assert dog.progress("  1,234,567  45%   12.34MB/s    0:01:02 (xfr#3, to-chk=1/9)\r")
+    assert dog.bytes == 1234567 and dog.percent == 45
+    assert not dog.progress("some/file/name\n")
+
+
+def test_stalled_source_is_killed(fake_rsync):
+    conf = make_conf(fake_rsync, 60, stall_timeout=1)
+    assert "--info=progress2" in run.build_command(conf, "s")
+    result = run.run_source(conf, "s")
+    assert result["error"] and result["returncode"] == watchdog.RETURNCODE
+    assert "no progress for 1s" in result["output"]
+    # the progress lines themselves stay out of the report
+    assert "10%" not in result["output"]
+    assert "sent 100 bytes" in result["output"]
+
+
+def test_children_are_killed_too(fake_rsync):
+    conf = make_conf(fake_rsync, 60, script=FORKING_RSYNC, stall_timeout=1)
+    began = time.monotonic()
+    result = run.run_source(conf, "s")
+    # not left waiting for the child to let go of the pipe
+    assert time.monotonic() - began < watchdog.KILL_GRACE
+    assert result["returncode"] == watchdog.RETURNCODE
+    assert "connecting" in result["output"]
+
+
+def test_slow_but_moving_source_survives(fake_rsync):
+    # progress keeps coming for 1.5s, which is longer than the stall window
+    conf = make_conf(fake_rsync, 0, stall_timeout=1)
+    assert not run.run_source(conf, "s")["error"]
+
+
+def test_hard_timeout_and_status_file(fake_rsync, tmpdir):
+    status = tmpdir.join("status.json")
+    conf = make_conf(fake_rsync, 60, timeout=2, status_file=str(status))
+    ctx = run.RunContext(conf, [conf])
+    seen = []
+    real = ctx.board._write
+
+    def spy(force):
+        real(force)
+        if status.check():
+            seen.append(json.loads(status.read()))
+
+    ctx.board._write = spy
+    try:
+        result = run.run_source(conf, "s", ctx)
+    finally:
+        ctx.close()
+    assert result["returncode"] == watchdog.RETURNCODE
+    assert "after 2s (timeout)" in result["output"]
+    assert any(s["sources"].get("tst/s", {}).get("bytes") for s in seen)
+    # and it's gone from the file once it's finished
+    assert json.loads(status.read())["sources"] == {}
+
+
+def test_crlf_split_across_reads():
+    kept, returncode = output.stream_command(
+        [sys.executable, "-c", "print('a', end='\\r', flush=True); print('b')"],
+        watchdog=watchdog.Watchdog(),
+    )
+    assert returncode == 0
+    assert kept.text() == "a\nb\n"